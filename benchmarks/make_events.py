@@ -0,0 +1,154 @@
+#################################################
+# Generate synthetic NanoAOD-like event samples #
+#################################################
+# The events mimic the structure of the NanoAOD files used in this repository,
+# so that the full chain can be benchmarked (or tested) without access to real input files:
+# - DsMeson: jagged collection of candidates (nDsMeson, DsMeson_pt, DsMeson_mass,
+#   DsMeson_tr1tr2_deltaR, DsMeson_KPlus_pt, DsMeson_hasFastGenmatch)
+# - DStarMeson: jagged collection of candidates (nDStarMeson, DStarMeson_pt,
+#   DStarMeson_deltamr, DStarMeson_hasFastGenmatch)
+# - MET_pt, genWeight: one value per event
+# The number of candidates per event is Poisson distributed with a configurable mean,
+# and the distributions of the candidate variables differ between signal and background,
+# so that cut optimization on them gives non-trivial results.
+# Usage (standalone):
+# - python benchmarks/make_events.py -o <output directory> -n <number of events>
+
+
+# imports
+import os
+import argparse
+import numpy as np
+import awkward as ak
+import uproot
+
+
+def make_chunk( nevents, multiplicity=2., signal=False, rng=None ):
+    ### generate a chunk of events
+    # input arguments:
+    # - nevents: number of events
+    # - multiplicity: mean number of candidates per event (for each collection)
+    # - signal: generate signal-like (True) or background-like (False) events
+    # - rng: numpy random generator
+    # returns:
+    # a dict mapping collection and branch names to (awkward or numpy) arrays,
+    # in the format expected by uproot's mktree and extend.
+    if rng is None: rng = np.random.default_rng()
+    arrays = {}
+    # DsMeson candidates
+    counts = rng.poisson(multiplicity, nevents)
+    ntot = int(counts.sum())
+    genmatch = rng.random(ntot) < (0.3 if signal else 0.)
+    mass = np.where(genmatch, rng.normal(1.969, 0.015, ntot), rng.uniform(1.85, 2.1, ntot))
+    deltar = np.abs(rng.normal(0., np.where(genmatch, 0.05, 0.15), ntot))
+    kpluspt = rng.exponential(np.where(genmatch, 3., 1.5), ntot) + 0.5
+    pt = rng.exponential(np.where(genmatch, 8., 5.), ntot) + 1.
+    fields = {'pt': pt, 'mass': mass, 'tr1tr2_deltaR': deltar, 'KPlus_pt': kpluspt}
+    fields = {key: ak.unflatten(val.astype(np.float32), counts) for key, val in fields.items()}
+    fields['hasFastGenmatch'] = ak.unflatten(genmatch, counts)
+    arrays['DsMeson'] = ak.zip(fields)
+    # DStarMeson candidates
+    counts = rng.poisson(multiplicity, nevents)
+    ntot = int(counts.sum())
+    genmatch = rng.random(ntot) < (0.2 if signal else 0.)
+    deltamr = np.where(genmatch, rng.normal(0.1455, 0.001, ntot), rng.uniform(0.139, 0.17, ntot))
+    pt = rng.exponential(np.where(genmatch, 8., 5.), ntot) + 1.
+    fields = {'pt': pt, 'deltamr': deltamr}
+    fields = {key: ak.unflatten(val.astype(np.float32), counts) for key, val in fields.items()}
+    fields['hasFastGenmatch'] = ak.unflatten(genmatch, counts)
+    arrays['DStarMeson'] = ak.zip(fields)
+    # event-level variables
+    arrays['MET_pt'] = rng.exponential(30. if signal else 50., nevents).astype(np.float32)
+    arrays['genWeight'] = rng.normal(1., 0.1, nevents).astype(np.float32)
+    return arrays
+
+def make_events(
+    outputfile,
+    nevents,
+    multiplicity=2.,
+    signal=False,
+    seed=None,
+    stepsize=100000,
+    treename='Events'):
+    ### generate events and write them to a ROOT file
+    # input arguments:
+    # - outputfile: ROOT file to write
+    # - nevents: number of events
+    # - multiplicity, signal: see make_chunk
+    # - seed: seed for the random generator
+    # - stepsize: number of events to generate and write at once
+    # - treename: name of the tree
+    rng = np.random.default_rng(seed)
+    with uproot.recreate(outputfile) as f:
+        for start in range(0, nevents, stepsize):
+            arrays = make_chunk(min(stepsize, nevents-start), multiplicity=multiplicity,
+                       signal=signal, rng=rng)
+            if treename not in f:
+                f.mktree(treename, {key: (val.type if isinstance(val, ak.Array) else val.dtype)
+                                    for key, val in arrays.items()},
+                  field_name=lambda outer, inner: f"{outer}_{inner}",
+                  counter_name=lambda counted: f"n{counted}")
+            f[treename].extend(arrays)
+
+def make_samples(
+    outputdir,
+    nevents,
+    sigfraction=0.2,
+    multiplicity=2.,
+    nfiles=1,
+    seed=1,
+    reuse=True):
+    ### generate a set of signal and background files
+    # input arguments:
+    # - outputdir: directory to write the files to
+    # - nevents: total number of events (signal and background)
+    # - sigfraction: fraction of signal events
+    # - multiplicity: mean number of candidates per event
+    # - nfiles: number of files to split the signal and the background events into
+    # - seed: seed for the random generator (each file gets a different seed derived from it)
+    # - reuse: do not generate files that already exist
+    #          (the settings are encoded in the file names, so existing files are identical)
+    # returns:
+    # a tuple of the form (list of signal files, list of background files)
+    if not os.path.exists(outputdir): os.makedirs(outputdir)
+    nsig = int(round(nevents*sigfraction))
+    files = {True: [], False: []}
+    for signal, ntot in [(True, nsig), (False, nevents-nsig)]:
+        if ntot==0: continue
+        tag = 'sig' if signal else 'bkg'
+        nperfile = [len(part) for part in np.array_split(np.arange(ntot), nfiles)]
+        for idx, n in enumerate(nperfile):
+            if n==0: continue
+            name = '{}_n{}_m{}_s{}_{}of{}.root'.format(tag, ntot, multiplicity, seed, idx, nfiles)
+            outputfile = os.path.join(outputdir, name)
+            if( not reuse or not os.path.exists(outputfile) ):
+                make_events(outputfile, n, multiplicity=multiplicity, signal=signal,
+                  seed=[seed, int(signal), idx])
+            files[signal].append(outputfile)
+    return (files[True], files[False])
+
+
+if __name__=='__main__':
+
+    # read arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--outputdir', required=True)
+    parser.add_argument('-n', '--nevents', default=100000, type=int,
+      help='Total number of events (signal and background)')
+    parser.add_argument('--sigfraction', default=0.2, type=float,
+      help='Fraction of signal events')
+    parser.add_argument('--multiplicity', default=2., type=float,
+      help='Mean number of candidates per event')
+    parser.add_argument('--nfiles', default=1, type=int,
+      help='Number of files for signal and for background')
+    parser.add_argument('--seed', default=1, type=int)
+    args = parser.parse_args()
+
+    # generate the events
+    (sigfiles, bkgfiles) = make_samples(args.outputdir, args.nevents,
+                             sigfraction=args.sigfraction, multiplicity=args.multiplicity,
+                             nfiles=args.nfiles, seed=args.seed, reuse=False)
+    print('Signal files:')
+    for f in sigfiles: print('  - {}'.format(f))
+    print('Background files:')
+    for f in bkgfiles: print('  - {}'.format(f))
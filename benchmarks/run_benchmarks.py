@@ -0,0 +1,313 @@
+####################################################
+# Benchmark the main steps of the cut optimization #
+####################################################
+# Synthetic NanoAOD-like samples are generated (see make_events.py) and used to time:
+# - generate: generating and writing the samples (events/s)
+# - read: reading and reducing the input columns with make_input_file.make_input_columns (events/s)
+# - selection: building event masks with cuttools.pass_selection for random cuts (events/s)
+# - loss_<engine>: calculating the loss with run_hyperopt.calculate_loss
+#   for random cuts, with each counting engine (trials/s, and the time to build the engine)
+# - fmin_<engine>: full hyperopt fmin runs with the TPE algorithm (trials/s)
+# - preprocess: splitting the samples into categories with preprocess.split_files (events/s)
+# For each benchmark, the peak resident memory (RSS) of the process up to that point is reported,
+# so it should be compared between runs with the same set of benchmarks (run in the above order).
+# The results are written to a json file, which can be passed back as a baseline
+# to compare later changes against.
+# Usage:
+# - python benchmarks/run_benchmarks.py -o <output json file> [--baseline <earlier json file>]
+
+
+# imports
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import tempfile
+import argparse
+import numpy as np
+from functools import partial
+
+# local imports
+thisdir = os.path.abspath(os.path.dirname(__file__))
+topdir = os.path.abspath(os.path.join(thisdir, '../'))
+sys.path.append(thisdir)
+sys.path.append(topdir)
+sys.path.append(os.path.join(topdir, 'tools'))
+from make_events import make_samples
+
+# benchmark grid
+# (cuts on jagged candidate variables and on an event-level variable)
+# note: the grid is coarse enough for the lattice engine to need less than 1 GB.
+gridconfig = [
+  ('DsMeson_mass_min', 1.85, 2.0, 0.01),
+  ('DsMeson_mass_max', 1.95, 2.1, 0.01),
+  ('DsMeson_tr1tr2_deltaR_max', 0., 0.5, 0.025),
+  ('DsMeson_KPlus_pt_min', 0., 10., 0.5),
+  ('MET_pt_max', 0., 300., 20.),
+]
+
+
+def get_peak_rss():
+    ### get the peak resident memory of the current process in MB
+    # note: ru_maxrss is in kB on linux, but in bytes on macos.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform=='darwin': return peak/1e6
+    return peak/1e3
+
+def get_environment():
+    ### get the versions of the relevant packages and the machine information
+    env = {'python': platform.python_version(), 'platform': platform.platform(),
+           'processor': platform.processor(), 'ncpus': os.cpu_count()}
+    for package in ['numpy', 'awkward', 'uproot', 'hyperopt']:
+        try: env[package] = __import__(package).__version__
+        except ImportError: env[package] = None
+    return env
+
+def make_benchmark_grid():
+    ### make the hyperopt grid for the benchmarks
+    from hyperopt import hp
+    return {cutname: hp.quniform(cutname, low, high, step)
+            for (cutname, low, high, step) in gridconfig}
+
+def get_random_cuts( grid, ncuts, seed=1 ):
+    ### get a list of random cut configurations from a hyperopt grid
+    from hyperopt.pyll import stochastic
+    rng = np.random.default_rng(seed)
+    return [stochastic.sample(grid, rng=rng) for _ in range(ncuts)]
+
+def timed( func, *args, **kwargs ):
+    ### call a function and measure the elapsed wall time
+    # returns:
+    # a tuple of the form (return value, elapsed time in seconds)
+    starttime = time.perf_counter()
+    res = func(*args, **kwargs)
+    return (res, max(time.perf_counter()-starttime, 1e-9))
+
+def make_result( elapsed, nevents=None, ntrials=None, **kwargs ):
+    ### make a dict with the result of a benchmark
+    res = {'time': elapsed}
+    if nevents is not None: res['events_per_s'] = nevents/elapsed
+    if ntrials is not None: res['trials_per_s'] = ntrials/elapsed
+    res.update(kwargs)
+    res['peak_rss_mb'] = get_peak_rss()
+    return res
+
+def make_engine( name, columns, sig_mask, grid ):
+    ### make a counting engine by name (as for the --engine option of run_hyperopt.py)
+    from maskengine import MaskEngine
+    from sortedindex import SortedIndexEngine
+    from lattice import LatticeEngine, get_grid_lattices
+    from maskcache import MaskCacheEngine
+    if name=='mask': return MaskEngine(columns, sig_mask)
+    if name=='sorted': return SortedIndexEngine(columns, sig_mask)
+    if name=='lattice': return LatticeEngine(columns, sig_mask, get_grid_lattices(grid))
+    if name=='maskcache': return MaskCacheEngine(columns, sig_mask)
+    if name=='numba':
+        from candidates import CandidateEngine
+        return CandidateEngine(columns, sig_mask)
+    raise Exception('ERROR: engine {} not recognized.'.format(name))
+
+def build_engine( name, columns, sig_mask, grid, cuts ):
+    ### make a counting engine by name and count the passing events for one configuration
+    # note: this way, one-time costs at the first call (e.g. compiling the numba kernel
+    #       or loading it from the cache) are counted in the build time of the engine,
+    #       instead of in the time per trial.
+    engine = make_engine(name, columns, sig_mask, grid)
+    engine.count(cuts)
+    return engine
+
+def run_benchmarks(
+    workdir,
+    nevents=100000,
+    sigfraction=0.2,
+    multiplicity=2.,
+    nfiles=1,
+    seed=1,
+    nselections=100,
+    ntrials=200,
+    engines=None,
+    fminengines=None,
+    nthreads=1):
+    ### run all benchmarks
+    # input arguments:
+    # - workdir: directory for the generated samples and other temporary files
+    # - nevents, sigfraction, multiplicity, nfiles, seed: see make_events.make_samples
+    # - nselections: number of random cut configurations for the selection and loss benchmarks
+    # - ntrials: number of trials for the fmin benchmarks
+    # - engines: list of engines for the loss benchmarks
+    # - fminengines: list of engines for the fmin benchmarks
+    # - nthreads: number of threads for reading the input files
+    # returns:
+    # a dict mapping benchmark names to dicts with the results
+    if engines is None: engines = ['mask', 'sorted', 'lattice', 'maskcache']
+    if fminengines is None: fminengines = ['mask', 'sorted']
+    results = {}
+
+    def report( name ):
+        res = results[name]
+        msg = '{}: {:.3f} s'.format(name, res['time'])
+        if 'events_per_s' in res: msg += ', {:.3g} events/s'.format(res['events_per_s'])
+        if 'trials_per_s' in res: msg += ', {:.3g} trials/s'.format(res['trials_per_s'])
+        if 'build_time' in res: msg += ' (engine built in {:.3f} s)'.format(res['build_time'])
+        msg += ', peak RSS {:.0f} MB'.format(res['peak_rss_mb'])
+        print(msg)
+
+    # generate the samples
+    # note: generating is only timed if the files did not exist yet.
+    existing = set(os.listdir(workdir)) if os.path.exists(workdir) else set()
+    (files, elapsed) = timed(make_samples, workdir, nevents, sigfraction=sigfraction,
+                         multiplicity=multiplicity, nfiles=nfiles, seed=seed)
+    (sigfiles, bkgfiles) = files
+    if all([os.path.basename(f) in existing for f in sigfiles+bkgfiles]):
+        print('generate: reusing existing samples in {}'.format(workdir))
+    else:
+        results['generate'] = make_result(elapsed, nevents=nevents)
+        report('generate')
+
+    # read the input columns
+    from make_input_file import make_input_columns
+    grid = make_benchmark_grid()
+    cutnames = list(grid.keys())
+    (res, elapsed) = timed(make_input_columns, sigfiles, bkgfiles, cutnames, -1, None, None,
+                       nthreads=nthreads)
+    (columns, sig_mask, _) = res
+    results['read'] = make_result(elapsed, nevents=len(sig_mask))
+    report('read')
+
+    # build event masks for random cuts
+    from cuttools import pass_selection
+    cuts = get_random_cuts(grid, nselections, seed=seed)
+    # (a different configuration for the first call to each engine, see build_engine)
+    warmupcuts = get_random_cuts(grid, 1, seed=seed+1)[0]
+    def select_all():
+        for cut in cuts: pass_selection(columns, cut)
+    (_, elapsed) = timed(select_all)
+    results['selection'] = make_result(elapsed, nevents=len(sig_mask)*len(cuts),
+                             ntrials=len(cuts))
+    report('selection')
+
+    # calculate the loss for random cuts with each engine
+    from run_hyperopt import calculate_loss
+    for name in engines:
+        (engine, buildtime) = timed(build_engine, name, columns, sig_mask, grid, warmupcuts)
+        iteration = [1]
+        def loss_all():
+            return [calculate_loss(columns, cut, sig_mask=sig_mask, iteration=iteration,
+                                   engine=engine)['loss'] for cut in cuts]
+        (losses, elapsed) = timed(loss_all)
+        key = 'loss_{}'.format(name)
+        results[key] = make_result(elapsed, ntrials=len(cuts), build_time=buildtime,
+                         bestloss=float(np.min(losses)))
+        report(key)
+        del engine
+
+    # run hyperopt with each engine
+    from hyperopt import fmin, tpe, Trials
+    for name in fminengines:
+        (engine, buildtime) = timed(build_engine, name, columns, sig_mask, grid, warmupcuts)
+        trials = Trials()
+        iteration = [1]
+        (_, elapsed) = timed(fmin, fn=partial(calculate_loss, columns, sig_mask=sig_mask,
+                                           iteration=iteration, engine=engine),
+                         space=grid, algo=tpe.suggest, max_evals=ntrials, trials=trials,
+                         rstate=np.random.default_rng(seed), show_progressbar=False)
+        key = 'fmin_{}'.format(name)
+        results[key] = make_result(elapsed, ntrials=len(trials.trials), build_time=buildtime,
+                         bestloss=float(min(trials.losses())))
+        report(key)
+        del engine
+
+    # split the samples into categories
+    from preprocess import load_config, split_files
+    config = load_config(os.path.join(topdir, 'preprocess_config.json'))
+    outputfiles = {category['category']: os.path.join(workdir, 'split_{}.root'.format(category['category']))
+                   for category in config}
+    (counts, elapsed) = timed(split_files, sigfiles+bkgfiles, 'Events', outputfiles, config)
+    results['preprocess'] = make_result(elapsed, nevents=nevents)
+    report('preprocess')
+    for outputfile in outputfiles.values(): os.remove(outputfile)
+
+    return results
+
+def compare( results, baseline ):
+    ### print a comparison of the results with a baseline
+    # note: for each benchmark, the ratio of the throughput (events/s or trials/s)
+    #       to the baseline is shown, i.e. a ratio above 1 means faster than the baseline.
+    print('Comparison with baseline (ratio of throughput, >1 is faster):')
+    for name, res in results.items():
+        if name not in baseline:
+            print('  - {}: not in baseline'.format(name))
+            continue
+        base = baseline[name]
+        ratios = []
+        for key in ['events_per_s', 'trials_per_s']:
+            if( key in res and key in base and base[key]>0 ):
+                ratios.append('{} x{:.2f}'.format(key, res[key]/base[key]))
+        if( 'peak_rss_mb' in base and base['peak_rss_mb']>0 ):
+            ratios.append('peak RSS x{:.2f}'.format(res['peak_rss_mb']/base['peak_rss_mb']))
+        print('  - {}: {}'.format(name, ', '.join(ratios)))
+
+
+if __name__=='__main__':
+
+    # read arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--outputfile', default=None,
+      help='Json file to write the results to')
+    parser.add_argument('--baseline', default=None,
+      help='Json file with earlier results to compare to')
+    parser.add_argument('-w', '--workdir', default=None,
+      help='Directory for the generated samples; if specified, the samples are kept'
+          +' and reused in later runs with the same settings (default: temporary directory)')
+    parser.add_argument('-n', '--nevents', default=100000, type=int,
+      help='Total number of events (signal and background)')
+    parser.add_argument('--sigfraction', default=0.2, type=float,
+      help='Fraction of signal events')
+    parser.add_argument('--multiplicity', default=2., type=float,
+      help='Mean number of candidates per event')
+    parser.add_argument('--nfiles', default=1, type=int,
+      help='Number of files for signal and for background')
+    parser.add_argument('--seed', default=1, type=int)
+    parser.add_argument('--nselections', default=100, type=int,
+      help='Number of random cut configurations for the selection and loss benchmarks')
+    parser.add_argument('--ntrials', default=200, type=int,
+      help='Number of trials for the fmin benchmarks')
+    parser.add_argument('--engines', default=['mask', 'sorted', 'lattice', 'maskcache'], nargs='+',
+      choices=['mask', 'sorted', 'lattice', 'maskcache', 'numba'],
+      help='Engines for the loss benchmarks')
+    parser.add_argument('--fminengines', default=['mask', 'sorted'], nargs='+',
+      choices=['mask', 'sorted', 'lattice', 'maskcache', 'numba'],
+      help='Engines for the fmin benchmarks')
+    parser.add_argument('--nthreads', default=1, type=int,
+      help='Number of input files to read concurrently')
+    args = parser.parse_args()
+
+    # set the working directory
+    workdir = args.workdir
+    if workdir is None: workdir = tempfile.mkdtemp(prefix='nanohyperopt_benchmark_')
+
+    # run the benchmarks
+    settings = {key: getattr(args, key) for key in ['nevents', 'sigfraction', 'multiplicity',
+                'nfiles', 'seed', 'nselections', 'ntrials', 'engines', 'fminengines', 'nthreads']}
+    try:
+        results = run_benchmarks(workdir, **settings)
+    finally:
+        if args.workdir is None: shutil.rmtree(workdir)
+
+    # write the results
+    output = {'settings': settings, 'environment': get_environment(),
+              'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': results}
+    if args.outputfile is not None:
+        with open(args.outputfile, 'w') as f: json.dump(output, f, indent=2)
+        print('Results written to {}'.format(args.outputfile))
+
+    # compare to the baseline
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f: baseline = json.load(f)
+        if baseline.get('settings')!=settings:
+            print('WARNING: the baseline was made with different settings: {}'.format(
+                   baseline.get('settings')))
+        compare(results, baseline['results'])
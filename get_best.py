@@ -8,32 +8,167 @@ import os
 import sys
 import argparse
 import pickle as pkl
+import numpy as np
 
+# local imports
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tools'))
+from resultsfile import is_results_dir, load_meta, load_column, load_losses
+from resultsfile import get_trial_loss, get_trial_losses
+
+
+def get_sorted_best(losses, nbest=1):
+    ### return indices of the lowest values in an array of losses
+    # note: the indices are sorted from lower to higher loss value,
+    #       with ties in the original order (as for a stable sort of all losses);
+    #       missing (None or nan) losses are sorted last.
+    # note: only the candidates found with a partial sort are sorted fully,
+    #       so this is fast also for a large number of losses.
+    losses = np.asarray([np.nan if l is None else l for l in losses] if isinstance(losses, list) else losses,
+                        dtype=np.float64)
+    losses = np.nan_to_num(losses, nan=np.inf)
+    if nbest>len(losses): nbest = len(losses)
+    if nbest<=0: return np.zeros(0, dtype=np.int64)
+    threshold = np.partition(losses, nbest-1)[nbest-1]
+    candidates = np.nonzero(losses <= threshold)[0]
+    order = np.argsort(losses[candidates], kind='stable')
+    return candidates[order][:nbest]
 
 def get_best_indices(trials, nbest=1):
     ### return indices of lowest-loss iterations in a trials object
     # note: the indices are sorted from lower to higher loss value
-    losses = trials.losses()
-    if nbest>len(losses): nbest = len(losses)
-    sorted_indices = sorted(range(len(losses)), key=lambda k: losses[k])
-    return sorted_indices[:nbest]
+    # note: trials evaluated on a subsample of the events only
+    #       (i.e. with fidelity smaller than 1, see tools/multifidelity.py)
+    #       have a missing loss, so they are never preferred over trials on all events
+    #       (see resultsfile.get_trial_losses).
+    # note: iterations with a missing loss (e.g. failed ones) are never included,
+    #       so fewer than nbest indices can be returned.
+    losses = get_trial_losses(trials)
+    return [int(idx) for idx in get_sorted_best(losses, nbest=nbest) if not np.isnan(losses[idx])]
+
+def get_missing(loss):
+    ### return None for a missing (nan) loss, else the loss as a python float
+    return None if np.isnan(loss) else float(loss)
+
+def get_trial_info(trials, idx):
+    ### return information of a single iteration in a trials object
+    # note: the loss is the one used for ranking, i.e. None for failed trials
+    #       and for trials with fidelity smaller than 1 (as for columnar results).
+    this_info = {}
+    this_info['loss'] = get_missing(get_trial_loss(trials.trials[idx]))
+    infodict = trials.trials[idx]['result'].get('extra_info', {})
+    for key,val in infodict.items():
+        this_info[key] = val
+    this_info['config'] = {}
+    for name,val in trials.trials[idx]['misc']['vals'].items():
+        this_info['config'][name] = val
+    return this_info
 
 def get_best_info(trials, nbest=1):
     ### return information of lowest-loss iterations in a trials object
-    best_info = []
-    losses = trials.losses()
-    ids = get_best_indices(trials, nbest=nbest)
-    for idx in ids:
+    return [get_trial_info(trials, idx) for idx in get_best_indices(trials, nbest=nbest)]
+
+def open_results(inputfile):
+    ### open a results file for reading single iterations
+    # input arguments:
+    # - inputfile: either a pickled trials object or a columnar results directory
+    # returns:
+    # a tuple of the form (losses, tids, get_info), where losses is an array of losses,
+    # tids an array of trial ids, and get_info a function returning
+    # the information of a single iteration (same format as get_best_info).
+    # note: for columnar results, only the losses are read entirely;
+    #       the other columns are memory-mapped and only read for the requested iterations.
+    if not is_results_dir(inputfile):
+        with open(inputfile,'rb') as f:
+            trials = pkl.load(f)
+        losses = get_trial_losses(trials)
+        tids = np.array([trial['tid'] for trial in trials.trials], dtype=np.int64)
+        return (losses, tids, lambda idx: get_trial_info(trials, idx))
+    meta = load_meta(inputfile)
+    losses = np.asarray(load_losses(inputfile))
+    tids = load_column(inputfile, 'tid')
+    config = load_column(inputfile, 'config')
+    extra = {key: load_column(inputfile, 'extra_'+key) for key in meta['extrakeys']
+             if 'extra_'+key in meta['columns']}
+    def get_info(idx):
         this_info = {}
-        this_info['loss'] = losses[idx]
-        infodict = trials.trials[idx]['result']['extra_info']
-        for key,val in infodict.items():
-            this_info[key] = val
+        this_info['loss'] = get_missing(losses[idx])
+        for key in meta['extrakeys']:
+            if key in extra: this_info[key] = extra[key][idx].item()
+            elif key in meta['constants']: this_info[key] = meta['constants'][key]
         this_info['config'] = {}
-        for name,val in trials.trials[idx]['misc']['vals'].items():
-            this_info['config'][name] = val
-        best_info.append(this_info)
-    return best_info
+        for j,name in enumerate(meta['cutnames']):
+            this_info['config'][name] = [float(config[idx, j])]
+        return this_info
+    return (losses, tids, get_info)
+
+def get_best_info_columnar(inputdir, nbest=1):
+    ### same as get_best_info, but for a columnar results directory
+    (losses, _, get_info) = open_results(inputdir)
+    return [get_info(idx) for idx in get_sorted_best(losses, nbest=nbest) if not np.isnan(losses[idx])]
+
+def get_config_key(config):
+    ### return a hashable key for a configuration (as in the output of get_best_info)
+    return tuple(sorted([(name, tuple([float(v) for v in val])) for name,val in config.items()]))
+
+def get_distinct_best(inputfile, nbest=1):
+    ### return information of the lowest-loss distinct configurations in a single file
+    # note: identical configurations are only kept once; the file and trial id
+    #       of each occurrence are stored under the 'sources' key.
+    # note: iterations with a missing loss (e.g. failed ones) are never included.
+    if nbest<=0: return []
+    (losses, tids, get_info) = open_results(inputfile)
+    losses = np.nan_to_num(losses, nan=np.inf)
+    # take more candidates until enough distinct configurations are found
+    # (including all ties with the last one, which may be duplicates)
+    ncandidates = nbest
+    while True:
+        ids = get_sorted_best(losses, nbest=ncandidates)
+        infos = {}
+        worst = np.inf
+        complete = False
+        for idx in ids:
+            # note: missing losses are sorted last, so all remaining ones are missing too
+            if losses[idx]==np.inf:
+                complete = True
+                break
+            if( len(infos)>=nbest and losses[idx]>worst ):
+                complete = True
+                break
+            info = get_info(idx)
+            key = get_config_key(info['config'])
+            if key not in infos:
+                if len(infos)>=nbest: continue
+                info['sources'] = []
+                infos[key] = info
+                worst = losses[idx]
+            infos[key]['sources'].append((inputfile, int(tids[idx])))
+        if( complete or len(ids)==len(losses) ): return list(infos.values())
+        ncandidates *= 2
+
+def merge_best_info(inputfiles, nbest=1):
+    ### return information of the lowest-loss distinct configurations over multiple files
+    # note: the files are read one at a time, and only the nbest best distinct
+    #       configurations are kept in between, so the memory usage does not grow
+    #       with the number of files.
+    # note: identical configurations (e.g. found by multiple jobs) are only kept once,
+    #       with the lowest loss; the file and trial id of each occurrence found among
+    #       the best iterations are stored under the 'sources' key.
+    def get_loss(info):
+        # missing losses are sorted last
+        if( info['loss'] is None or np.isnan(info['loss']) ): return np.inf
+        return info['loss']
+    best = {}
+    for inputfile in inputfiles:
+        for info in get_distinct_best(inputfile, nbest=nbest):
+            key = get_config_key(info['config'])
+            if key not in best: best[key] = info
+            elif get_loss(info) < get_loss(best[key]):
+                info['sources'] = best[key]['sources'] + info['sources']
+                best[key] = info
+            else: best[key]['sources'] += info['sources']
+        keep = sorted(best.keys(), key=lambda key: get_loss(best[key]))[:nbest]
+        best = {key: best[key] for key in keep}
+    return sorted(best.values(), key=get_loss)
 
  
 if __name__=='__main__':
@@ -42,24 +177,48 @@ if __name__=='__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--inputfile', required=True, nargs='+')
     parser.add_argument('-n', '--nbest', type=int, default=1)
+    parser.add_argument('-m', '--merge', default=False, action='store_true',
+      help='Get the best distinct configurations over all input files together,'
+          +' instead of for each input file separately')
     args = parser.parse_args()
+    if args.nbest<=0:
+        raise Exception('ERROR: option --nbest must be at least 1 (got {}).'.format(args.nbest))
 
     # print arguments
     print('Running with following configuration:')
     for arg in vars(args): print('  - {}: {}'.format(arg,getattr(args,arg)))
 
-    # run over input files
-    # (can be multiple, e.g. in the case of multiple parallel jobs as cross-check)
-    for inputfile in args.inputfile:
-        with open(inputfile,'rb') as f:
-            trials = pkl.load(f)
-        info = get_best_info(trials, nbest = args.nbest)
+    # get the best configurations
+    # (each input file can be either a pickled Trials object or a columnar results directory)
+    if args.merge:
+        # over all input files together
+        # (e.g. in the case of many parallel jobs with different seeds)
+        infos = [merge_best_info(args.inputfile, nbest = args.nbest)]
+    else:
+        # for each input file separately
+        # (can be multiple, e.g. in the case of multiple parallel jobs as cross-check)
+        infos = []
+        for inputfile in args.inputfile:
+            if is_results_dir(inputfile):
+                infos.append(get_best_info_columnar(inputfile, nbest = args.nbest))
+            else:
+                with open(inputfile,'rb') as f:
+                    trials = pkl.load(f)
+                infos.append(get_best_info(trials, nbest = args.nbest))
+
+    # print the results
+    for info in infos:
         for idx in range(len(info)):
             print('--- configuration {} ---'.format(idx))
             print('loss: {}'.format(info[idx]['loss']))
             for key,val in info[idx].items(): 
                 if key=='loss': continue   # already printed
                 if key=='config': continue # will be printed later
+                if key=='sources': continue # will be printed later
                 print('{}: {}'.format(key, val))
             print('config:')
             for name,val in info[idx]['config'].items(): print('  - {}: {}'.format(name,val))
+            if 'sources' in info[idx]:
+                print('found in {} trial(s):'.format(len(info[idx]['sources'])))
+                for (inputfile, tid) in info[idx]['sources']:
+                    print('  - {} (trial {})'.format(inputfile, tid))
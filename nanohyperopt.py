@@ -0,0 +1,139 @@
+###################################################
+# Single entry point for all nanohyperopt scripts #
+###################################################
+# Usage:
+# - python nanohyperopt.py <command> <arguments of the command>
+# with the following commands:
+# - make-grid: make a hyperopt search grid (see grids/make_grid.py)
+# - run: run hyperopt (see run_hyperopt.py)
+# - best: get the best configurations (see get_best.py)
+# - plot: plot the loss (see plot_loss.py)
+# - preprocess: split NanoAOD files into categories (see preprocess.py)
+# - benchmark: run the benchmarks on synthetic samples (see benchmarks/run_benchmarks.py)
+# - import-time: measure the startup time of each command
+# Only this (light-weight) file is loaded at startup;
+# the script of the requested command (and thus its imports) is only loaded when it runs,
+# so e.g. getting the best configurations does not import uproot or matplotlib
+# (nor hyperopt, when reading columnar results).
+
+
+# imports
+import os
+import sys
+import time
+import runpy
+import argparse
+import subprocess
+
+thisdir = os.path.abspath(os.path.dirname(__file__))
+
+# scripts to run for each command (relative to this directory)
+commands = {
+  'make-grid': ('grids/make_grid.py', 'Make a hyperopt search grid from a json file'),
+  'run': ('run_hyperopt.py', 'Run hyperopt'),
+  'best': ('get_best.py', 'Get the best configurations from a hyperopt output file'),
+  'plot': ('plot_loss.py', 'Plot the loss from a hyperopt output file'),
+  'preprocess': ('preprocess.py', 'Split NanoAOD files into categories of events'),
+  'benchmark': ('benchmarks/run_benchmarks.py', 'Run the benchmarks on synthetic samples'),
+}
+
+
+def run_command( command, arguments ):
+    ### run the script of a command with the given command line arguments
+    # note: the script is run as if it were called directly (i.e. as __main__),
+    #       so it parses the arguments itself.
+    script = os.path.join(thisdir, commands[command][0])
+    sys.argv = [script] + list(arguments)
+    sys.path.insert(0, os.path.dirname(script))
+    runpy.run_path(script, run_name='__main__')
+
+def get_import_times( stderr ):
+    ### parse the output of python -X importtime
+    # returns:
+    # a list of tuples of the form (module, cumulative time in seconds)
+    # for the top-level imports (i.e. not the ones imported by other modules)
+    times = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'): continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts)!=3: continue
+        name = parts[2].rstrip()
+        if name.strip()=='package' or name.startswith('  '): continue
+        try: times.append((name.strip(), float(parts[1])*1e-6))
+        except ValueError: continue
+    return times
+
+def measure_startup( command, repeat=3 ):
+    ### measure the time needed to start a command (i.e. load it and parse --help)
+    # returns:
+    # a tuple of the form (minimum wall time in seconds, list of top-level import times)
+    cmd = [sys.executable, '-X', 'importtime', os.path.abspath(__file__), command, '--help']
+    best = None
+    imports = []
+    for _ in range(repeat):
+        starttime = time.time()
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        elapsed = time.time() - starttime
+        if result.returncode!=0:
+            msg = 'ERROR: command {} failed with the following output:\n'.format(command)
+            msg += result.stderr[-2000:]
+            raise Exception(msg)
+        if( best is None or elapsed<best ):
+            best = elapsed
+            imports = get_import_times(result.stderr)
+    return (best, imports)
+
+def import_time( arguments ):
+    ### benchmark the startup time of all (or some) commands
+    parser = argparse.ArgumentParser(prog='nanohyperopt import-time',
+      description='Measure the startup time of the commands, i.e. the time to load them'
+                 +' and print their help message.')
+    parser.add_argument('-c', '--commands', default=list(commands.keys()), nargs='+',
+      choices=list(commands.keys()))
+    parser.add_argument('-r', '--repeat', default=3, type=int,
+      help='Number of repetitions (the fastest one is reported)')
+    parser.add_argument('-n', '--nimports', default=5, type=int,
+      help='Number of slowest top-level imports to show per command')
+    parser.add_argument('--maxtime', default=None, type=float,
+      help='Exit with an error if any command takes longer than this number of seconds'
+          +' to start (e.g. for catching startup regressions in automated checks)')
+    args = parser.parse_args(arguments)
+
+    # measure the baseline time of starting python
+    starttime = time.time()
+    subprocess.run([sys.executable, '-c', 'pass'])
+    baseline = time.time() - starttime
+    print('Python startup: {:.3f} s'.format(baseline))
+
+    # measure the startup time of each command
+    slow = []
+    for command in args.commands:
+        (elapsed, imports) = measure_startup(command, repeat=args.repeat)
+        print('{}: {:.3f} s'.format(command, elapsed))
+        for (name, seconds) in sorted(imports, key=lambda x: -x[1])[:args.nimports]:
+            print('  - {}: {:.3f} s'.format(name, seconds))
+        if( args.maxtime is not None and elapsed>args.maxtime ): slow.append(command)
+    if len(slow)>0:
+        msg = 'ERROR: the startup time of the following commands'
+        msg += ' exceeds {} s: {}'.format(args.maxtime, slow)
+        raise Exception(msg)
+
+
+if __name__=='__main__':
+
+    # read the command
+    # note: only the command itself is parsed here,
+    #       the remaining arguments are parsed by the script of the command.
+    parser = argparse.ArgumentParser(prog='nanohyperopt',
+      description='Cut optimization with hyperopt on NanoAOD files.'
+                 +' Use "nanohyperopt <command> --help" for the arguments of each command.')
+    parser.add_argument('command', choices=list(commands.keys())+['import-time'],
+      help='; '.join(['{}: {}'.format(key, val[1]) for key, val in commands.items()])
+          +'; import-time: measure the startup time of each command')
+    parser.add_argument('arguments', nargs=argparse.REMAINDER,
+      help='Arguments passed to the command')
+    args = parser.parse_args()
+
+    # run the command
+    if args.command=='import-time': import_time(args.arguments)
+    else: run_command(args.command, args.arguments)
@@ -8,9 +8,50 @@ import os
 import sys
 import argparse
 import pickle as pkl
+import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 
+# local imports
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tools'))
+from resultsfile import is_results_dir, load_column, load_losses, get_trial_losses
+
+
+def get_colorlist( ncolors ):
+    ### get a list of colors from the jet colormap
+    colormap = mpl.colormaps['jet'].resampled(max(1, ncolors))
+    return [mpl.colors.rgb2hex(colormap(i)) for i in range(ncolors)]
+
+def sort_by_last( losses, colorlist ):
+    ### sort the losses (and colors) such that the lowest last loss is plotted last
+    # re-index the losses to sort according to last loss value
+    lastloss = [l[-1] for l in losses]
+    sorted_inds = [i[0] for i in sorted(enumerate(lastloss), key=lambda x:x[1])]
+    losses = [losses[i] for i in sorted_inds]
+    # revert losses and colorlist to plot lowest loss last
+    return (losses[::-1], colorlist[::-1])
+
+def decimate( loss, nbins ):
+    ### reduce an array of loss values to its minimum and maximum in each of nbins bins
+    # returns:
+    # a tuple of the form (x, y), with two points (minimum and maximum) per bin,
+    # which gives visually the same line as the full array if nbins is at least
+    # the number of pixel columns of the plot.
+    loss = np.asarray(loss, dtype=np.float64)
+    if len(loss)<=2*nbins: return (np.arange(len(loss)), loss)
+    edges = np.linspace(0, len(loss), nbins+1).astype(int)
+    # note: fmin and fmax ignore nan values (unless all values in a bin are nan)
+    mins = np.fmin.reduceat(loss, edges[:-1])
+    maxs = np.fmax.reduceat(loss, edges[:-1])
+    centers = (edges[:-1] + edges[1:] - 1) / 2.
+    return (np.repeat(centers, 2), np.column_stack((mins, maxs)).ravel())
+
+def get_running_best( loss ):
+    ### get the lowest loss value up to each iteration
+    # note: missing (nan) losses are skipped, and the running best is nan
+    #       up to the first valid loss, so those iterations are not plotted.
+    return np.fmin.accumulate(np.asarray(loss, dtype=np.float64))
 
 def plotloss( losses, labellist=None,
                 colorlist=None, colorsort=False,
@@ -25,16 +66,8 @@ def plotloss( losses, labellist=None,
         labellist = ['dummy']*len(losses)
     if colorlist is None:
         # get a colormap with the right amount of colors
-        colormap = mpl.cm.get_cmap('jet', len(losses))
-        colorlist = [mpl.colors.rgb2hex(colormap(i)) for i in range(colormap.N)]
-        if colorsort:
-            # re-index the losses to sort according to last loss value
-            lastloss = [l[-1] for l in losses]
-            sorted_inds = [i[0] for i in sorted(enumerate(lastloss), key=lambda x:x[1])]
-            losses = [losses[i] for i in sorted_inds]
-            # revert losses and colorlist to plot lowest loss last
-            losses = losses[::-1]
-            colorlist = colorlist[::-1]
+        colorlist = get_colorlist(len(losses))
+        if colorsort: (losses, colorlist) = sort_by_last(losses, colorlist)
     for loss, label, color in zip(losses, labellist, colorlist):
         ax.plot(loss, color=color,
                 linewidth=2, label=label)
@@ -46,6 +79,70 @@ def plotloss( losses, labellist=None,
     if yaxtitle is not None: ax.set_ylabel(yaxtitle)
     return (fig,ax)
 
+def plotloss_fast( losses, colorlist=None, colorsort=False,
+                   title=None,
+                   xlims=None, xaxtitle='Iteration',
+                   yaxlog=False, yaxtitle='Loss value',
+                   nbins=None, linewidth=1 ):
+    ### same as plotloss, but faster for many and/or long arrays of loss values
+    # note: all lines are drawn as a single LineCollection,
+    #       and each line is first reduced to its minimum and maximum per bin
+    #       (default: one bin per pixel column of the figure).
+    # note: no legend is drawn, since this is meant for many lines.
+    fig,ax = plt.subplots()
+    if nbins is None: nbins = int(fig.get_figwidth()*fig.dpi)
+    if colorlist is None:
+        colorlist = get_colorlist(len(losses))
+        if colorsort: (losses, colorlist) = sort_by_last(losses, colorlist)
+    segments = [np.column_stack(decimate(loss, nbins)) for loss in losses]
+    ax.add_collection(LineCollection(segments, colors=colorlist, linewidths=linewidth))
+    ax.autoscale()
+    if yaxlog: ax.set_yscale('log')
+    if xlims is not None: ax.set_xlim(xlims)
+    if title is not None: ax.set_title(title)
+    if xaxtitle is not None: ax.set_xlabel(xaxtitle)
+    if yaxtitle is not None: ax.set_ylabel(yaxtitle)
+    return (fig,ax)
+
+def plotbands( losses, quantiles=[0.05, 0.25],
+               color='tab:blue',
+               title=None,
+               xlims=None, xaxtitle='Iteration',
+               yaxlog=False, yaxtitle='Loss value',
+               nbins=None ):
+    ### plot the median and quantile bands of multiple arrays of loss values
+    # input arguments:
+    # - losses: list of arrays of loss values (possibly of different lengths)
+    # - quantiles: lower quantiles of the bands to draw
+    #              (each band goes from q to 1-q, with lighter colors for wider bands)
+    # note: the quantiles are calculated per iteration over the arrays that have
+    #       at least that many iterations, and evaluated at (at most) nbins iterations
+    #       (default: one per pixel column of the figure).
+    fig,ax = plt.subplots()
+    if nbins is None: nbins = int(fig.get_figwidth()*fig.dpi)
+    niterations = max([len(loss) for loss in losses])
+    x = np.unique(np.linspace(0, niterations-1, min(nbins, niterations)).astype(int))
+    values = np.full((len(losses), len(x)), np.nan)
+    for idx, loss in enumerate(losses):
+        loss = np.asarray(loss, dtype=np.float64)
+        mask = (x < len(loss))
+        values[idx, mask] = loss[x[mask]]
+    # skip iterations without any valid loss (e.g. before the first one in a running best)
+    valid = np.any(~np.isnan(values), axis=0)
+    (x, values) = (x[valid], values[:, valid])
+    for q in sorted(quantiles):
+        (low, high) = np.nanquantile(values, [q, 1-q], axis=0)
+        ax.fill_between(x, low, high, color=color, alpha=0.25, linewidth=0,
+                        label='{:.0%}-{:.0%}'.format(q, 1-q))
+    ax.plot(x, np.nanmedian(values, axis=0), color=color, linewidth=2, label='median')
+    ax.legend()
+    if yaxlog: ax.set_yscale('log')
+    if xlims is not None: ax.set_xlim(xlims)
+    if title is not None: ax.set_title(title)
+    if xaxtitle is not None: ax.set_xlabel(xaxtitle)
+    if yaxtitle is not None: ax.set_ylabel(yaxtitle)
+    return (fig,ax)
+
 
 if __name__=='__main__':
 
@@ -54,6 +151,15 @@ if __name__=='__main__':
     parser.add_argument('-i', '--inputfile', required=True, nargs='+')
     parser.add_argument('-o', '--outputfile', required=True)
     parser.add_argument('-s', '--sort', default=False, action='store_true')
+    parser.add_argument('-f', '--fast', default=False, action='store_true',
+      help='Draw all lines at once, reduced to their minimum and maximum per pixel column'
+          +' (recommended for many input files and/or many iterations)')
+    parser.add_argument('-b', '--runningbest', default=False, action='store_true',
+      help='Plot the lowest loss up to each iteration instead of the loss of each iteration'
+          +' (only taking into account iterations evaluated on all events,'
+          +' in case of multi-fidelity runs)')
+    parser.add_argument('-q', '--bands', default=False, action='store_true',
+      help='Plot the median and quantile bands over the input files instead of each line')
     args = parser.parse_args()
 
     # print arguments
@@ -62,11 +168,26 @@ if __name__=='__main__':
     
     # load the losses
     losses = []
+    # (each input can be either a pickled Trials object or a columnar results directory,
+    #  in which case only the loss column is read)
+    # (for the running best, iterations evaluated on a subsample of the events only
+    #  are skipped, since their loss is not comparable, see tools/multifidelity.py)
     for inputfile in args.inputfile:
-        with open(inputfile,'rb') as f:
-            trials = pkl.load(f)
-        loss = trials.losses()
-        if args.sort: loss.sort(reverse=True)
+        if is_results_dir(inputfile):
+            if args.runningbest: loss = load_losses(inputfile, mmap=False)
+            else: loss = load_column(inputfile, 'loss', mmap=False)
+        else:
+            with open(inputfile,'rb') as f:
+                trials = pkl.load(f)
+            if args.runningbest: loss = get_trial_losses(trials)
+            else: loss = trials.losses()
+        if( args.fast or args.bands or args.runningbest ):
+            loss = np.array([np.nan if l is None else l for l in loss], dtype=np.float64)
+            if args.runningbest: loss = get_running_best(loss)
+            if args.sort: loss = np.sort(loss)[::-1]
+        else:
+            loss = list(loss)
+            if args.sort: loss.sort(reverse=True)
         losses.append( loss )
 
     # hard coded arguments
@@ -74,10 +195,23 @@ if __name__=='__main__':
     extratext += 'Results for cut optimization\n'
     extratext += 'using hyperopt'
     if args.sort: extratext += '\n(sorted)'
+    if args.runningbest: extratext += '\n(lowest loss so far)'
     extratext_coords = (0.05, 0.25)
 
     # make the figure
-    (fig,ax) = plotloss( losses, 
+    if args.bands:
+        (fig,ax) = plotbands( losses,
+                title=None,
+                xlims=None, xaxtitle='Iteration',
+                yaxlog=False, yaxtitle='Loss value' )
+    elif args.fast:
+        (fig,ax) = plotloss_fast( losses,
+                colorsort=True,
+                title=None,
+                xlims=None, xaxtitle='Iteration',
+                yaxlog=False, yaxtitle='Loss value' )
+    else:
+        (fig,ax) = plotloss( losses, 
                 colorsort=True,
                 title=None,
                 xlims=None, xaxtitle='Iteration',
@@ -1,12 +1,352 @@
-import ROOT
-import argparse
+#######################################################################
+# Split NanoAOD files into categories of signal and background events #
+#######################################################################
+# The events are read in chunks with uproot, the category of each event is
+# determined with columnar (awkward) operations, and the events of each category
+# are written to a separate output file.
+# The categories are defined in a json config file (see preprocess_config.json),
+# as a list of dicts with the following keys:
+# - category: name of the category (used as suffix for the output file)
+# - branch: name of a (jagged) boolean branch, e.g. DsMeson_hasFastGenmatch
+# - anymatch: if true, select the events where any of the values in the branch is true;
+#             if false, select the events where none of them is true.
+# Each input file is processed as an independent task (optionally in a pool of processes),
+# writing its split outputs to <outputdir>/<input file name>/<input file name>_<category>.root.
+# Inputs for which all outputs are already up to date are skipped,
+# and the outputs of all input files can optionally be merged per category.
+# The settings used to write each output file (category definitions, branches, compression)
+# are stored in a stamp file next to it (<output file name>_stamp.json),
+# so that outputs written with other settings are not considered up to date.
+
+
 import os
 import sys
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+import awkward as ak
+import uproot
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 thisdir = os.path.abspath(os.path.dirname(__file__))
 topdir = os.path.abspath(os.path.join(thisdir, '../'))
 sys.path.append(topdir)
 
+
+def load_config( configfile ):
+    ### load the category definitions from a json config file
+    with open(configfile, 'r') as f: config = json.load(f)
+    for category in config:
+        for key in ['category', 'branch', 'anymatch']:
+            if key not in category:
+                msg = 'ERROR: key {} missing in category definition {}'.format(key, category)
+                msg += ' in config file {}.'.format(configfile)
+                raise Exception(msg)
+    return config
+
+def get_compression( compression ):
+    ### get an uproot compression object from a string like ZLIB:4 or LZ4:1
+    # note: None gives the default compression of uproot,
+    #       while 'none' gives no compression at all.
+    if compression is None: return uproot.ZLIB(1)
+    if compression.lower()=='none': return None
+    (algorithm, _, level) = compression.partition(':')
+    algorithms = {'ZLIB': uproot.ZLIB, 'LZMA': uproot.LZMA, 'LZ4': uproot.LZ4, 'ZSTD': uproot.ZSTD}
+    if algorithm.upper() not in algorithms:
+        msg = 'ERROR: compression algorithm {} not recognized;'.format(algorithm)
+        msg += ' choose from {}.'.format(list(algorithms.keys()))
+        raise Exception(msg)
+    return algorithms[algorithm.upper()](int(level) if level else 1)
+
+def get_compression_name( compression ):
+    ### get a unique name for a compression string (see get_compression), e.g. ZLIB:1
+    # note: equivalent strings (e.g. None and ZLIB:1, or zlib and ZLIB:1) give the same name.
+    compression = get_compression(compression)
+    if compression is None: return 'none'
+    return '{}:{}'.format(type(compression).__name__, compression.level)
+
+def get_config_hash( config ):
+    ### get a hash of the category definitions
+    # note: the hash only depends on the content of the definitions,
+    #       not on the formatting of the config file they were loaded from.
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+def get_branch_groups( tree, branches ):
+    ### group jagged branches with the same counter branch (e.g. nDsMeson) into collections
+    # returns:
+    # a tuple of the form (collections, flat), where collections is a dict mapping
+    # collection names (e.g. DsMeson) to lists of branch names (e.g. DsMeson_pt),
+    # and flat is a list of the other branches.
+    # note: counter branches themselves are not included,
+    #       since they are written automatically for each collection.
+    # note: a jagged branch that does not follow the naming convention <collection>_<field>
+    #       is treated as a collection on its own.
+    collections = {}
+    counters = set()
+    flat = []
+    for branch in branches:
+        countbranch = tree[branch].count_branch
+        if countbranch is None:
+            flat.append(branch)
+            continue
+        countname = countbranch.name
+        counters.add(countname)
+        collection = countname[1:] if countname.startswith('n') else countname
+        if not branch.startswith(collection+'_'): collection = branch
+        collections.setdefault(collection, []).append(branch)
+    flat = [branch for branch in flat if branch not in counters]
+    return (collections, flat)
+
+def get_output_arrays( events, collections, flat ):
+    ### arrange the arrays for writing with uproot, such that the branch names are preserved
+    arrays = {}
+    for collection, branches in collections.items():
+        if len(branches)==1 and branches[0]==collection:
+            arrays[collection] = events[collection]
+            continue
+        fields = {branch[len(collection)+1:]: events[branch] for branch in branches}
+        arrays[collection] = ak.zip(fields)
+    for branch in flat: arrays[branch] = events[branch]
+    return arrays
+
+def get_category_masks( events, config ):
+    ### get a boolean mask of the selected events for each category
+    masks = {}
+    for category in config:
+        anymatch = ak.to_numpy(ak.any(events[category['branch']], axis=-1))
+        if category['anymatch']: masks[category['category']] = anymatch
+        else: masks[category['category']] = ~anymatch
+    return masks
+
+def extend_tree( outfile, treename, arrays ):
+    ### write a chunk of arrays to a tree in an output file, creating the tree if needed
+    if treename not in outfile:
+        outfile.mktree(treename, {key: array.type for key, array in arrays.items()},
+          field_name=lambda outer, inner: f"{outer}_{inner}",
+          counter_name=lambda counted: f"n{counted}")
+    outfile[treename].extend(arrays)
+
+def get_tmpfile( outputfile ):
+    ### get a temporary file name to write an output file to before moving it in place
+    # note: this ensures that an interrupted task never leaves an incomplete output file
+    #       that would be considered up to date afterwards.
+    return outputfile + '.tmp{}'.format(os.getpid())
+
+def read_branches( inputfile, treename, branches=None, required=None ):
+    ### get the branches to read from the first input file
+    # returns:
+    # a tuple of the form (collections, flat, readbranches),
+    # where collections and flat are as returned by get_branch_groups.
+    if required is None: required = []
+    with uproot.open(f"{inputfile}:{treename}") as tree:
+        allbranches = [branch for branch in tree.keys() if '/' not in branch]
+        if branches is None: writebranches = allbranches
+        else: writebranches = list(tree.keys(filter_name=branches))
+        missing = [branch for branch in required if branch not in allbranches]
+        if len(missing)>0:
+            msg = 'ERROR: the following branches are needed for the split'
+            msg += ' but not found in file {}: {}'.format(inputfile, missing)
+            raise Exception(msg)
+        (collections, flat) = get_branch_groups(tree, writebranches)
+    readbranches = list(dict.fromkeys(writebranches + required))
+    return (collections, flat, readbranches)
+
+def split_files(
+    inputfiles,
+    treename,
+    outputfiles,
+    config,
+    branches=None,
+    compression=None,
+    stepsize='100 MB'):
+    ### split a set of input files into categories
+    # input arguments:
+    # - inputfiles: list of input files (the events of all files are processed together)
+    # - treename: name of the tree to read (and write)
+    # - outputfiles: dict mapping category names to output files
+    # - config: list of category definitions, as obtained from load_config
+    # - branches: list of branch names or patterns to write (default: all branches)
+    # - compression: see get_compression
+    # - stepsize: number of entries or size in memory to process at once
+    # returns:
+    # a dict mapping category names to the number of selected events
+    splitbranches = [category['branch'] for category in config]
+    (collections, flat, readbranches) = read_branches(inputfiles[0], treename,
+                                          branches=branches, required=splitbranches)
+    compression = get_compression(compression)
+
+    # open the output files
+    tmpfiles = {name: get_tmpfile(outputfile) for name, outputfile in outputfiles.items()}
+    outfiles = {name: uproot.recreate(tmpfile, compression=compression)
+                for name, tmpfile in tmpfiles.items()}
+    counts = {name: 0 for name in outputfiles.keys()}
+    try:
+        for events in uproot.iterate([f"{inputfile}:{treename}" for inputfile in inputfiles],
+                                     filter_name=readbranches, step_size=stepsize, library='ak'):
+            masks = get_category_masks(events, config)
+            arrays = get_output_arrays(events, collections, flat)
+            for name, outfile in outfiles.items():
+                mask = masks[name]
+                extend_tree(outfile, treename, {key: array[mask] for key, array in arrays.items()})
+                counts[name] += int(np.count_nonzero(mask))
+    except:
+        for outfile in outfiles.values(): outfile.close()
+        for tmpfile in tmpfiles.values():
+            if os.path.exists(tmpfile): os.remove(tmpfile)
+        raise
+    for name, outfile in outfiles.items():
+        outfile.close()
+        os.replace(tmpfiles[name], outputfiles[name])
+    return counts
+
+def merge_files(
+    inputfiles,
+    treename,
+    outputfile,
+    compression=None,
+    stepsize='100 MB'):
+    ### merge the trees in a set of files into a single output file
+    # returns:
+    # the number of events in the output file
+    (collections, flat, readbranches) = read_branches(inputfiles[0], treename)
+    compression = get_compression(compression)
+    tmpfile = get_tmpfile(outputfile)
+    count = 0
+    try:
+        with uproot.recreate(tmpfile, compression=compression) as outfile:
+            for events in uproot.iterate([f"{inputfile}:{treename}" for inputfile in inputfiles],
+                                         filter_name=readbranches, step_size=stepsize, library='ak'):
+                extend_tree(outfile, treename, get_output_arrays(events, collections, flat))
+                count += len(events)
+    except:
+        if os.path.exists(tmpfile): os.remove(tmpfile)
+        raise
+    os.replace(tmpfile, outputfile)
+    return count
+
+def get_outputfiles( inputfile, outputdir, config ):
+    ### get the output files for a given input file
+    # returns:
+    # a dict mapping category names to output files in <outputdir>/<input file name>/
+    basename = os.path.basename(inputfile).replace('.root', '')
+    return {category['category']: os.path.join(outputdir, basename,
+              f"{basename}_{category['category']}.root") for category in config}
+
+def get_stampfile( outputfile ):
+    ### get the stamp file storing the settings used to write an output file
+    return os.path.splitext(outputfile)[0] + '_stamp.json'
+
+def write_stamps( outputfiles, settings ):
+    ### write the settings used to write a set of output files to their stamp files
+    # note: the stamps are written after the output files are in place,
+    #       so an interrupted task never leaves a stamp for an incomplete output file.
+    for outputfile in outputfiles:
+        stampfile = get_stampfile(outputfile)
+        tmpfile = get_tmpfile(stampfile)
+        with open(tmpfile, 'w') as f: json.dump(settings, f, indent=2, sort_keys=True)
+        os.replace(tmpfile, stampfile)
+
+def read_stamp( outputfile ):
+    ### read the settings used to write an output file (None if there is no valid stamp)
+    stampfile = get_stampfile(outputfile)
+    if not os.path.exists(stampfile): return None
+    try:
+        with open(stampfile, 'r') as f: return json.load(f)
+    except ValueError: return None
+
+def is_up_to_date( inputfiles, outputfiles, settings=None ):
+    ### check whether all output files exist and are newer than all input files
+    # input arguments:
+    # - inputfiles: list of input files
+    # - outputfiles: list of output files
+    # - settings: json-serializable dict with the settings used to write the output files
+    #             (e.g. the branches and the compression); if specified, the outputs are only
+    #             up to date if their stamp files (see write_stamps) contain the same settings.
+    if not all([os.path.exists(outputfile) for outputfile in outputfiles]): return False
+    if settings is not None:
+        # compare in json form, e.g. with lists instead of tuples
+        settings = json.loads(json.dumps(settings))
+        if not all([read_stamp(outputfile)==settings for outputfile in outputfiles]): return False
+    intime = max([os.path.getmtime(inputfile) for inputfile in inputfiles])
+    outtime = min([os.path.getmtime(outputfile) for outputfile in outputfiles])
+    return (outtime >= intime)
+
+def get_counts( outputfiles, treename ):
+    ### get the number of events in a set of existing output files
+    # returns:
+    # a dict mapping category names to the number of events
+    counts = {}
+    for name, outputfile in outputfiles.items():
+        with uproot.open(outputfile) as f:
+            counts[name] = f[treename].num_entries if treename in f else 0
+    return counts
+
+def process_file(
+    inputfile,
+    treename,
+    outputfiles,
+    config,
+    force=False,
+    branches=None,
+    compression=None,
+    **kwargs):
+    ### split a single input file into categories, unless the outputs are up to date
+    # input arguments:
+    # - inputfile: input file
+    # - treename, outputfiles, config, branches, compression: see split_files
+    # - force: split the input file also if the outputs are up to date
+    # - kwargs: passed down to split_files
+    # returns:
+    # a tuple of the form (counts, skipped, elapsed time)
+    # note: the outputs are only up to date if they were written
+    #       with the same tree, category definitions, branches and compression.
+    starttime = time.time()
+    settings = {'treename': treename, 'config': get_config_hash(config),
+                'branches': branches, 'compression': get_compression_name(compression)}
+    if( not force and is_up_to_date([inputfile], outputfiles.values(), settings=settings) ):
+        return (get_counts(outputfiles, treename), True, time.time()-starttime)
+    for outputfile in outputfiles.values():
+        outdir = os.path.dirname(outputfile)
+        if not os.path.exists(outdir): os.makedirs(outdir, exist_ok=True)
+    counts = split_files([inputfile], treename, outputfiles, config,
+               branches=branches, compression=compression, **kwargs)
+    write_stamps(outputfiles.values(), settings)
+    return (counts, False, time.time()-starttime)
+
+def process_merge( inputfiles, treename, outputfile, force=False, compression=None, **kwargs ):
+    ### merge a set of files, unless the output is up to date
+    # returns:
+    # a tuple of the form (count, skipped, elapsed time)
+    # note: the output is only up to date if it was written from the same input files
+    #       (in the same order) and with the same tree and compression.
+    starttime = time.time()
+    settings = {'treename': treename, 'inputfiles': [os.path.abspath(f) for f in inputfiles],
+                'compression': get_compression_name(compression)}
+    if( not force and is_up_to_date(inputfiles, [outputfile], settings=settings) ):
+        return (get_counts({'merged': outputfile}, treename)['merged'], True, time.time()-starttime)
+    count = merge_files(inputfiles, treename, outputfile, compression=compression, **kwargs)
+    write_stamps([outputfile], settings)
+    return (count, False, time.time()-starttime)
+
+def run_tasks( func, tasks, nworkers=1 ):
+    ### run a set of tasks, either sequentially or in a pool of processes
+    # input arguments:
+    # - func: function to call for each task
+    # - tasks: dict mapping task names to tuples of the form (args, kwargs)
+    # - nworkers: number of processes (1 means running in the current process)
+    # returns:
+    # a generator of tuples of the form (task name, result), in order of completion
+    if nworkers<=1:
+        for name, (args, kwargs) in tasks.items(): yield (name, func(*args, **kwargs))
+        return
+    with ProcessPoolExecutor(max_workers=nworkers) as executor:
+        futures = {executor.submit(func, *args, **kwargs): name
+                   for name, (args, kwargs) in tasks.items()}
+        for future in as_completed(futures): yield (futures[future], future.result())
+
+
 if __name__=='__main__':
 
     # read arguments
@@ -14,108 +354,84 @@ if __name__=='__main__':
     parser.add_argument('-i', '--inputfiles', required=True, nargs='+', help="Input ROOT files")
     parser.add_argument('-t', '--inputtree', required=True)
     parser.add_argument('-o', '--outputdir', required=True, type=os.path.abspath)
+    parser.add_argument('-c', '--config', default=os.path.join(thisdir, 'preprocess_config.json'),
+      help='Json file with the category definitions (default: preprocess_config.json)')
+    parser.add_argument('--branches', default=None, nargs='+',
+      help='Branch names or patterns (e.g. "DsMeson_*") to write (default: all branches)')
+    parser.add_argument('--compression', default=None,
+      help='Compression of the output files, e.g. ZLIB:1, LZMA:9, LZ4:4, ZSTD:5 or none'
+          +' (default: ZLIB:1)')
+    parser.add_argument('--stepsize', default='100 MB',
+      help='Number of entries or size in memory (e.g. "100 MB") to process at once')
+    parser.add_argument('-n', '--nworkers', default=1, type=int,
+      help='Number of input files to process in parallel, each in a separate process'
+          +' (default: 1)')
+    parser.add_argument('-f', '--force', default=False, action='store_true',
+      help='Process all input files, also if their outputs are up to date')
+    parser.add_argument('-m', '--merge', default=False, action='store_true',
+      help='Merge the outputs of all input files into one file per category'
+          +' (written to the output directory as <category>.root)')
     args = parser.parse_args()
 
-    #input_file = ROOT.TFile.Open(args.inputfiles)
-    input_files = args.inputfiles  # no reading, no open()
-    # Open the input ROOT file
-    input_tree = ROOT.TChain(args.inputtree)
-    for infile in args.inputfiles:
-        input_tree.Add(infile)
+    # load the category definitions
+    config = load_config(args.config)
+    categories = [category['category'] for category in config]
+    stepsize = args.stepsize
+    if stepsize.isdigit(): stepsize = int(stepsize)
+    options = {'branches': args.branches, 'compression': args.compression, 'stepsize': stepsize}
 
-    # Create an output file and clone the tree structure
-    basename = os.path.basename(args.inputfiles[0]).replace('.root', '')
-    output_file = ROOT.TFile(f"{basename}_DsSig.root", "RECREATE")
-    output_tree = input_tree.CloneTree(0)  # Empty tree with same structure
-
-    #output_file2 = ROOT.TFile("DsBkg.root", "RECREATE")
-    output_file2 = ROOT.TFile(f"{basename}_DsBkg.root", "RECREATE")
-    output_tree2 = input_tree.CloneTree(0)  # Empty tree with same structure
+    # check for input files with the same name, as they would have the same output directory
+    inputfiles = args.inputfiles
+    basenames = [os.path.basename(infile) for infile in inputfiles]
+    duplicates = sorted(set([name for name in basenames if basenames.count(name)>1]))
+    if len(duplicates)>0:
+        msg = 'ERROR: the following input file names occur more than once: {}'.format(duplicates)
+        raise Exception(msg)
 
-    #output_file3 = ROOT.TFile("DstarSig.root", "RECREATE")
-    output_file3 = ROOT.TFile(f"{basename}_DstarSig.root", "RECREATE")
-    output_tree3 = input_tree.CloneTree(0)  # Empty tree with same structure
+    # set output files
+    outputfiles = {infile: get_outputfiles(infile, args.outputdir, config) for infile in inputfiles}
 
-    #output_file4 = ROOT.TFile("DstarBkg.root", "RECREATE")
-    output_file4 = ROOT.TFile(f"{basename}_DstarBkg.root", "RECREATE")
-    output_tree4 = input_tree.CloneTree(0)  # Empty tree with same structure
+    # split the input files
+    starttime = time.time()
+    tasks = {infile: ((infile, args.inputtree, outputfiles[infile], config),
+                      dict(force=args.force, **options))
+             for infile in inputfiles}
+    counts = {}
+    nskipped = 0
+    for idx, (infile, (filecounts, skipped, elapsed)) in enumerate(
+      run_tasks(process_file, tasks, nworkers=args.nworkers)):
+        counts[infile] = filecounts
+        if skipped: nskipped += 1
+        msg = '[{}/{}] {}: '.format(idx+1, len(inputfiles), infile)
+        if skipped: msg += 'outputs up to date, skipped'
+        else: msg += 'split in {:.1f} s'.format(elapsed)
+        print(msg)
+    msg = 'Processed {} input files ({} skipped)'.format(len(inputfiles), nskipped)
+    msg += ' in {:.1f} s'.format(time.time()-starttime)
+    print(msg)
 
-    # Loop over events
-    n_entries = input_tree.GetEntries()
+    # merge the outputs per category
+    mergedfiles = {}
+    if args.merge:
+        mergedfiles = {name: os.path.join(args.outputdir, f"{name}.root") for name in categories}
+        tasks = {name: (([outputfiles[infile][name] for infile in inputfiles],
+                         args.inputtree, mergedfiles[name]),
+                        dict(force=args.force, compression=args.compression, stepsize=stepsize))
+                 for name in categories}
+        for name, (count, skipped, elapsed) in run_tasks(process_merge, tasks,
+                                                        nworkers=args.nworkers):
+            msg = 'Merged {} events for category {} into {}'.format(count, name, mergedfiles[name])
+            if skipped: msg += ' (up to date, skipped)'
+            else: msg += ' in {:.1f} s'.format(elapsed)
+            print(msg)
 
-    # set output directories
-    inputfiles = args.inputfiles
-    outputdirs = {}
-    for infile in inputfiles:
-        basename = os.path.basename(infile).replace('.root', '')
-        outputdirs[infile] = os.path.join(args.outputdir, basename)
-
-    for i in range(n_entries):
-
-            if i % 10000 == 0:
-                print(f'Processing event {i}/{n_entries}')
-
-            input_tree.GetEntry(i)
-
-        # nDsMeson = getattr(input_tree, "DsMeson_pt")  # Get number of DsMesons
-        # Check if any DsMeson is matched
-            has_match = False
-            for j in range(len(input_tree.DsMeson_pt)):  # Loop over DsMeson candidates
-                if getattr(input_tree, "DsMeson_hasFastGenmatch")[j]:  # Proper indexing
-                    has_match = True
-                    break
-            if has_match:
-                output_tree.Fill()  # Store the event
-            else:
-                output_tree2.Fill()  # Store the event
-
-            has_DstarMatch = False
-            for j in range(len(input_tree.DStarMeson_pt)):  # Loop over DsMeson candidates
-                if getattr(input_tree, "DStarMeson_hasFastGenmatch")[j]:  # Proper indexing
-                    has_DstarMatch = True
-                    break
-            if has_DstarMatch:
-                output_tree3.Fill()  # Store the event
-            else:
-                output_tree4.Fill()  # Store the event
-        
-    '''
-    candidates = []
-    for event in input_tree:
-        candidates.append(event.DsMeson_mass)
-        has_match = False
-        for j in candidates:
-            if input_tree.DsMeson_hasFastGenmatch[j]:  # If any candidate matches
-                has_match = True
-                break
-        if has_match:
-            output_tree.Fill()  # Store the event
-    '''
-    
-    # make output directories
-    for outdir in outputdirs.values():
-        if not os.path.exists(outdir):
-            os.makedirs(outdir)
-
-
-    # Write trees to their respective files
-    output_file.cd()
-    output_tree.Write()
-
-    output_file2.cd()
-    output_tree2.Write()
-
-    output_file3.cd()
-    output_tree3.Write()
-
-    output_file4.cd()
-    output_tree4.Write()
-
-    # Close the files
-    output_file.Close()
-    output_file2.Close()
-    output_file3.Close()
-    output_file4.Close()
-   # input_file.Close()
-
-    
+    # print a summary of the number of events per category
+    width = max([len(name) for name in categories] + [8])
+    print('Summary of the number of events per category:')
+    for name in categories:
+        total = sum([counts[infile][name] for infile in inputfiles])
+        msg = '  {}: {:>10} events in {} files'.format(name.ljust(width), total, len(inputfiles))
+        if name in mergedfiles: msg += ' (merged: {})'.format(mergedfiles[name])
+        print(msg)
+    total = sum([sum(filecounts.values()) for filecounts in counts.values()])
+    print('  {}: {:>10} events'.format('total'.ljust(width), total))
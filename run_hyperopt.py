@@ -1,120 +1,106 @@
-import ROOT
 # imports
 import sys
 import os
+import time
 import argparse
+import hashlib
 import numpy as np
-import awkward as ak
 import pickle as pkl
-from coffea.nanoevents import NanoEventsFactory, NanoAODSchema
-from hyperopt import hp, fmin, tpe, STATUS_OK, Trials
+from hyperopt import fmin, tpe, STATUS_OK, Trials
+from hyperopt.fmin import generate_trials_to_calculate
 from functools import partial
-import uproot
 
 # local imports
-sys.path.append('tools')
-from make_input_file import make_input_file
+# note: the tools that depend on uproot or awkward (reading the input files and the engines),
+#       and the ones for parallel, multi-fidelity and shared runs,
+#       are only imported where they are used, so that importing this file
+#       (e.g. for calculate_loss_batch) or printing the help message stays fast.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tools'))
+from losstools import get_losses
+from resultcache import ResultCache, get_input_key
+from earlystop import EarlyStopper
+from checkpoint import Checkpointer, load_trials
+from resultsfile import write_results
+from profiling import TrialProfiler
 
 #####################################
 # Run hyperopt for cut optimization #
 #####################################
 
-def make_input_file(
-    sigfiles=[],
-    bkgfiles=[],
-    nentriesperfile=-1,
-    sigvar='isSignal',
-):
-    issignal = [True] * len(sigfiles) + [False] * len(bkgfiles)
-    allevents = []
-
-    for idx, inputfile in enumerate(sigfiles + bkgfiles):
-        tree = uproot.open(f"{inputfile}:Events")
-        
-        # Load all branches, optionally limit number of entries
-        events = tree.arrays(entry_stop=nentriesperfile if nentriesperfile >= 0 else None, library="ak")
-
-        # Add signal label to each event
-        events = ak.with_field(events, issignal[idx], where=sigvar)
-
-        allevents.append(events)
-
-    # Concatenate all signal and background events
-    events = ak.concatenate(allevents)
-
-    return events
-
-def pass_selection( events, cuts ):
-    ### get a mask for a particular configuration of cuts
-    # input arguments:
-    # - events: NanoAOD events array
-    # - cuts: dictionary mapping a variable name to a cut value
-    #         note: each key in the dict is supposed to be formatted
-    #               as <variable name>_<type>, where <type> is either min or max,
-    #               and <variable name> can contain underscores for sub-variables,
-    #               e.g. MET_pt for MET.pt
-    mask = np.ones(len(events)).astype(bool)
-    for cutname, cutvalue in cuts.items():
-        # parse cut name
-        ismax = cutname.endswith('_max')
-        ismin = cutname.endswith('_min')
-        if( not (ismax or ismin) ): 
-            raise Exception('ERROR: cut {} is neither min nor max.'.format(cutname))
-        varname = cutname[:-4]
-        # parse variable name
-       # varnameparts = varname.split('_')
-        # get the variable value
-        varvalue = events[varname]
-        
-       # for varnamepart in varnameparts[1:]: varvalue = getattr(varvalue, varnamepart)
-        # if the varvalue is an array instead of a single value per event,
-        # take minimum or maximum depending on the cut type
-        if(varvalue.layout.minmax_depth[0]==1): pass
-        elif(varvalue.layout.minmax_depth[0]==2): 
-            if ismin: varvalue = ak.min(varvalue, axis=-1)
-            if ismax: varvalue = ak.max(varvalue, axis=-1)
-        else:
-            msg = 'ERROR: shape of value array for variable {} not recognized.'.format(varname)
-            raise Exception(msg)
-        # perform the cut
-        if ismax: mask = ((mask) & (varvalue < cutvalue))
-        if ismin: mask = ((mask) & (varvalue > cutvalue))
-    return mask
-
-
-def calculate_loss( events, cuts,
+def calculate_loss( columns, cuts,
                     sig_mask=None,
                     lossfunction='s/b',
-                    iteration=None):
+                    iteration=None,
+                    engine=None,
+                    resultcache=None,
+                    weights=None,
+                    timing=False,
+                    scale=None):
     ### calculate the loss function for a given configuration of cuts
+    # note: if an engine (e.g. a SortedIndexEngine) is provided,
+    #       it is used to count the passing events instead of building a mask.
+    #       without an engine, the totals are recomputed in each call,
+    #       so for many calls on the same events a MaskEngine should be used instead.
+    # note: if weights are provided (one per event, see make_input_file.get_event_weights),
+    #       the loss is calculated from the weighted signal and background yields;
+    #       the engine must then be made with the same weights.
+    # note: if a result cache (see tools/resultcache.py) is provided,
+    #       configurations that were evaluated before are not recalculated.
+    # note: if timing is True, the time spent in each step is added to the result
+    #       as a dict under the key 'timing' (see tools/profiling.py).
+    # note: if scale is provided, it should be a tuple of the form (signal scale, background scale),
+    #       by which the passing (weighted) yields are multiplied before calculating the loss,
+    #       e.g. to estimate the yields in the full sample from a subsample
+    #       (see tools/multifidelity.py); the extra info contains the unscaled yields.
 
     # print progress
     #print('Now processing iteration {}'.format(iteration[0]))
     iteration[0] += 1
 
-    # do event selection
-    sel_mask = pass_selection(events, cuts)
+    # check if this configuration was evaluated before
+    if resultcache is not None:
+        result = resultcache.get(cuts, lossfunction)
+        if result is not None: return result
+        starttime = time.time()
+    times = [('start', time.perf_counter())]
+    # note: engines that build event masks (e.g. MaskEngine) measure the time spent on it
+    #       themselves, which is then reported as the select step instead of the count step.
+    engineselect = ( timing and hasattr(engine, 'selecttime') )
+    if engineselect: engine.timing = True
 
-    # calculate number of passing events
-    # todo: use sum of relevant weights instead of sum of entries
-    nsig_tot = np.sum(sig_mask)
-    nsig_pass = np.sum((sig_mask) & (sel_mask))
-    nbkg_tot = np.sum(~sig_mask)
-    nbkg_pass = np.sum((~sig_mask) & (sel_mask))
+    # calculate number of passing events (and their weighted yields)
+    if( engine is not None and weights is not None ):
+        nsig_tot = engine.nsig_tot
+        nbkg_tot = engine.nbkg_tot
+        (nsig_pass, nbkg_pass, wsig_pass, wbkg_pass) = engine.count_weighted(cuts)
+        wsig_tot = engine.wsig_tot
+        wbkg_tot = engine.wbkg_tot
+    elif engine is not None:
+        nsig_tot = engine.nsig_tot
+        nbkg_tot = engine.nbkg_tot
+        (nsig_pass, nbkg_pass) = engine.count(cuts)
+    else:
+        # do event selection
+        from cuttools import pass_selection
+        sel_mask = pass_selection(columns, cuts)
+        if timing: times.append(('select', time.perf_counter()))
+        nsig_tot = np.sum(sig_mask)
+        nsig_pass = np.sum((sig_mask) & (sel_mask))
+        nbkg_tot = np.sum(~sig_mask)
+        nbkg_pass = np.sum((~sig_mask) & (sel_mask))
+        if weights is not None:
+            wsig_tot = float(np.sum(weights[sig_mask], dtype=np.float64))
+            wsig_pass = float(np.sum(weights[(sig_mask) & (sel_mask)], dtype=np.float64))
+            wbkg_tot = float(np.sum(weights[~sig_mask], dtype=np.float64))
+            wbkg_pass = float(np.sum(weights[(~sig_mask) & (sel_mask)], dtype=np.float64))
+    if timing: times.append(('count', time.perf_counter()))
 
     # calculate loss
-    if lossfunction=='s/b':
-        if nbkg_pass == 0: loss = 0.
-        else: loss = -nsig_pass / nbkg_pass
-    elif lossfunction=='s/sqrt(b)':
-        if nbkg_pass == 0: loss = 0
-        else: loss = -nsig_pass / np.sqrt(nbkg_pass)
-    elif lossfunction=='s/sqrt(s+b)':
-        if( nsig_pass==0 and nbkg_pass==0 ): loss = 0
-        else: loss = -nsig_pass / np.sqrt(nsig_pass + nbkg_pass)
-    else:
-        msg = 'ERROR: loss function {} not recognized.'.format(lossfunction)
-        raise Exception(msg)
+    (sig_pass, bkg_pass) = (nsig_pass, nbkg_pass)
+    if weights is not None: (sig_pass, bkg_pass) = (wsig_pass, wbkg_pass)
+    if scale is not None: (sig_pass, bkg_pass) = (sig_pass*scale[0], bkg_pass*scale[1])
+    loss = float(get_losses(sig_pass, bkg_pass, lossfunction=lossfunction))
+    if timing: times.append(('loss', time.perf_counter()))
 
     # extend with other loss function definitions
     extra_info = {'nsig_tot': nsig_tot,
@@ -122,7 +108,164 @@ def calculate_loss( events, cuts,
                   'nbkg_tot': nbkg_tot,
                   'nbkg_pass': nbkg_pass,
                   'lossfunction': lossfunction}
-    return {'loss':loss, 'status':STATUS_OK, 'extra_info': extra_info}
+    if weights is not None:
+        extra_info.update({'wsig_tot': wsig_tot,
+                           'wsig_pass': wsig_pass,
+                           'wbkg_tot': wbkg_tot,
+                           'wbkg_pass': wbkg_pass})
+    result = {'loss':loss, 'status':STATUS_OK, 'extra_info': extra_info}
+    if resultcache is not None:
+        resultcache.put(cuts, lossfunction, result, evaltime=time.time()-starttime)
+    if timing:
+        result['timing'] = {step: times[idx+1][1]-times[idx][1]
+                            for idx, (step, _) in enumerate(times[1:])}
+        result['timing']['total'] = times[-1][1] - times[0][1]
+        if engineselect:
+            result['timing']['select'] = engine.selecttime
+            result['timing']['count'] -= engine.selecttime
+    return result
+
+
+def calculate_loss_batch( columns, cutnames, thresholds,
+                          sig_mask=None,
+                          lossfunction='s/b',
+                          chunksize=None,
+                          engine=None,
+                          weights=None):
+    ### calculate the loss function for many configurations of cuts at once
+    # input arguments:
+    # - columns, sig_mask, lossfunction, engine, weights: see calculate_loss
+    # - cutnames: list of cut names, one per column of thresholds
+    # - thresholds: array of shape (number of configurations, number of cuts)
+    # - chunksize: number of events to process at once
+    #              (default: such that the selection has at most 2**24 elements,
+    #              or 2**21 elements with weights, since the selection is then
+    #              converted to float64 for the product with the weights)
+    # returns:
+    # a dict with the same structure as the output of calculate_loss,
+    # but with an array of values (one per configuration)
+    # for the loss and the number of passing events.
+    # note: the thresholds are compared to the columns in the same way as
+    #       the (python float) cut values in calculate_loss,
+    #       so the results are identical to calling calculate_loss for each row.
+    thresholds = np.atleast_2d(np.asarray(thresholds, dtype=float))
+    nconfigs = len(thresholds)
+    if thresholds.shape[1]!=len(cutnames):
+        msg = 'ERROR: thresholds have {} columns'.format(thresholds.shape[1])
+        msg += ' but {} cut names were given.'.format(len(cutnames))
+        raise Exception(msg)
+    nsig_pass = np.zeros(nconfigs, dtype=np.int64)
+    nbkg_pass = np.zeros(nconfigs, dtype=np.int64)
+    wsig_pass = np.zeros(nconfigs, dtype=np.float64)
+    wbkg_pass = np.zeros(nconfigs, dtype=np.float64)
+
+    if engine is not None:
+        # count passing events with the engine, one configuration at a time
+        nsig_tot = engine.nsig_tot
+        nbkg_tot = engine.nbkg_tot
+        if weights is not None:
+            wsig_tot = engine.wsig_tot
+            wbkg_tot = engine.wbkg_tot
+        for idx in range(nconfigs):
+            cuts = {cutname: float(value) for cutname, value in zip(cutnames, thresholds[idx])}
+            if weights is not None:
+                (nsig_pass[idx], nbkg_pass[idx], wsig_pass[idx], wbkg_pass[idx]) = engine.count_weighted(cuts)
+            else: (nsig_pass[idx], nbkg_pass[idx]) = engine.count(cuts)
+    else:
+        # split the columns in signal and background, and cast the thresholds
+        # to the precision in which they would be compared in pass_selection
+        sig_mask = np.asarray(sig_mask, dtype=bool)
+        nsig_tot = np.sum(sig_mask)
+        nbkg_tot = np.sum(~sig_mask)
+        from cuttools import parse_cutname
+        cuttypes = [parse_cutname(cutname)[1] for cutname in cutnames]
+        sigcolumns = [columns[cutname][sig_mask] for cutname in cutnames]
+        bkgcolumns = [columns[cutname][~sig_mask] for cutname in cutnames]
+        cutvalues = [thresholds[:, [i]].astype(np.result_type(columns[cutname].dtype, 0.))
+                     for i, cutname in enumerate(cutnames)]
+        sigweights = None
+        bkgweights = None
+        if weights is not None:
+            sigweights = np.asarray(weights[sig_mask], dtype=np.float32)
+            bkgweights = np.asarray(weights[~sig_mask], dtype=np.float32)
+            wsig_tot = float(np.sum(sigweights, dtype=np.float64))
+            wbkg_tot = float(np.sum(bkgweights, dtype=np.float64))
+        if chunksize is None:
+            maxsize = 2**24 if weights is None else 2**21
+            chunksize = max(1, maxsize // max(1, nconfigs))
+        # build the selection as a 2D (configurations x events) mask, in chunks of events
+        for (splitcolumns, npass, splitweights, wpass) in [
+                (sigcolumns, nsig_pass, sigweights, wsig_pass),
+                (bkgcolumns, nbkg_pass, bkgweights, wbkg_pass)]:
+            nevents = len(splitcolumns[0]) if len(splitcolumns)>0 else 0
+            for start in range(0, nevents, chunksize):
+                mask = np.ones((nconfigs, min(chunksize, nevents-start)), dtype=bool)
+                for cuttype, column, cutvalue in zip(cuttypes, splitcolumns, cutvalues):
+                    varvalue = column[start:start+chunksize]
+                    if cuttype=='max': mask &= (varvalue < cutvalue)
+                    if cuttype=='min': mask &= (varvalue > cutvalue)
+                npass += np.count_nonzero(mask, axis=1)
+                if splitweights is not None:
+                    wpass += mask @ splitweights[start:start+chunksize].astype(np.float64)
+
+    # calculate losses
+    if weights is not None:
+        losses = get_losses(wsig_pass, wbkg_pass, lossfunction=lossfunction)
+    else:
+        losses = get_losses(nsig_pass, nbkg_pass, lossfunction=lossfunction)
+    extra_info = {'nsig_tot': nsig_tot,
+                  'nsig_pass': nsig_pass,
+                  'nbkg_tot': nbkg_tot,
+                  'nbkg_pass': nbkg_pass,
+                  'lossfunction': lossfunction}
+    if weights is not None:
+        extra_info.update({'wsig_tot': wsig_tot,
+                           'wsig_pass': wsig_pass,
+                           'wbkg_tot': wbkg_tot,
+                           'wbkg_pass': wbkg_pass})
+    return {'loss':losses, 'status':STATUS_OK, 'extra_info': extra_info}
+
+
+def scan_batch( columns, lattices,
+                sig_mask=None,
+                lossfunction='s/b',
+                nbest=1,
+                nconfigs=4096,
+                engine=None,
+                weights=None):
+    ### evaluate all configurations on the grid lattices and get the best ones
+    # input arguments:
+    # - columns, sig_mask, lossfunction, engine, weights: see calculate_loss
+    # - lattices: dict mapping cut names to lattices, as obtained from lattice.get_grid_lattices
+    # - nbest: number of configurations to return
+    # - nconfigs: number of configurations to evaluate at once with calculate_loss_batch
+    # returns:
+    # a list of configurations (dicts mapping cut names to python floats),
+    # sorted from lower to higher loss (and by lattice index for equal losses)
+    # note: gives the same configurations as LatticeEngine.get_best,
+    #       but without a table of counts, so it also works for lattices that are too large
+    #       for the lattice engine, or with per-candidate selection (see tools/candidates.py).
+    cutnames = list(lattices.keys())
+    values = [np.asarray(lattices[cutname], dtype=np.float64) for cutname in cutnames]
+    shape = tuple([len(lattice) for lattice in values])
+    ntotal = int(np.prod(shape))
+    bestindices = np.zeros(0, dtype=np.int64)
+    bestlosses = np.zeros(0, dtype=np.float64)
+    for start in range(0, ntotal, nconfigs):
+        indices = np.arange(start, min(start+nconfigs, ntotal), dtype=np.int64)
+        thresholds = np.stack([lattice[j] for lattice, j
+                               in zip(values, np.unravel_index(indices, shape))], axis=1)
+        losses = calculate_loss_batch(columns, cutnames, thresholds,
+                   sig_mask=sig_mask, lossfunction=lossfunction,
+                   engine=engine, weights=weights)['loss']
+        # keep only the best ones so far
+        indices = np.concatenate((bestindices, indices))
+        losses = np.concatenate((bestlosses, losses))
+        order = np.lexsort((indices, losses))[:nbest]
+        (bestindices, bestlosses) = (indices[order], losses[order])
+    return [{cutname: float(lattice[j]) for cutname, lattice, j
+             in zip(cutnames, values, np.unravel_index(index, shape))}
+            for index in bestindices]
 
 
 if __name__=='__main__':
@@ -133,33 +276,123 @@ if __name__=='__main__':
     parser.add_argument('-b', '--bkgfiles', default=[], nargs='+')
     parser.add_argument('-g', '--gridfile', required=True)
     parser.add_argument('-o', '--outputfile', default=None)
+    parser.add_argument('--columnar', default=None,
+      help='Directory for writing the results in columnar format'
+          +' (in addition to the output file), for fast reading with get_best.py and plot_loss.py')
     parser.add_argument('-n', '--niterations', type=int, default=10)
     parser.add_argument('-l', '--lossfunction', default='s/b')
     parser.add_argument('--nentriesperfile', type=int, default=-1)
     parser.add_argument('--nstartup', type=int, default=10)
+    parser.add_argument('--patience', type=int, default=None,
+      help='Stop if the best loss did not improve (by more than --epsilon)'
+          +' during this number of iterations (default: no early stopping)')
+    parser.add_argument('--epsilon', type=float, default=0.,
+      help='Minimal relative improvement of the best loss to reset the --patience count')
+    parser.add_argument('--maxtime', type=float, default=None,
+      help='Stop after this number of seconds (default: no limit)')
+    parser.add_argument('--minrate', type=float, default=None,
+      help='Stop if fewer than this number of iterations per second were evaluated'
+          +' during the last 20 iterations (default: no limit)')
+    parser.add_argument('--checkpoint', default=None,
+      help='File for writing periodic checkpoints of the trials'
+          +' (same format as the output file; default: no checkpoints)')
+    parser.add_argument('--checkpointevery', type=int, default=100,
+      help='Write a checkpoint every this number of iterations')
+    parser.add_argument('--checkpointinterval', type=float, default=None,
+      help='Write a checkpoint every this number of seconds (in addition to --checkpointevery)')
+    parser.add_argument('--resume', default=False, action='store_true',
+      help='Continue from the trials in the --checkpoint file (if it exists)'
+          +' up to a total of --niterations, without re-evaluating them')
+    parser.add_argument('--studyfile', default=None,
+      help='SQLite file (e.g. on a shared filesystem) for sharing the trials of a --study'
+          +' between multiple jobs, so that each suggestion uses the results of all jobs')
+    parser.add_argument('--study', default=None,
+      help='Name of the study in the --studyfile to attach to; the study must be created'
+          +' by one of the jobs with --createstudy, and --niterations is the total for all jobs')
+    parser.add_argument('--createstudy', default=False, action='store_true',
+      help='Create the --study instead of attaching to it (including pre-defined trials'
+          +' from --scan or --resume, if any)')
+    parser.add_argument('--staletime', type=float, default=None,
+      help='Put trials of the --study that have been running for more than this number'
+          +' of seconds (e.g. from a job that was killed) back in the queue'
+          +' when this job starts (default: never)')
+    parser.add_argument('--profile', default=False, action='store_true',
+      help='Measure the time spent in each step of each trial and in the suggestion algorithm,'
+          +' and print a summary at the end of the run')
+    parser.add_argument('--progressfile', default=None,
+      help='Json lines file to write the progress (and timing) of each trial to during the run'
+          +' (implies --profile)')
+    parser.add_argument('--weightbranch', default=None,
+      help='Branch with generator weights (e.g. genWeight);'
+          +' if specified (or if cross-sections are given), the loss is calculated'
+          +' from the weighted signal and background yields instead of the number of events')
+    parser.add_argument('--sigxsec', type=float, default=None, nargs='+',
+      help='Cross-section of the signal, either one value (all signal files are one sample)'
+          +' or one value per signal file (each file is a separate sample)')
+    parser.add_argument('--bkgxsec', type=float, default=None, nargs='+',
+      help='Cross-section of the background, either one value or one value per file'
+          +' (see --sigxsec)')
+    parser.add_argument('--lumi', type=float, default=1.,
+      help='Integrated luminosity, in units matching the cross-sections')
+    parser.add_argument('--engine', default='mask',
+      choices=['mask','sorted','lattice','maskcache','numba'],
+      help='Method for counting passing events: build a mask in each iteration (mask),'
+          +' use a binary search in pre-sorted columns (sorted),'
+          +' use a table of counts on the grid lattice (lattice, only for quniform grids),'
+          +' combine cached bit-packed masks for each cut value (maskcache),'
+          +' or apply all cuts in a single compiled loop over the events (numba, requires numba)')
+    parser.add_argument('--selection', default='variable', choices=['variable','candidate'],
+      help='Semantics of cuts on jagged variables (e.g. DsMeson_mass):'
+          +' each cut passes if the minimum or maximum over the candidates passes (variable),'
+          +' or an event passes if at least one candidate of each collection passes'
+          +' all cuts on that collection (candidate, requires the numba engine)')
+    parser.add_argument('--maskcachesize', type=float, default=1.,
+      help='Maximum memory in GB for the cached masks of the maskcache engine')
+    parser.add_argument('--latticemaxsize', type=float, default=1.,
+      help='Maximum memory in GB for the lattice engine;'
+          +' if more would be needed, the sorted engine is used instead')
+    parser.add_argument('--scan', default=False, action='store_true',
+      help='Evaluate all configurations on the grid lattice instead of running tpe'
+          +' (requires a grid with only quniform variables; uses the table of the lattice engine'
+          +' if available, else evaluates the configurations in batches);'
+          +' the output contains the --nscan best ones')
+    parser.add_argument('--nscan', type=int, default=100)
+    parser.add_argument('--nworkers', type=int, default=1,
+      help='Number of worker processes for evaluating trials in parallel')
+    parser.add_argument('--nfidelities', type=int, default=1,
+      help='Number of fidelity levels for successive halving: if larger than 1,'
+          +' the suggested configurations are first evaluated on a random subsample'
+          +' of 1/eta**(nfidelities-1) of the events, and only the best 1/eta of them'
+          +' is evaluated again on a subsample that is eta times larger,'
+          +' up to the full sample (default: 1, i.e. all configurations on all events)')
+    parser.add_argument('--eta', type=int, default=3,
+      help='Reduction factor for successive halving (see --nfidelities)')
+    parser.add_argument('--resultcache', default=None,
+      help='File for storing results of evaluated configurations,'
+          +' to be reused within this run and in later runs on the same inputs')
+    parser.add_argument('--stepsize', default=None,
+      help='Read the input files in chunks of this size, either a number of entries'
+          +' or a string like "100 MB" (default: read each file at once)')
+    parser.add_argument('--nthreads', type=int, default=1,
+      help='Number of input files to read concurrently (default: 1)')
+    parser.add_argument('--cachedir', default=None,
+      help='Directory for caching reduced input columns between runs (default: no caching)')
+    parser.add_argument('--cachesize', type=float, default=None,
+      help='Maximum size of the column cache in GB (default: no limit)')
     args = parser.parse_args()
 
     # print arguments
     print('Running with following configuration:')
     for arg in vars(args): print('  - {}: {}'.format(arg,getattr(args,arg))) 
+    if( args.resume and args.checkpoint is None ):
+        raise Exception('ERROR: option --resume requires a --checkpoint file.')
+    if( (args.study is None) != (args.studyfile is None) ):
+        raise Exception('ERROR: options --study and --studyfile must be used together.')
+    if( args.study is not None and (args.nworkers > 1 or args.nfidelities > 1) ):
+        raise Exception('ERROR: option --study cannot be combined with --nworkers or --nfidelities.')
+    if( args.study is not None and args.resume and not args.createstudy ):
+        raise Exception('ERROR: option --resume can only be used with --study for --createstudy.')
 
-    # load the input files
-    sigvar = 'isSignal'
-    events = make_input_file(sigfiles=args.sigfiles,
-      bkgfiles=args.bkgfiles,
-      nentriesperfile=args.nentriesperfile,
-      sigvar=sigvar)
-
-    # define signal mask
-    #sig_mask = (events.MET.pt > 55.) # only for testing
-    sig_mask = getattr(events, sigvar)
-
-    # do some printouts
-    print('Number of events from inut files:')
-    print(' - Signal: {}'.format(ak.sum(sig_mask)))
-    print(' - Background: {}'.format(ak.sum(~sig_mask)))
-    print(' - Total: {}'.format(len(events)))
-    
     # get the grid
     with open(args.gridfile,'rb') as f:
         obj = pkl.load(f)
@@ -168,23 +401,340 @@ if __name__=='__main__':
     print('Found following grid:')
     print(gridstr)
 
+    # get the normalization of each input file
+    xsecs = None
+    samples = None
+    if( args.sigxsec is not None or args.bkgxsec is not None ):
+        xsecs = []
+        samples = []
+        for (label, files, filexsecs) in [('sig', args.sigfiles, args.sigxsec),
+                                          ('bkg', args.bkgfiles, args.bkgxsec)]:
+            if filexsecs is None: filexsecs = []
+            if len(files)==0: continue
+            if len(filexsecs)==1:
+                xsecs += filexsecs * len(files)
+                samples += [label] * len(files)
+            elif len(filexsecs)==len(files):
+                xsecs += filexsecs
+                samples += ['{}{}'.format(label, idx) for idx in range(len(files))]
+            else:
+                msg = 'ERROR: got {} {} cross-sections'.format(len(filexsecs), label)
+                msg += ' for {} {} files;'.format(len(files), label)
+                msg += ' need either one value or one value per file.'
+                raise Exception(msg)
+    weighted = (args.weightbranch is not None or xsecs is not None)
+
+    # make the column cache
+    cache = None
+    if args.cachedir is not None:
+        maxsize = None if args.cachesize is None else int(args.cachesize*1e9)
+        from columncache import ColumnCache
+        cache = ColumnCache(args.cachedir, maxsize=maxsize)
+        print('Using {}'.format(cache))
+
+    # load the input files
+    # (only the branches needed for the cuts in the grid are read,
+    #  and the variables to cut on are reduced to one dense column per cut,
+    #  so that each iteration only needs to compare them to the cut values)
+    from cuttools import get_cut_branches
+    from make_input_file import make_input_columns, make_candidate_columns
+    branches = get_cut_branches(grid.keys())
+    print('Reading following branches: {}'.format(branches))
+    stepsize = args.stepsize
+    if( stepsize is not None and stepsize.isdigit() ): stepsize = int(stepsize)
+    columns, sig_mask, weights = make_input_columns(sigfiles=args.sigfiles,
+      bkgfiles=args.bkgfiles,
+      cutnames=list(grid.keys()),
+      nentriesperfile=args.nentriesperfile,
+      cache=cache,
+      stepsize=stepsize,
+      nthreads=args.nthreads,
+      verbose=True,
+      weightbranch=args.weightbranch,
+      xsecs=xsecs,
+      samples=samples,
+      lumi=args.lumi)
+    if cache is not None:
+        print('Column cache hits: {}, misses: {}'.format(cache.nhits, cache.nmisses))
+    # read the jagged variables per candidate
+    # (the reduced columns are still used for cuts on variables with one value per event)
+    candidates = None
+    if args.selection=='candidate':
+        if args.engine!='numba':
+            raise Exception('ERROR: option --selection candidate requires the numba engine.')
+        candidates = make_candidate_columns(sigfiles=args.sigfiles,
+          bkgfiles=args.bkgfiles,
+          cutnames=list(grid.keys()),
+          nentriesperfile=args.nentriesperfile,
+          stepsize=stepsize)
+        for collection, data in candidates.items():
+            print('Read {} candidates of collection {} for variables {}'.format(
+                   data['offsets'][-1], collection, list(data['values'].keys())))
+
+    # do some printouts
+    print('Number of events from inut files:')
+    print(' - Signal: {}'.format(np.sum(sig_mask)))
+    print(' - Background: {}'.format(np.sum(~sig_mask)))
+    print(' - Total: {}'.format(len(sig_mask)))
+    if weighted:
+        print('Weighted yields:')
+        print(' - Signal: {}'.format(np.sum(weights[sig_mask], dtype=np.float64)))
+        print(' - Background: {}'.format(np.sum(weights[~sig_mask], dtype=np.float64)))
+
+    # prepare the engine for counting passing events
+    engine = None
+    if args.engine=='mask':
+        # note: the columns and weights are split in signal and background once,
+        #       instead of in each iteration, and the events are counted in chunks
+        #       without allocating full-length masks (see tools/maskengine.py).
+        from maskengine import MaskEngine
+        engine = MaskEngine(columns, sig_mask, weights=weights)
+    if args.engine=='lattice':
+        from lattice import LatticeEngine, get_grid_lattices
+        lattices = get_grid_lattices(grid)
+        if lattices is None:
+            print('WARNING: lattice engine requires a grid with only quniform variables;'
+                  +' using sorted engine instead.')
+            args.engine = 'sorted'
+        elif LatticeEngine.get_size(lattices, weighted=weighted) > args.latticemaxsize*1e9:
+            msg = 'WARNING: lattice engine would need {:.1f} GB'.format(
+                    LatticeEngine.get_size(lattices, weighted=weighted)/1e9)
+            msg += ' (more than --latticemaxsize); using sorted engine instead.'
+            print(msg)
+            args.engine = 'sorted'
+        else:
+            print('Filling lattice tables...')
+            engine = LatticeEngine(columns, sig_mask, lattices, weights=weights)
+    if args.scan:
+        from lattice import get_grid_lattices
+        if get_grid_lattices(grid) is None:
+            raise Exception('ERROR: option --scan requires a grid with only quniform variables.')
+    if( args.nfidelities > 1 and (args.scan or args.nworkers > 1) ):
+        raise Exception('ERROR: option --nfidelities cannot be combined with --scan or --nworkers.')
+    if args.engine=='sorted':
+        print('Sorting input columns...')
+        from sortedindex import SortedIndexEngine
+        engine = SortedIndexEngine(columns, sig_mask, weights=weights)
+    if args.engine=='maskcache':
+        from maskcache import MaskCacheEngine
+        engine = MaskCacheEngine(columns, sig_mask, maxsize=args.maskcachesize*1e9, weights=weights)
+    if args.engine=='numba':
+        # note: imported here since numba is an optional dependency and slow to import.
+        from candidates import CandidateEngine, select_events
+        engine = CandidateEngine(columns, sig_mask, candidates=candidates, weights=weights)
+
+    # make the result cache
+    # note: the results are always cached in memory,
+    #       but only written to a file if requested.
+    weightsettings = None
+    if weighted:
+        weightsettings = {'weightbranch': args.weightbranch, 'xsecs': xsecs,
+                          'samples': samples, 'lumi': args.lumi}
+    # note: per-candidate cuts give different results for the same configuration,
+    #       so they use a separate key (while keeping the key of existing caches unchanged).
+    if args.selection=='candidate':
+        weightsettings = {'weights': weightsettings, 'selection': args.selection}
+    inputkey = get_input_key(sigfiles=args.sigfiles, bkgfiles=args.bkgfiles,
+                             nentriesperfile=args.nentriesperfile,
+                             extra=weightsettings)
+    resultcache = ResultCache(inputkey=inputkey, cachefile=args.resultcache)
+    if resultcache.nloaded>0:
+        print('Loaded {} results from {}'.format(resultcache.nloaded, args.resultcache))
+
+    # load the trials from an earlier run
+    resumed = None
+    if( args.resume and os.path.exists(args.checkpoint) ):
+        (resumed, nremoved) = load_trials(args.checkpoint)
+        msg = 'Resuming from {} trials in {}'.format(len(resumed.trials), args.checkpoint)
+        if nremoved>0: msg += ' ({} unfinished trials removed)'.format(nremoved)
+        print(msg)
+
     # run hyperopt
     trials = Trials()
+    if resumed is not None: trials = resumed
+    algo = partial(tpe.suggest, n_startup_jobs=args.nstartup)
+    niterations = args.niterations
+    if args.scan:
+        # evaluate all configurations at once and keep only the best ones,
+        # which are then evaluated again by hyperopt as pre-defined trials
+        # (with the table of the lattice engine if available, else in batches of configurations)
+        if args.engine=='lattice':
+            print('Scanning all {} configurations...'.format(int(np.prod(engine.shape))))
+            points = [engine.get_config(index)
+                      for index in engine.get_best(lossfunction=args.lossfunction, nbest=args.nscan)]
+        else:
+            scanlattices = get_grid_lattices(grid)
+            print('Scanning all {} configurations in batches...'.format(
+                   int(np.prod([len(lattice) for lattice in scanlattices.values()]))))
+            # (for the mask engine, the selection is built for many configurations at once instead)
+            points = scan_batch(columns, scanlattices,
+                       sig_mask=sig_mask,
+                       lossfunction=args.lossfunction,
+                       nbest=args.nscan,
+                       engine=engine if args.engine!='mask' else None,
+                       weights=weights)
+        if resumed is None: trials = generate_trials_to_calculate(points)
+        niterations = len(points)
+        # do not make any new suggestions on top of the pre-defined trials
+        algo = lambda new_ids, domain, trials, seed: []
+    # set the early stopping rules
+    # (not used for scan mode, where all pre-defined trials are evaluated)
+    earlystopper = None
+    if( not args.scan and (args.patience is not None or args.maxtime is not None
+                           or args.minrate is not None) ):
+        earlystopper = EarlyStopper(patience=args.patience, epsilon=args.epsilon,
+                         maxtime=args.maxtime, minrate=args.minrate)
+
+    # set the checkpointing
+    # (called through the same hook as the early stopping rules)
+    checkpointer = None
+    if args.checkpoint is not None:
+        checkpointer = Checkpointer(args.checkpoint, every=args.checkpointevery,
+                         interval=args.checkpointinterval)
+    # set the timing of each trial
+    # (also called through the same hook as the early stopping rules)
+    profiler = None
+    if( args.profile or args.progressfile is not None ):
+        profiler = TrialProfiler(progressfile=args.progressfile)
+        algo = profiler.wrap_algo(algo)
+    # create or attach to the shared study
+    # (only jobs with the same inputs, grid and loss function can share a study)
+    store = None
+    if args.study is not None:
+        # note: the grid description contains object addresses, so the file content is used.
+        with open(args.gridfile, 'rb') as f: gridkey = hashlib.sha1(f.read()).hexdigest()
+        settings = {'inputkey': inputkey, 'grid': gridkey, 'lossfunction': args.lossfunction}
+        from sharedtrials import TrialStore, fmin_shared
+        store = TrialStore(args.studyfile, args.study, create=args.createstudy, settings=settings)
+        if args.createstudy:
+            print('Created study {} in {}'.format(args.study, args.studyfile))
+            if len(trials._dynamic_trials)>0: store.add_trials(trials)
+        else: print('Attached to study {} in {}'.format(args.study, args.studyfile))
+        if args.staletime is not None:
+            nrequeued = store.requeue_stale(args.staletime)
+            if nrequeued>0: print('Put {} stale trials back in the queue'.format(nrequeued))
+    def early_stop_fn( trials, *early_stop_args ):
+        if checkpointer is not None: checkpointer(trials)
+        if profiler is not None: profiler(trials)
+        if earlystopper is not None: return earlystopper(trials)
+        return (False, [])
+
     iteration = [1]
-    best = fmin(
-      fn=partial(calculate_loss, events,
-                 sig_mask=sig_mask,
-                 lossfunction=args.lossfunction,
-                 iteration=iteration
-      ),
-      space=grid,
-      algo=partial(tpe.suggest, n_startup_jobs=args.nstartup),
-      max_evals=args.niterations,
-      trials=trials
-    )
+    enginefactory = None
+    if args.engine=='mask': enginefactory = MaskEngine
+    if args.engine=='sorted': enginefactory = SortedIndexEngine
+    if args.engine=='lattice': enginefactory = partial(LatticeEngine, lattices=lattices)
+    if args.engine=='maskcache':
+        enginefactory = partial(MaskCacheEngine, maxsize=args.maskcachesize*1e9/args.nworkers)
+    if args.engine=='numba': enginefactory = partial(CandidateEngine, candidates=candidates)
+    if args.nworkers > 1:
+        # evaluate batches of trials in parallel worker processes,
+        # each with their own engine but sharing the input columns
+        from parallel import TrialPool, fmin_parallel
+        fn = partial(calculate_loss,
+                     lossfunction=args.lossfunction,
+                     iteration=iteration,
+                     timing=(profiler is not None))
+        with TrialPool(columns, sig_mask, fn, args.nworkers, enginefactory=enginefactory,
+                       resultcache=resultcache, lossfunction=args.lossfunction,
+                       weights=weights) as pool:
+            fmin_parallel(pool, grid, algo, niterations, trials, early_stop_fn=early_stop_fn)
+    elif store is not None:
+        # evaluate trials one at a time, sharing all trials with the other jobs in the study
+        trials = fmin_shared(partial(calculate_loss, columns,
+                               sig_mask=sig_mask,
+                               lossfunction=args.lossfunction,
+                               iteration=iteration,
+                               engine=engine,
+                               resultcache=resultcache,
+                               weights=weights,
+                               timing=(profiler is not None)),
+                             grid, algo, niterations, store, early_stop_fn=early_stop_fn)
+    elif args.nfidelities > 1:
+        # evaluate the suggestions on increasingly large subsamples of the events,
+        # promoting only the best ones to the next level,
+        # with a separate engine for each subsample
+        # note: the result cache is only used for the full sample.
+        from multifidelity import get_fractions, get_subsample_indices, make_subsample
+        from multifidelity import fmin_halving, get_cost
+        fractions = get_fractions(args.nfidelities, eta=args.eta)
+        fns = []
+        for indices in get_subsample_indices(sig_mask, fractions, seed=1):
+            sub = make_subsample(columns, sig_mask, indices, weights=weights)
+            subengine = engine
+            if( indices is not None and enginefactory is not None ):
+                subfactory = enginefactory
+                if candidates is not None:
+                    subfactory = partial(CandidateEngine, candidates=select_events(candidates, indices))
+                if weights is None: subengine = subfactory(sub['columns'], sub['sig_mask'])
+                else: subengine = subfactory(sub['columns'], sub['sig_mask'], weights=sub['weights'])
+            fns.append(partial(calculate_loss, sub['columns'],
+                               sig_mask=sub['sig_mask'],
+                               lossfunction=args.lossfunction,
+                               iteration=iteration,
+                               engine=subengine,
+                               resultcache=resultcache if indices is None else None,
+                               weights=sub['weights'],
+                               timing=(profiler is not None),
+                               scale=sub['scale']))
+        fmin_halving(fns, fractions, grid, algo, niterations, trials, eta=args.eta,
+                     early_stop_fn=early_stop_fn)
+    else:
+        best = fmin(
+          fn=partial(calculate_loss, columns,
+                     sig_mask=sig_mask,
+                     lossfunction=args.lossfunction,
+                     iteration=iteration,
+                     engine=engine,
+                     resultcache=resultcache,
+                     weights=weights,
+                     timing=(profiler is not None)
+          ),
+          space=grid,
+          algo=algo,
+          max_evals=niterations,
+          trials=trials,
+          early_stop_fn=early_stop_fn
+        )
+    if checkpointer is not None:
+        checkpointer.write(trials)
+        print('Wrote {} checkpoints to {}'.format(checkpointer.nwritten, args.checkpoint))
+
+    if( earlystopper is not None and earlystopper.reason is not None ):
+        print('Stopped after {} of {} iterations: {}'.format(
+               len(trials.trials), niterations, earlystopper.reason))
+
+    if args.nfidelities > 1:
+        (nevals, cost) = get_cost(trials)
+        print('Number of evaluations per fidelity (fraction of events):')
+        for fidelity in sorted(nevals.keys()):
+            print(' - {:.4g}: {}'.format(fidelity, nevals[fidelity]))
+        print('Total cost equivalent to {:.1f} evaluations on all events'.format(cost)
+              +' (instead of {})'.format(len(trials.trials)))
+
+    if profiler is not None:
+        profiler.close()
+        print(profiler.report())
+        if args.progressfile is not None:
+            print('Progress of each trial written to {}'.format(args.progressfile))
+
+    if( args.engine=='lattice' and args.nworkers==1 ):
+        print('Number of evaluations not on the lattice: {}'.format(engine.nfallback))
+    if( args.engine=='maskcache' and args.nworkers==1 ):
+        print(engine.report())
+
+    if store is not None:
+        print(store.report())
+        store.close()
+
+    print(resultcache.report())
+    resultcache.save()
 
     # write search results to output file
     if args.outputfile is not None:
         print('Writing results to {}'.format(args.outputfile))
         with open(args.outputfile,'wb') as f:
-            pkl.dump(trials,f)
\ No newline at end of file
+            pkl.dump(trials,f)
+    if args.columnar is not None:
+        print('Writing results in columnar format to {}'.format(args.columnar))
+        write_results(trials, args.columnar)
@@ -0,0 +1,40 @@
+# shared fixtures for the tests
+
+# imports
+import os
+import sys
+import numpy as np
+import pytest
+from hyperopt import hp
+
+# local imports
+thisdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(thisdir, '..'))
+sys.path.append(os.path.join(thisdir, '..', 'tools'))
+
+
+@pytest.fixture
+def events():
+    ### small set of reduced cut columns with signal labels and weights
+    # returns:
+    # a dict with keys columns, sig_mask, weights and grid
+    # (a hyperopt grid with only quniform variables, matching the columns)
+    rng = np.random.default_rng(1)
+    nevents = 2000
+    sig_mask = rng.random(nevents) < 0.3
+    columns = {
+      'x_min': np.where(sig_mask, rng.normal(0.6, 0.2, nevents),
+                 rng.normal(0.4, 0.2, nevents)).astype(np.float32),
+      'x_max': rng.uniform(0., 1., nevents).astype(np.float32),
+      'y_max': np.where(sig_mask, rng.exponential(1., nevents),
+                 rng.exponential(2., nevents)).astype(np.float32),
+    }
+    # missing values fail any cut
+    columns['y_max'][::97] = np.nan
+    weights = rng.normal(1., 0.2, nevents).astype(np.float32)
+    grid = {
+      'x_min': hp.quniform('x_min', 0., 1., 0.1),
+      'x_max': hp.quniform('x_max', 0.5, 1., 0.1),
+      'y_max': hp.quniform('y_max', 0.5, 3., 0.25),
+    }
+    return {'columns': columns, 'sig_mask': sig_mask, 'weights': weights, 'grid': grid}
@@ -0,0 +1,129 @@
+# tests for the engines for counting passing events
+
+# imports
+import numpy as np
+import pytest
+
+# local imports
+from cuttools import pass_selection
+from maskengine import MaskEngine, split_events
+from sortedindex import SortedIndexEngine
+from lattice import LatticeEngine, get_grid_lattices
+from maskcache import MaskCacheEngine
+
+
+def get_engines( events, weights=None ):
+    ### make all engines for a set of events
+    columns = events['columns']
+    sig_mask = events['sig_mask']
+    engines = {
+      'mask': MaskEngine(columns, sig_mask, weights=weights),
+      # (chunks that do not divide the number of events)
+      'maskchunks': MaskEngine(columns, sig_mask, weights=weights, chunksize=97),
+      'sorted': SortedIndexEngine(columns, sig_mask, weights=weights),
+      'lattice': LatticeEngine(columns, sig_mask, get_grid_lattices(events['grid']), weights=weights),
+      'maskcache': MaskCacheEngine(columns, sig_mask, maxsize=1e5, weights=weights),
+    }
+    # note: numba is an optional dependency
+    try: from candidates import CandidateEngine
+    except ImportError: CandidateEngine = None
+    if CandidateEngine is not None:
+        engines['numba'] = CandidateEngine(columns, sig_mask, weights=weights)
+    return engines
+
+def get_configs( events, nconfigs=100 ):
+    ### make random configurations, both on and off the grid lattice, with subsets of the cuts
+    rng = np.random.default_rng(3)
+    lattices = get_grid_lattices(events['grid'])
+    configs = []
+    for idx in range(nconfigs):
+        if idx%2==0:
+            cuts = {cutname: float(rng.choice(lattice)) for cutname, lattice in lattices.items()}
+        else:
+            cuts = {cutname: float(rng.uniform(lattice[0], lattice[-1]))
+                    for cutname, lattice in lattices.items()}
+        # note: a configuration always has at least one cut
+        if idx%5==0: cuts = {key: val for n, (key, val) in enumerate(cuts.items())
+                             if n==0 or rng.random()<0.5}
+        configs.append(cuts)
+    return configs
+
+def reference_count( events, cuts, weights=None ):
+    ### count passing events with a full-length mask
+    mask = pass_selection(events['columns'], cuts)
+    sigsel = mask & events['sig_mask']
+    bkgsel = mask & ~events['sig_mask']
+    res = (int(np.count_nonzero(sigsel)), int(np.count_nonzero(bkgsel)))
+    if weights is None: return res
+    return res + (float(np.sum(weights[sigsel], dtype=np.float64)),
+                  float(np.sum(weights[bkgsel], dtype=np.float64)))
+
+
+def test_engines_agree( events ):
+    ### all engines give the same number of passing events as the full mask
+    engines = get_engines(events)
+    for cuts in get_configs(events):
+        expected = reference_count(events, cuts)
+        for name, engine in engines.items():
+            assert engine.count(cuts)==expected, name
+
+def test_engines_agree_weighted( events ):
+    ### all engines give the same weighted yields as the full mask
+    weights = events['weights']
+    engines = get_engines(events, weights=weights)
+    for name, engine in engines.items():
+        assert engine.wsig_tot==pytest.approx(np.sum(weights[events['sig_mask']], dtype=np.float64))
+    for cuts in get_configs(events):
+        expected = reference_count(events, cuts, weights=weights)
+        for name, engine in engines.items():
+            res = engine.count_weighted(cuts)
+            assert res[:2]==expected[:2], name
+            assert res[2:]==pytest.approx(expected[2:], rel=1e-6, abs=1e-9), name
+
+def test_mask_engine_split( events ):
+    ### the mask engine uses views if all signal events come first, and masks otherwise
+    sig_mask = np.sort(events['sig_mask'])[::-1]
+    (sigsel, bkgsel) = split_events(sig_mask)
+    assert isinstance(sigsel, slice)
+    assert np.all(sig_mask[sigsel]) and not np.any(sig_mask[bkgsel])
+    (sigsel, bkgsel) = split_events(events['sig_mask'])
+    assert not isinstance(sigsel, slice)
+
+def test_candidate_selection( events ):
+    ### with per-candidate selection, an event passes if one candidate passes all cuts on it
+    pytest.importorskip('numba')
+    import awkward as ak
+    from candidates import CandidateEngine, select_events
+    rng = np.random.default_rng(5)
+    sig_mask = events['sig_mask']
+    counts = rng.integers(0, 4, len(sig_mask))
+    pt = rng.exponential(2., counts.sum()).astype(np.float32)
+    eta = rng.uniform(-2.5, 2.5, counts.sum()).astype(np.float32)
+    offsets = np.zeros(len(sig_mask)+1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    candidates = {'Cand': {'offsets': offsets, 'values': {'Cand_pt': pt, 'Cand_eta': eta}}}
+    # note: the reduced columns of the candidate variables are not used
+    columns = {'x_min': events['columns']['x_min'],
+               'Cand_pt_min': np.zeros(len(sig_mask), dtype=np.float32),
+               'Cand_eta_max': np.zeros(len(sig_mask), dtype=np.float32)}
+    def reference( cuts, indices ):
+        mask = columns['x_min'] > np.float32(cuts['x_min'])
+        candmask = np.ones(len(pt), dtype=bool)
+        if 'Cand_pt_min' in cuts: candmask &= (pt > np.float32(cuts['Cand_pt_min']))
+        if 'Cand_eta_max' in cuts: candmask &= (eta < np.float32(cuts['Cand_eta_max']))
+        # (collections without cuts do not need any candidate)
+        if len(cuts)>1: mask &= ak.to_numpy(ak.any(ak.unflatten(candmask, counts), axis=1))
+        mask = mask[indices]
+        return (int(np.count_nonzero(mask & sig_mask[indices])),
+                int(np.count_nonzero(mask & ~sig_mask[indices])))
+    rng = np.random.default_rng(6)
+    indices = np.sort(rng.choice(len(sig_mask), len(sig_mask)//3, replace=False))
+    engines = [(CandidateEngine(columns, sig_mask, candidates=candidates), np.arange(len(sig_mask))),
+               (CandidateEngine({key: val[indices] for key, val in columns.items()}, sig_mask[indices],
+                                candidates=select_events(candidates, indices)), indices)]
+    for idx in range(20):
+        cuts = {'x_min': float(rng.uniform(0., 0.8))}
+        if idx%3!=1: cuts['Cand_pt_min'] = float(rng.uniform(0., 4.))
+        if idx%3!=2: cuts['Cand_eta_max'] = float(rng.uniform(-2., 2.))
+        for (engine, selected) in engines:
+            assert engine.count(cuts)==reference(cuts, selected)
@@ -0,0 +1,74 @@
+# tests for the selection of the best configurations in get_best.py
+
+# imports
+import pickle as pkl
+from hyperopt import Trials, STATUS_OK, STATUS_FAIL
+from hyperopt.base import JOB_STATE_DONE
+
+# local imports
+from get_best import get_best_info, get_distinct_best, merge_best_info
+from resultsfile import write_results
+
+
+def make_trials_file( path, results ):
+    ### write a pickled trials object with the given results
+    # input arguments:
+    # - path: output file
+    # - results: list of tuples of the form (x_min, loss, status, fidelity)
+    trials = Trials()
+    docs = []
+    for tid, (x_min, loss, status, fidelity) in enumerate(results):
+        # note: failed trials have no loss and no extra info
+        result = {'status': status}
+        if loss is not None: result.update({'loss': loss, 'extra_info': {'fidelity': fidelity}})
+        misc = {'tid': tid, 'cmd': None, 'workdir': None,
+                'idxs': {'x_min': [tid]}, 'vals': {'x_min': [x_min]}}
+        doc = trials.new_trial_docs([tid], [None], [result], [misc])[0]
+        doc['state'] = JOB_STATE_DONE
+        docs.append(doc)
+    trials.insert_trial_docs(docs)
+    trials.refresh()
+    with open(path, 'wb') as f:
+        pkl.dump(trials, f)
+    return str(path)
+
+def test_failed_trials_are_skipped( tmp_path ):
+    ### failed trials (without a loss) are never returned
+    inputfile = make_trials_file(tmp_path / 'trials.pkl', [
+      (0.1, -1., STATUS_OK, 1), (0.2, None, STATUS_FAIL, 1), (0.3, -2., STATUS_OK, 1)])
+    infos = get_distinct_best(inputfile, nbest=5)
+    assert [info['loss'] for info in infos]==[-2., -1.]
+    assert get_distinct_best(inputfile, nbest=0)==[]
+    infos = merge_best_info([inputfile, inputfile], nbest=5)
+    assert [info['loss'] for info in infos]==[-2., -1.]
+    assert [len(info['sources']) for info in infos]==[2, 2]
+    assert merge_best_info([inputfile], nbest=0)==[]
+    with open(inputfile, 'rb') as f: trials = pkl.load(f)
+    infos = get_best_info(trials, nbest=5)
+    assert [info['loss'] for info in infos]==[-2., -1.]
+    assert [info['config'] for info in infos]==[{'x_min': [0.3]}, {'x_min': [0.1]}]
+
+def test_merge_keeps_lowest_loss( tmp_path ):
+    ### identical configurations in multiple files are kept once, with the lowest loss
+    file1 = make_trials_file(tmp_path / 'trials1.pkl', [
+      (0.1, -1., STATUS_OK, 1), (0.2, -3., STATUS_OK, 1)])
+    file2 = make_trials_file(tmp_path / 'trials2.pkl', [
+      (0.1, -4., STATUS_OK, 1), (0.3, -2., STATUS_OK, 1)])
+    infos = merge_best_info([file1, file2], nbest=2)
+    assert [info['loss'] for info in infos]==[-4., -3.]
+    assert infos[0]['config']=={'x_min': [0.1]}
+    assert infos[0]['sources']==[(file1, 0), (file2, 0)]
+
+def test_subsample_trials_are_not_ranked( tmp_path ):
+    ### trials evaluated on a subsample of the events only are never preferred
+    ### (in the same way for pickled and columnar results)
+    inputfile = make_trials_file(tmp_path / 'trials.pkl', [
+      (0.1, -5., STATUS_OK, 1/3.), (0.2, -2., STATUS_OK, 1), (0.3, -1., STATUS_OK, 1)])
+    with open(inputfile, 'rb') as f: trials = pkl.load(f)
+    columnar = str(tmp_path / 'columnar')
+    write_results(trials, columnar)
+    assert [info['loss'] for info in get_best_info(trials, nbest=3)]==[-2., -1.]
+    for infile in [inputfile, columnar]:
+        infos = merge_best_info([infile], nbest=3)
+        assert [info['loss'] for info in infos]==[-2., -1.]
+        assert [info['config'] for info in infos]==[{'x_min': [0.2]}, {'x_min': [0.3]}]
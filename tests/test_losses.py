@@ -0,0 +1,68 @@
+# tests for the loss calculation in run_hyperopt.py
+
+# imports
+import numpy as np
+import pytest
+
+# local imports
+from run_hyperopt import calculate_loss, calculate_loss_batch, scan_batch
+from lattice import LatticeEngine, get_grid_lattices
+from sortedindex import SortedIndexEngine
+
+
+@pytest.mark.parametrize('lossfunction', ['s/b', 's/sqrt(b)', 's/sqrt(s+b)'])
+@pytest.mark.parametrize('weighted', [False, True])
+@pytest.mark.parametrize('engine', [None, 'sorted'])
+def test_batch_matches_single( events, lossfunction, weighted, engine ):
+    ### calculate_loss_batch gives the same results as calculate_loss for each configuration
+    columns = events['columns']
+    sig_mask = events['sig_mask']
+    weights = events['weights'] if weighted else None
+    if engine=='sorted': engine = SortedIndexEngine(columns, sig_mask, weights=weights)
+    cutnames = list(columns.keys())
+    rng = np.random.default_rng(2)
+    thresholds = np.stack([rng.uniform(0., 1., 50), rng.uniform(0.3, 1., 50),
+                           rng.uniform(0., 3., 50)], axis=1)
+    batch = calculate_loss_batch(columns, cutnames, thresholds, sig_mask=sig_mask,
+              lossfunction=lossfunction, engine=engine, weights=weights, chunksize=300)
+    for idx, row in enumerate(thresholds):
+        cuts = {cutname: float(value) for cutname, value in zip(cutnames, row)}
+        result = calculate_loss(columns, cuts, sig_mask=sig_mask, lossfunction=lossfunction,
+                   iteration=[0], engine=engine, weights=weights)
+        assert batch['extra_info']['nsig_pass'][idx]==result['extra_info']['nsig_pass']
+        assert batch['extra_info']['nbkg_pass'][idx]==result['extra_info']['nbkg_pass']
+        assert batch['loss'][idx]==pytest.approx(result['loss'], rel=1e-9)
+
+@pytest.mark.parametrize('weighted', [False, True])
+def test_scan_batch_matches_lattice( events, weighted ):
+    ### scan_batch finds the same best configurations as the lattice engine
+    columns = events['columns']
+    sig_mask = events['sig_mask']
+    weights = events['weights'] if weighted else None
+    lattices = get_grid_lattices(events['grid'])
+    engine = LatticeEngine(columns, sig_mask, lattices, weights=weights)
+    expected = [engine.get_config(index) for index in engine.get_best(nbest=20)]
+    points = scan_batch(columns, lattices, sig_mask=sig_mask, nbest=20,
+               nconfigs=100, weights=weights)
+    # note: configurations with equal losses (e.g. without passing background) can be
+    #       in a different order, so the losses are compared
+    losses = [calculate_loss(columns, cuts, sig_mask=sig_mask, iteration=[0],
+                weights=weights)['loss'] for cuts in points+expected]
+    assert losses[:20]==pytest.approx(losses[20:], rel=1e-6)
+    assert losses[:20]==sorted(losses[:20])
+
+@pytest.mark.parametrize('weighted', [False, True])
+def test_timing_reports_mask_building( events, weighted ):
+    ### the time spent on building masks is reported separately, also with the mask engine
+    from maskengine import MaskEngine
+    columns = events['columns']
+    sig_mask = events['sig_mask']
+    weights = events['weights'] if weighted else None
+    cuts = {'x_min': 0.5, 'y_max': 1.}
+    for engine in [None, MaskEngine(columns, sig_mask, weights=weights)]:
+        result = calculate_loss(columns, cuts, sig_mask=sig_mask, iteration=[0],
+                   engine=engine, weights=weights, timing=True)
+        timing = result['timing']
+        assert set(timing.keys())=={'select', 'count', 'loss', 'total'}
+        assert timing['select']>0 and timing['count']>=0
+        assert timing['select']+timing['count']+timing['loss']==pytest.approx(timing['total'])
@@ -0,0 +1,34 @@
+# tests for the multi-fidelity (successive halving) mode in tools/multifidelity.py
+
+# imports
+import numpy as np
+from functools import partial
+from hyperopt import tpe, Trials
+
+# local imports
+from run_hyperopt import calculate_loss
+from resultcache import ResultCache
+from multifidelity import get_fractions, get_subsample_indices, make_subsample, fmin_halving
+
+
+def test_fidelity_does_not_leak_into_result_cache( events ):
+    ### the fidelity is added to the trials, but not to the results in the result cache
+    columns = events['columns']
+    sig_mask = events['sig_mask']
+    cache = ResultCache(inputkey='key')
+    fractions = get_fractions(2, eta=3)
+    fns = []
+    for indices in get_subsample_indices(sig_mask, fractions, seed=1):
+        sub = make_subsample(columns, sig_mask, indices)
+        fns.append(partial(calculate_loss, sub['columns'], sig_mask=sub['sig_mask'],
+                           iteration=[0], resultcache=cache if indices is None else None,
+                           scale=sub['scale']))
+    trials = Trials()
+    fmin_halving(fns, fractions, events['grid'], tpe.suggest, 18, trials,
+                 rstate=np.random.default_rng(1), show_progressbar=False)
+    fidelities = [trial['result']['extra_info']['fidelity'] for trial in trials.trials]
+    assert sorted(set(fidelities))==fractions
+    assert len(cache.results)>0
+    for result in cache.results.values():
+        assert 'fidelity' not in result['extra_info']
+        assert 'fidelity_losses' not in result
@@ -0,0 +1,27 @@
+# tests for the running best and the quantile bands in plot_loss.py
+
+# imports
+import warnings
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+
+# local imports
+from plot_loss import get_running_best, plotbands
+
+
+def test_running_best_skips_missing_losses():
+    ### the running best is missing up to the first valid loss, and ignores later missing ones
+    best = get_running_best([np.nan, np.nan, 3., np.nan, 1., 2.])
+    assert np.all(np.isnan(best[:2]))
+    assert list(best[2:])==[3., 3., 1., 1.]
+
+def test_bands_without_warnings():
+    ### the bands are built only from valid losses
+    losses = [get_running_best([np.nan, 2., 1.]), get_running_best([np.nan, np.nan, 3., 0.])]
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        (fig, ax) = plotbands(losses, nbins=10)
+    (x, median) = ax.get_lines()[0].get_data()
+    assert list(x)==[1, 2, 3]
+    assert list(median)==[2., 2., 0.]
@@ -0,0 +1,62 @@
+# tests for the skipping of up-to-date outputs in preprocess.py
+
+# imports
+import os
+import numpy as np
+import awkward as ak
+import uproot
+
+# local imports
+from preprocess import extend_tree, get_outputfiles, process_file, process_merge
+
+
+config = [
+  {'category': 'sig', 'branch': 'Cand_match', 'anymatch': True},
+  {'category': 'bkg', 'branch': 'Cand_match', 'anymatch': False},
+]
+
+def make_input_file( path ):
+    ### write a small input file with a jagged candidate collection
+    rng = np.random.default_rng(1)
+    counts = rng.integers(0, 3, 100)
+    pt = ak.unflatten(rng.uniform(0., 10., counts.sum()).astype(np.float32), counts)
+    match = ak.unflatten(rng.random(counts.sum()) < 0.3, counts)
+    with uproot.recreate(path) as f:
+        extend_tree(f, 'Events', {'Cand': ak.zip({'pt': pt, 'match': match}),
+                                  'run': ak.Array(np.ones(100, dtype=np.int32))})
+    return str(path)
+
+def test_outputs_are_redone_for_other_settings( tmp_path ):
+    ### outputs are only skipped if they were written with the same settings
+    inputfile = make_input_file(tmp_path / 'input.root')
+    outputfiles = get_outputfiles(inputfile, str(tmp_path / 'out'), config)
+    (counts, skipped, _) = process_file(inputfile, 'Events', outputfiles, config)
+    assert not skipped
+    assert sum(counts.values())==100
+    (_, skipped, _) = process_file(inputfile, 'Events', outputfiles, config, compression='zlib')
+    assert skipped
+    (_, skipped, _) = process_file(inputfile, 'Events', outputfiles, config, compression='LZ4:1')
+    assert not skipped
+    (counts, skipped, _) = process_file(inputfile, 'Events', outputfiles, config,
+                             compression='LZ4:1', branches=['Cand_*'])
+    assert not skipped
+    with uproot.open(outputfiles['sig']) as f:
+        assert 'run' not in f['Events'].keys()
+    newconfig = [dict(category, anymatch=not category['anymatch']) for category in config]
+    (_, skipped, _) = process_file(inputfile, 'Events', outputfiles, newconfig,
+                        compression='LZ4:1', branches=['Cand_*'])
+    assert not skipped
+
+def test_merged_output_is_redone_for_other_inputs( tmp_path ):
+    ### a merged output is not skipped if the set of input files changes
+    inputfiles = [make_input_file(tmp_path / 'input{}.root'.format(idx)) for idx in range(2)]
+    outputfile = str(tmp_path / 'merged.root')
+    (count, skipped, _) = process_merge(inputfiles[:1], 'Events', outputfile)
+    assert (count, skipped)==(100, False)
+    (count, skipped, _) = process_merge(inputfiles[:1], 'Events', outputfile)
+    assert (count, skipped)==(100, True)
+    (count, skipped, _) = process_merge(inputfiles, 'Events', outputfile)
+    assert (count, skipped)==(200, False)
+    (count, skipped, _) = process_merge(inputfiles, 'Events', outputfile, compression='none')
+    assert (count, skipped)==(200, False)
+    assert os.path.exists(os.path.join(str(tmp_path), 'merged_stamp.json'))
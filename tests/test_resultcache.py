@@ -0,0 +1,26 @@
+# tests for the result cache in tools/resultcache.py
+
+# imports
+import multiprocessing as mp
+
+# local imports
+from resultcache import ResultCache
+
+
+def save_results( cachefile, offset ):
+    ### store and save results for some configurations (in a separate process)
+    cache = ResultCache(inputkey='key', cachefile=cachefile)
+    for idx in range(20):
+        cache.put({'x_min': float(offset+idx)}, 's/b', {'loss': -float(offset+idx)})
+        cache.save()
+
+def test_concurrent_saves_are_merged( tmp_path ):
+    ### results saved by concurrent jobs sharing a cache file are all kept
+    cachefile = str(tmp_path / 'results.pkl')
+    processes = [mp.Process(target=save_results, args=(cachefile, offset))
+                 for offset in [0, 100, 200]]
+    for process in processes: process.start()
+    for process in processes: process.join()
+    cache = ResultCache(inputkey='key', cachefile=cachefile)
+    assert cache.nloaded==60
+    assert cache.get({'x_min': 105.}, 's/b')['loss']==-105.
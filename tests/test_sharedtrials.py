@@ -0,0 +1,125 @@
+# tests for shared studies in tools/sharedtrials.py and the tracking of finished trials
+
+# imports
+import json
+import time
+import multiprocessing as mp
+import pytest
+from hyperopt import hp, tpe, STATUS_OK, STATUS_FAIL, Trials
+from hyperopt.base import JOB_STATE_DONE, JOB_STATE_RUNNING, JOB_STATE_ERROR
+
+# local imports
+from sharedtrials import TrialStore, fmin_shared
+from trialtracker import TrialTracker
+from earlystop import EarlyStopper
+from profiling import TrialProfiler
+
+
+space = {'x_min': hp.quniform('x_min', 0., 1., 0.01)}
+
+def objective( config ):
+    ### cheap loss function, slow enough for the jobs to interleave
+    time.sleep(0.01)
+    return {'loss': (config['x_min']-0.3)**2, 'status': STATUS_OK, 'extra_info': {}}
+
+def run_job( dbfile, progressfile, max_evals ):
+    ### run one job of the study (in a separate process)
+    store = TrialStore(dbfile, 'test')
+    profiler = TrialProfiler(progressfile=progressfile)
+    stopper = EarlyStopper()
+    def early_stop_fn( trials, *args ):
+        profiler(trials)
+        return stopper(trials)
+    trials = fmin_shared(objective, space, tpe.suggest, max_evals, store,
+                         show_progressbar=False, early_stop_fn=early_stop_fn)
+    # wait for the trials of the other job
+    while store.count().get(JOB_STATE_DONE, 0)<max_evals:
+        time.sleep(0.05)
+        store.sync()
+    early_stop_fn(trials)
+    profiler.close()
+    store.close()
+
+def make_docs( trials, tids, state ):
+    ### make trial documents with a given state
+    docs = []
+    for tid in tids:
+        misc = {'tid': tid, 'cmd': None, 'workdir': None,
+                'idxs': {'x_min': [tid]}, 'vals': {'x_min': [0.1*tid]}}
+        result = {'loss': float(tid), 'status': STATUS_OK}
+        doc = trials.new_trial_docs([tid], [None], [result], [misc])[0]
+        doc['state'] = state
+        docs.append(doc)
+    return docs
+
+def test_tracker_returns_each_finished_trial_once():
+    ### trials are returned once, when finished, also if inserted before earlier ones
+    trials = Trials()
+    tracker = TrialTracker()
+    docs = make_docs(trials, [0, 1, 3], JOB_STATE_DONE)
+    docs[1]['state'] = JOB_STATE_RUNNING
+    trials._dynamic_trials[:] = docs
+    trials.refresh()
+    assert [trial['tid'] for trial in tracker.get_new(trials)]==[0, 3]
+    assert tracker.get_new(trials)==[]
+    # a trial of another job is inserted (sorted by id) and the running one finishes
+    docs[1]['state'] = JOB_STATE_DONE
+    trials._dynamic_trials[:] = docs[:2] + make_docs(trials, [2], JOB_STATE_DONE) + docs[2:]
+    trials.refresh()
+    assert [trial['tid'] for trial in tracker.get_new(trials)]==[1, 2]
+    assert tracker.get_new(trials)==[]
+
+def test_two_jobs_share_a_study( tmp_path ):
+    ### two jobs on the same study evaluate each trial once and both see all of them
+    dbfile = str(tmp_path / 'study.db')
+    max_evals = 20
+    TrialStore(dbfile, 'test', create=True).close()
+    progressfiles = [str(tmp_path / 'progress{}.jsonl'.format(idx)) for idx in range(2)]
+    processes = [mp.Process(target=run_job, args=(dbfile, progressfile, max_evals))
+                 for progressfile in progressfiles]
+    for process in processes: process.start()
+    for process in processes: process.join()
+    assert all([process.exitcode==0 for process in processes])
+    store = TrialStore(dbfile, 'test')
+    store.sync()
+    tids = [trial['tid'] for trial in store.trials.trials]
+    assert sorted(tids)==list(range(max_evals))
+    assert store.count()=={JOB_STATE_DONE: max_evals}
+    owners = set([trial['owner'] for trial in store.trials.trials])
+    assert len(owners)==2
+    best = min(store.trials.losses())
+    for progressfile in progressfiles:
+        with open(progressfile, 'r') as f: lines = [json.loads(line) for line in f]
+        assert sorted([line['tid'] for line in lines])==list(range(max_evals))
+        assert [line['ndone'] for line in lines]==list(range(1, max_evals+1))
+        assert lines[-1]['best']==best
+    store.close()
+
+def test_failed_trial_is_marked_in_study( tmp_path ):
+    ### a trial whose evaluation raises is stored as failed instead of running
+    dbfile = str(tmp_path / 'study.db')
+    store = TrialStore(dbfile, 'test', create=True)
+    def failing( config ): raise ValueError('evaluation failed')
+    with pytest.raises(ValueError):
+        fmin_shared(failing, space, tpe.suggest, 5, store, show_progressbar=False)
+    other = TrialStore(dbfile, 'test')
+    other.sync()
+    assert other.count()=={JOB_STATE_ERROR: 1}
+    # note: hyperopt does not list failed trials in Trials.trials
+    doc = other.trials._dynamic_trials[0]
+    assert doc['result']['status']==STATUS_FAIL
+    assert 'evaluation failed' in doc['misc']['error'][1]
+    for s in [store, other]: s.close()
+
+def test_jobs_on_other_hosts_get_other_suggestions( tmp_path, monkeypatch ):
+    ### jobs with the same seed and process id but on different hosts make different suggestions
+    monkeypatch.setenv('HYPEROPT_FMIN_SEED', '1')
+    dbfile = str(tmp_path / 'study.db')
+    configs = []
+    for host in ['node1', 'node2']:
+        store = TrialStore(dbfile, host, create=True)
+        store.owner = '{}:1234'.format(host)
+        trials = fmin_shared(objective, space, tpe.suggest, 3, store, show_progressbar=False)
+        configs.append([trial['misc']['vals']['x_min'][0] for trial in trials.trials])
+        store.close()
+    assert configs[0]!=configs[1]
@@ -0,0 +1,234 @@
+###################################################################
+# Count passing events with a compiled per-candidate selection    #
+###################################################################
+# By default, jagged variables (e.g. DsMeson_mass) are reduced to one value per event
+# independently for each cut (the minimum for a min cut and the maximum for a max cut),
+# so an event can pass because one candidate passes one cut and another candidate another cut.
+# With candidate semantics, all cuts on variables of the same collection (e.g. DsMeson_*)
+# are applied to each candidate, and an event passes if at least one candidate passes all of them
+# (and, if there are cuts on multiple collections, for each collection separately).
+# The selection works on the flattened content and the offsets of each collection,
+# and is done in a single compiled (numba) loop over the events that stops at the first
+# passing candidate, without building intermediate masks.
+# The same engine can also be used with per-variable semantics (i.e. on the reduced columns only),
+# in which case it gives identical results to cuttools.pass_selection.
+
+
+# imports
+import numpy as np
+import numba
+
+# local imports
+from cuttools import parse_cutname
+from sortedindex import cast_cutvalue
+
+
+@numba.njit(nogil=True, cache=True)
+def count_kernel( flatvalues, flatlow, flathigh, flathasmin, flathasmax,
+                  offsets, content, rowbase, rowstart, active, low, high, hasmin, hasmax,
+                  sig_mask, weights ):
+    ### count the passing (weighted) signal and background events
+    # input arguments:
+    # - flatvalues: 2D array (cuts x events) of values with one value per event
+    # - flatlow, flathigh, flathasmin, flathasmax: cut values and flags for each row of flatvalues
+    # - offsets: 2D array (collections x (events+1)) with the candidate offsets of each collection
+    # - content: 1D array with the candidate values of all variables of all collections
+    # - rowbase: index in content of the first candidate for each variable
+    # - rowstart: index of the first variable of each collection (length: collections+1)
+    # - active: boolean array with for each collection whether there is any cut on it
+    #           (collections without cuts do not need any candidate)
+    # - low, high, hasmin, hasmax: cut values and flags for each variable
+    # - sig_mask: boolean array with one value per event
+    # - weights: array with one weight per event, or an empty array for no weights
+    # returns:
+    # a tuple of the form (nsig_pass, nbkg_pass, wsig_pass, wbkg_pass)
+    nsig = 0
+    nbkg = 0
+    wsig = 0.
+    wbkg = 0.
+    useweights = weights.shape[0]>0
+    for i in range(sig_mask.shape[0]):
+        passed = True
+        # cuts on variables with one value per event
+        for r in range(flatvalues.shape[0]):
+            value = flatvalues[r, i]
+            if( flathasmin[r] and not (value > flatlow[r]) ):
+                passed = False
+                break
+            if( flathasmax[r] and not (value < flathigh[r]) ):
+                passed = False
+                break
+        if not passed: continue
+        # cuts on candidates, at least one candidate per collection must pass all of them
+        for g in range(offsets.shape[0]):
+            if not active[g]: continue
+            found = False
+            for j in range(offsets[g, i], offsets[g, i+1]):
+                candpassed = True
+                for k in range(rowstart[g], rowstart[g+1]):
+                    value = content[rowbase[k]+j]
+                    if( hasmin[k] and not (value > low[k]) ):
+                        candpassed = False
+                        break
+                    if( hasmax[k] and not (value < high[k]) ):
+                        candpassed = False
+                        break
+                if candpassed:
+                    found = True
+                    break
+            if not found:
+                passed = False
+                break
+        if not passed: continue
+        if sig_mask[i]:
+            nsig += 1
+            if useweights: wsig += weights[i]
+        else:
+            nbkg += 1
+            if useweights: wbkg += weights[i]
+    return (nsig, nbkg, wsig, wbkg)
+
+
+def select_events( candidates, indices ):
+    ### select a subset of the events in a set of candidate collections
+    # input arguments:
+    # - candidates: dict as obtained from make_input_file.make_candidate_columns
+    # - indices: array of event indices to keep
+    indices = np.asarray(indices)
+    res = {}
+    for collection, data in candidates.items():
+        offsets = data['offsets']
+        counts = np.diff(offsets)[indices]
+        newoffsets = np.zeros(len(indices)+1, dtype=np.int64)
+        np.cumsum(counts, out=newoffsets[1:])
+        candidx = np.repeat(offsets[:-1][indices] - newoffsets[:-1], counts) + np.arange(newoffsets[-1])
+        res[collection] = {'offsets': newoffsets,
+                           'values': {varname: values[candidx] for varname, values in data['values'].items()}}
+    return res
+
+
+class CandidateEngine(object):
+
+    def __init__( self, columns, sig_mask, candidates=None, weights=None ):
+        # input arguments:
+        # - columns: dict mapping cut names to arrays with one value per event,
+        #            as obtained from cuttools.make_cut_columns
+        # - sig_mask: boolean array with one value per event
+        # - candidates: dict mapping collection names to dicts with keys offsets
+        #               (array of length number of events + 1) and values (dict mapping
+        #               variable names to flattened candidate values),
+        #               as obtained from make_input_file.make_candidate_columns;
+        #               cuts on these variables are applied per candidate,
+        #               all other cuts are applied to the (reduced) columns.
+        #               (default: per-variable semantics, i.e. only the reduced columns are used)
+        # - weights: array with one weight per event (default: no weighted yields)
+        self.sig_mask = np.asarray(sig_mask, dtype=bool)
+        nevents = len(self.sig_mask)
+        self.nsig_tot = int(np.count_nonzero(self.sig_mask))
+        self.nbkg_tot = nevents - self.nsig_tot
+        self.weights = np.zeros(0, dtype=np.float32)
+        if weights is not None:
+            self.weights = np.asarray(weights, dtype=np.float32)
+            self.wsig_tot = float(np.sum(self.weights[self.sig_mask], dtype=np.float64))
+            self.wbkg_tot = float(np.sum(self.weights[~self.sig_mask], dtype=np.float64))
+        if candidates is None: candidates = {}
+        # find the collection of each variable
+        collections = {}
+        for collection, data in candidates.items():
+            if len(data['offsets'])!=nevents+1:
+                msg = 'ERROR: collection {} has {} events'.format(collection, len(data['offsets'])-1)
+                msg += ' but the columns have {}.'.format(nevents)
+                raise Exception(msg)
+            for varname in data['values'].keys(): collections[varname] = collection
+        # split the cuts in cuts on the reduced columns and on the candidates
+        self.flatcuts = []
+        self.candvars = {}
+        for cutname in columns.keys():
+            varname = parse_cutname(cutname)[0]
+            if varname in collections:
+                self.candvars.setdefault(collections[varname], [])
+                if varname not in self.candvars[collections[varname]]:
+                    self.candvars[collections[varname]].append(varname)
+            else: self.flatcuts.append(cutname)
+        # arrange the reduced columns in one 2D array
+        flatdtype = self.get_dtype([columns[cutname].dtype for cutname in self.flatcuts])
+        self.flatdtypes = [columns[cutname].dtype for cutname in self.flatcuts]
+        self.flatvalues = np.zeros((len(self.flatcuts), nevents), dtype=flatdtype)
+        for idx, cutname in enumerate(self.flatcuts): self.flatvalues[idx] = columns[cutname]
+        self.flatindex = {cutname: idx for idx, cutname in enumerate(self.flatcuts)}
+        # arrange the candidate values of all variables in one 1D array
+        self.varnames = [varname for varnames in self.candvars.values() for varname in varnames]
+        self.vardtypes = [candidates[collections[varname]]['values'][varname].dtype
+                          for varname in self.varnames]
+        canddtype = self.get_dtype(self.vardtypes)
+        self.offsets = np.zeros((len(self.candvars), nevents+1), dtype=np.int64)
+        self.rowstart = np.zeros(len(self.candvars)+1, dtype=np.int64)
+        self.rowbase = np.zeros(len(self.varnames), dtype=np.int64)
+        parts = []
+        ntot = 0
+        for g, (collection, varnames) in enumerate(self.candvars.items()):
+            self.offsets[g] = candidates[collection]['offsets']
+            self.rowstart[g+1] = self.rowstart[g] + len(varnames)
+            for r, varname in enumerate(varnames):
+                values = candidates[collection]['values'][varname]
+                self.rowbase[self.rowstart[g]+r] = ntot
+                parts.append(np.asarray(values, dtype=canddtype))
+                ntot += len(values)
+        self.content = np.concatenate(parts) if len(parts)>0 else np.zeros(0, dtype=canddtype)
+        self.varindex = {varname: idx for idx, varname in enumerate(self.varnames)}
+
+    @staticmethod
+    def get_dtype( dtypes ):
+        ### get a common floating point type for a list of column types
+        # note: the cut values are rounded to the precision of each original column,
+        #       so comparisons in the common type give identical results.
+        if len(dtypes)==0: return np.float32
+        dtype = np.result_type(*dtypes)
+        if not np.issubdtype(dtype, np.floating): dtype = np.float64
+        return dtype
+
+    def get_cut_arrays( self, cuts ):
+        ### convert a configuration of cuts to the arrays needed by the kernel
+        nflat = len(self.flatcuts)
+        flatlow = np.zeros(nflat, dtype=self.flatvalues.dtype)
+        flathigh = np.zeros(nflat, dtype=self.flatvalues.dtype)
+        flathasmin = np.zeros(nflat, dtype=bool)
+        flathasmax = np.zeros(nflat, dtype=bool)
+        nvars = len(self.varnames)
+        low = np.zeros(nvars, dtype=self.content.dtype)
+        high = np.zeros(nvars, dtype=self.content.dtype)
+        hasmin = np.zeros(nvars, dtype=bool)
+        hasmax = np.zeros(nvars, dtype=bool)
+        for cutname, cutvalue in cuts.items():
+            (varname, cuttype) = parse_cutname(cutname)
+            if cutname in self.flatindex:
+                idx = self.flatindex[cutname]
+                cutvalue = cast_cutvalue(cutvalue, self.flatdtypes[idx])
+                if cuttype=='min': (flatlow[idx], flathasmin[idx]) = (cutvalue, True)
+                if cuttype=='max': (flathigh[idx], flathasmax[idx]) = (cutvalue, True)
+            elif varname in self.varindex:
+                idx = self.varindex[varname]
+                cutvalue = cast_cutvalue(cutvalue, self.vardtypes[idx])
+                if cuttype=='min': (low[idx], hasmin[idx]) = (cutvalue, True)
+                if cuttype=='max': (high[idx], hasmax[idx]) = (cutvalue, True)
+            else:
+                msg = 'ERROR: cut {} not found in the input columns.'.format(cutname)
+                raise Exception(msg)
+        active = np.array([np.any(hasmin[self.rowstart[g]:self.rowstart[g+1]])
+                           or np.any(hasmax[self.rowstart[g]:self.rowstart[g+1]])
+                           for g in range(len(self.candvars))], dtype=bool)
+        return (flatlow, flathigh, flathasmin, flathasmax, active, low, high, hasmin, hasmax)
+
+    def count_weighted( self, cuts ):
+        ### count the passing signal and background events and their weighted yields
+        (flatlow, flathigh, flathasmin, flathasmax,
+         active, low, high, hasmin, hasmax) = self.get_cut_arrays(cuts)
+        (nsig, nbkg, wsig, wbkg) = count_kernel(self.flatvalues, flatlow, flathigh,
+                                     flathasmin, flathasmax, self.offsets, self.content,
+                                     self.rowbase, self.rowstart, active, low, high, hasmin, hasmax,
+                                     self.sig_mask, self.weights)
+        return (int(nsig), int(nbkg), float(wsig), float(wbkg))
+
+    def count( self, cuts ):
+        ### count the passing signal and background events
+        return self.count_weighted(cuts)[:2]
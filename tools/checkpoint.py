@@ -0,0 +1,72 @@
+#####################################################
+# Periodic checkpointing of hyperopt Trials objects #
+#####################################################
+# The Trials object is written to a checkpoint file every given number of trials
+# and/or every given number of seconds, so that a run that is killed
+# (e.g. by the wall-time limit of a batch system) can be resumed from there.
+# The checkpoint is written to a temporary file first and then moved in place,
+# so an interrupted write never leaves a corrupt checkpoint.
+# The checkpoint file has the same format as the output file of run_hyperopt.py.
+
+
+# imports
+import os
+import sys
+import time
+import pickle as pkl
+from hyperopt import base
+
+
+def write_trials( trials, outputfile ):
+    ### atomically write a Trials object to a pickle file
+    tmpfile = outputfile + '.tmp{}'.format(os.getpid())
+    with open(tmpfile, 'wb') as f: pkl.dump(trials, f)
+    os.replace(tmpfile, outputfile)
+
+def load_trials( inputfile ):
+    ### load a Trials object from a checkpoint for resuming a run
+    # note: trials that were still running when the checkpoint was written
+    #       have no result, so they are removed and will be suggested again;
+    #       trials that were not started yet (e.g. pre-defined points) are kept.
+    with open(inputfile, 'rb') as f: trials = pkl.load(f)
+    keep = [trial for trial in trials._dynamic_trials
+            if trial['state'] in [base.JOB_STATE_DONE, base.JOB_STATE_NEW]]
+    nremoved = len(trials._dynamic_trials) - len(keep)
+    trials._dynamic_trials[:] = keep
+    trials.refresh()
+    return (trials, nremoved)
+
+
+class Checkpointer(object):
+
+    def __init__( self, checkpointfile, every=None, interval=None ):
+        # input arguments:
+        # - checkpointfile: file to write the checkpoints to
+        # - every: write a checkpoint every this number of trials
+        # - interval: write a checkpoint every this number of seconds
+        # note: if both every and interval are None, a checkpoint is written after each call.
+        self.checkpointfile = checkpointfile
+        self.every = every
+        self.interval = interval
+        self.lasttime = time.time()
+        self.lastcount = None
+        self.nwritten = 0
+
+    def write( self, trials ):
+        ### write a checkpoint
+        write_trials(trials, self.checkpointfile)
+        self.lasttime = time.time()
+        self.lastcount = len(trials.trials)
+        self.nwritten += 1
+
+    def __call__( self, trials, *args ):
+        ### write a checkpoint if needed
+        # note: same interface as the early_stop_fn argument of hyperopt.fmin,
+        #       but never requests to stop.
+        ntrials = len(trials.trials)
+        if self.lastcount is None: self.lastcount = 0
+        due = (self.every is None and self.interval is None)
+        if( self.every is not None and ntrials-self.lastcount >= self.every ): due = True
+        if( self.interval is not None and time.time()-self.lasttime >= self.interval ): due = True
+        if due: self.write(trials)
+        return (False, [])
@@ -0,0 +1,194 @@
+##################################################
+# On-disk cache of reduced per-event cut columns #
+##################################################
+# Each cached column is stored as a plain .npy file (which can be memory-mapped),
+# together with a small .json file describing its origin.
+# The cache key consists of the absolute input file path, its size and modification time,
+# the cut name (i.e. branch name and reduction type) and the number of entries read.
+# If the total size of the cache exceeds its maximum size,
+# the least recently used columns are removed.
+# Usage (standalone):
+# - python tools/columncache.py -d <cachedir> --inspect
+# - python tools/columncache.py -d <cachedir> --clear
+# - python tools/columncache.py -d <cachedir> --build -s <sigfiles> -b <bkgfiles> -g <grid.pkl>
+
+
+# imports
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+
+
+class ColumnCache(object):
+
+    def __init__( self, cachedir, maxsize=None ):
+        # input arguments:
+        # - cachedir: directory where to store the cached columns
+        #             (will be created if it does not exist yet)
+        # - maxsize: maximum total size of the cache in bytes (default: no limit)
+        self.cachedir = os.path.abspath(cachedir)
+        self.maxsize = maxsize
+        self.nhits = 0
+        self.nmisses = 0
+        if not os.path.exists(self.cachedir): os.makedirs(self.cachedir)
+
+    def get_key( self, inputfile, cutname, nentries=-1 ):
+        ### make a unique key for a given column of a given file
+        path = os.path.abspath(inputfile)
+        stat = os.stat(path)
+        keyobj = [path, stat.st_size, stat.st_mtime_ns, cutname, int(nentries)]
+        key = hashlib.sha1(json.dumps(keyobj).encode()).hexdigest()
+        info = {'inputfile': path, 'filesize': stat.st_size, 'filemtime': stat.st_mtime,
+                'cutname': cutname, 'nentries': int(nentries)}
+        return (key, info)
+
+    def get_path( self, key, ext='.npy' ):
+        ### get the path to the file for a given key
+        return os.path.join(self.cachedir, key+ext)
+
+    def get( self, inputfile, cutname, nentries=-1 ):
+        ### get a cached column as a memory-mapped array, or None if not in the cache
+        key, _ = self.get_key(inputfile, cutname, nentries=nentries)
+        path = self.get_path(key)
+        try: column = np.load(path, mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            self.nmisses += 1
+            return None
+        # update the modification time, used as last access time for eviction
+        os.utime(path)
+        self.nhits += 1
+        return column
+
+    def put( self, inputfile, cutname, column, nentries=-1 ):
+        ### store a column in the cache
+        # note: the files are first written to a temporary file and then renamed,
+        #       so concurrent jobs never see partially written columns.
+        key, info = self.get_key(inputfile, cutname, nentries=nentries)
+        info['dtype'] = str(column.dtype)
+        info['nevents'] = len(column)
+        info['created'] = time.time()
+        tmpsuffix = '.tmp{}'.format(os.getpid())
+        path = self.get_path(key)
+        with open(path+tmpsuffix, 'wb') as f: np.save(f, np.ascontiguousarray(column))
+        with open(self.get_path(key, ext='.json')+tmpsuffix, 'w') as f: json.dump(info, f)
+        os.replace(self.get_path(key, ext='.json')+tmpsuffix, self.get_path(key, ext='.json'))
+        os.replace(path+tmpsuffix, path)
+        self.evict()
+
+    def entries( self ):
+        ### get a list of all entries in the cache, sorted from least to most recently used
+        entries = []
+        for fname in os.listdir(self.cachedir):
+            if not fname.endswith('.npy'): continue
+            path = os.path.join(self.cachedir, fname)
+            # note: entries might be removed concurrently by another job
+            try:
+                stat = os.stat(path)
+                with open(os.path.splitext(path)[0]+'.json', 'r') as f: info = json.load(f)
+            except (FileNotFoundError, ValueError): continue
+            info['key'] = os.path.splitext(fname)[0]
+            info['size'] = stat.st_size
+            info['lastused'] = stat.st_mtime
+            entries.append(info)
+        entries = sorted(entries, key=lambda info: info['lastused'])
+        return entries
+
+    def size( self ):
+        ### get the total size of the cache in bytes
+        return sum([info['size'] for info in self.entries()])
+
+    def remove( self, key ):
+        ### remove an entry from the cache
+        for ext in ['.npy', '.json']:
+            try: os.remove(self.get_path(key, ext=ext))
+            except FileNotFoundError: pass
+
+    def evict( self ):
+        ### remove least recently used entries until the cache fits in its maximum size
+        if self.maxsize is None: return
+        entries = self.entries()
+        totsize = sum([info['size'] for info in entries])
+        for info in entries:
+            if totsize <= self.maxsize: break
+            self.remove(info['key'])
+            totsize -= info['size']
+
+    def clear( self ):
+        ### remove all entries from the cache
+        for fname in os.listdir(self.cachedir):
+            if( fname.endswith('.npy') or fname.endswith('.json') or '.tmp' in fname ):
+                os.remove(os.path.join(self.cachedir, fname))
+
+    def __str__( self ):
+        entries = self.entries()
+        res = 'ColumnCache( {}: {} columns, {:.1f} MB'.format(self.cachedir,
+                len(entries), sum([info['size'] for info in entries])/1e6)
+        if self.maxsize is not None: res += ' (max. {:.1f} MB)'.format(self.maxsize/1e6)
+        res += ' )'
+        return res
+
+
+if __name__=='__main__':
+
+    # read arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--cachedir', required=True)
+    parser.add_argument('--maxsize', type=float, default=None,
+      help='Maximum size of the cache in GB (default: no limit)')
+    parser.add_argument('--inspect', default=False, action='store_true')
+    parser.add_argument('--clear', default=False, action='store_true')
+    parser.add_argument('--build', default=False, action='store_true')
+    parser.add_argument('-s', '--sigfiles', default=[], nargs='+')
+    parser.add_argument('-b', '--bkgfiles', default=[], nargs='+')
+    parser.add_argument('-g', '--gridfile', default=None)
+    parser.add_argument('--nentriesperfile', type=int, default=-1)
+    parser.add_argument('--stepsize', default=None)
+    parser.add_argument('--weightbranch', default=None)
+    args = parser.parse_args()
+
+    # print arguments
+    print('Running with following configuration:')
+    for arg in vars(args): print('  - {}: {}'.format(arg,getattr(args,arg)))
+
+    # make the cache
+    maxsize = None if args.maxsize is None else int(args.maxsize*1e9)
+    cache = ColumnCache(args.cachedir, maxsize=maxsize)
+
+    # clear the cache
+    if args.clear:
+        print('Clearing {}'.format(cache))
+        cache.clear()
+
+    # fill the cache with the columns needed for a given grid
+    if args.build:
+        if args.gridfile is None:
+            raise Exception('ERROR: a grid file is needed to build the cache.')
+        import pickle as pkl
+        from make_input_file import make_input_columns
+        with open(args.gridfile,'rb') as f:
+            grid = pkl.load(f)['grid']
+        stepsize = args.stepsize
+        if( stepsize is not None and stepsize.isdigit() ): stepsize = int(stepsize)
+        columns, sig_mask, _ = make_input_columns(sigfiles=args.sigfiles,
+          bkgfiles=args.bkgfiles,
+          cutnames=list(grid.keys()),
+          nentriesperfile=args.nentriesperfile,
+          cache=cache,
+          stepsize=stepsize,
+          weightbranch=args.weightbranch)
+        print('Cached {} columns for {} events'.format(len(columns), len(sig_mask)))
+        print('(cache hits: {}, misses: {})'.format(cache.nhits, cache.nmisses))
+
+    # print the cache content
+    if args.inspect:
+        entries = cache.entries()
+        print(cache)
+        for info in entries[::-1]:
+            print('  - {}: {} [{} entries, {}, {:.1f} MB, last used {}]'.format(
+                   info.get('inputfile'), info.get('cutname'), info.get('nevents'),
+                   info.get('dtype'), info['size']/1e6,
+                   time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(info['lastused']))))
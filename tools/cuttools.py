@@ -0,0 +1,98 @@
+#############################################
+# Tools for parsing and preparing cut names #
+#############################################
+
+
+# imports
+import numpy as np
+import awkward as ak
+
+
+def parse_cutname( cutname ):
+    ### split a cut name into its variable name and cut type
+    # input arguments:
+    # - cutname: string formatted as <variable name>_<type>,
+    #            where <type> is either min or max,
+    #            and <variable name> can contain underscores for sub-variables,
+    #            e.g. MET_pt_min for a minimum cut on MET.pt
+    # returns:
+    # a tuple of the form (variable name, cut type)
+    ismax = cutname.endswith('_max')
+    ismin = cutname.endswith('_min')
+    if( not (ismax or ismin) ):
+        raise Exception('ERROR: cut {} is neither min nor max.'.format(cutname))
+    return (cutname[:-4], cutname[-3:])
+
+def get_cut_branches( cutnames, extra=None ):
+    ### get the list of branches needed to evaluate a collection of cuts
+    # input arguments:
+    # - cutnames: iterable of cut names (e.g. the keys of a hyperopt grid)
+    # - extra: list of additional branches to read (e.g. a weight branch)
+    # note: the order of first appearance is preserved and duplicates are removed
+    branches = []
+    for cutname in cutnames:
+        varname = parse_cutname(cutname)[0]
+        if varname not in branches: branches.append(varname)
+    if extra is not None:
+        for branch in extra:
+            if branch is None: continue
+            if branch not in branches: branches.append(branch)
+    return branches
+
+def to_dense_column( varvalue ):
+    ### convert a flat awkward array to a contiguous numpy array
+    # note: missing values (e.g. from taking the minimum over an empty list)
+    #       are replaced by nan, so they fail any cut comparison.
+    #       the original floating point precision is kept,
+    #       so cut comparisons give the same result as on the awkward array.
+    column = ak.to_numpy(varvalue, allow_missing=True)
+    if isinstance(column, np.ma.MaskedArray):
+        if not np.issubdtype(column.dtype, np.floating): column = column.astype(float)
+        column = np.ma.filled(column, np.nan)
+    return np.ascontiguousarray(column)
+
+def make_cut_columns( events, cutnames ):
+    ### reduce the variable of each cut to one value per event
+    # input arguments:
+    # - events: NanoAOD events array
+    # - cutnames: iterable of cut names (e.g. the keys of a hyperopt grid)
+    # returns:
+    # a dict mapping each cut name to a dense numpy array with one value per event.
+    # note: if the variable is an array instead of a single value per event,
+    #       the minimum or maximum is taken depending on the cut type.
+    #       this is done only once, so the per-trial selection is a simple comparison.
+    columns = {}
+    for cutname in cutnames:
+        varname, cuttype = parse_cutname(cutname)
+        varvalue = events[varname]
+        if(varvalue.layout.minmax_depth[0]==1): pass
+        elif(varvalue.layout.minmax_depth[0]==2):
+            if cuttype=='min': varvalue = ak.min(varvalue, axis=-1)
+            if cuttype=='max': varvalue = ak.max(varvalue, axis=-1)
+        else:
+            msg = 'ERROR: shape of value array for variable {} not recognized.'.format(varname)
+            raise Exception(msg)
+        columns[cutname] = to_dense_column(varvalue)
+    return columns
+
+def pass_selection( columns, cuts ):
+    ### get a mask for a particular configuration of cuts
+    # input arguments:
+    # - columns: dict mapping cut names to arrays with one value per event,
+    #            as obtained from make_cut_columns
+    #            (i.e. jagged variables are already reduced to their min or max)
+    # - cuts: dictionary mapping a variable name to a cut value
+    #         note: each key in the dict is supposed to be formatted
+    #               as <variable name>_<type>, where <type> is either min or max,
+    #               and <variable name> can contain underscores for sub-variables,
+    #               e.g. MET_pt for MET.pt
+    mask = np.ones(len(next(iter(columns.values()))), dtype=bool)
+    for cutname, cutvalue in cuts.items():
+        # parse cut name
+        cuttype = parse_cutname(cutname)[1]
+        # get the (reduced) variable value
+        varvalue = columns[cutname]
+        # perform the cut
+        if cuttype=='max': mask &= (varvalue < cutvalue)
+        if cuttype=='min': mask &= (varvalue > cutvalue)
+    return mask
@@ -0,0 +1,93 @@
+##########################################
+# Early stopping rules for hyperopt fmin #
+##########################################
+# The rules are checked after each evaluated trial (or batch of trials),
+# through the early_stop_fn argument of hyperopt.fmin (or parallel.fmin_parallel).
+# Each rule is optional, and the run stops as soon as any of them is satisfied:
+# - no significant improvement of the best loss during a given number of trials,
+#   where an improvement is significant if it is larger than a relative epsilon;
+# - a maximum wall-clock time;
+# - a minimum number of evaluated trials per second (averaged over recent trials),
+#   e.g. to stop when the suggestion algorithm becomes too slow for many trials.
+# The reason for stopping is kept, so that it can be reported after the run.
+# note: trials evaluated on a subsample of the events only (see tools/multifidelity.py)
+#       count as evaluated trials, but their loss is not compared to the best loss.
+
+
+# imports
+import time
+from collections import deque
+
+# local imports
+from trialtracker import TrialTracker
+
+
+class EarlyStopper(object):
+
+    def __init__( self, patience=None, epsilon=0., maxtime=None, minrate=None, ratewindow=20 ):
+        # input arguments:
+        # - patience: stop if the best loss did not improve significantly
+        #             during this number of trials (default: no limit)
+        # - epsilon: minimal relative improvement of the best loss to be considered significant
+        # - maxtime: stop after this number of seconds (default: no limit)
+        # - minrate: stop if fewer than this number of trials per second
+        #            were evaluated during the last ratewindow trials (default: no limit)
+        # - ratewindow: number of trials over which to average the rate
+        self.patience = patience
+        self.epsilon = epsilon
+        self.maxtime = maxtime
+        self.minrate = minrate
+        self.ratewindow = ratewindow
+        self.starttime = time.time()
+        self.reason = None
+        self.tracker = TrialTracker()
+        self.ndone = 0
+        self.best = None
+        self.bestidx = 0
+        self.history = deque()
+
+    def update( self, trials ):
+        ### process the trials that finished since the last call
+        # note: only the new trials are looked at (see tools/trialtracker.py),
+        #       so each call is fast also for a large number of trials.
+        for trial in self.tracker.get_new(trials):
+            loss = trial['result'].get('loss')
+            if loss is None: continue
+            self.ndone += 1
+            if trial['result'].get('extra_info', {}).get('fidelity', 1) < 1: continue
+            if( self.best is None or loss < self.best - abs(self.best)*self.epsilon ):
+                self.best = loss
+                self.bestidx = self.ndone
+        self.history.append((self.ndone, time.time()))
+        while( len(self.history)>1 and self.history[1][0] <= self.ndone-self.ratewindow ):
+            self.history.popleft()
+
+    def check( self ):
+        ### check the stopping rules
+        # returns:
+        # the reason for stopping (as a string), or None if the run should continue
+        if( self.patience is not None and self.ndone-self.bestidx >= self.patience ):
+            msg = 'no improvement of the best loss ({})'.format(self.best)
+            if self.epsilon>0: msg += ' by more than {:.3g} (relative)'.format(self.epsilon)
+            msg += ' during the last {} trials'.format(self.ndone-self.bestidx)
+            return msg
+        elapsed = time.time() - self.starttime
+        if( self.maxtime is not None and elapsed >= self.maxtime ):
+            return 'time limit of {} s reached ({:.1f} s elapsed)'.format(self.maxtime, elapsed)
+        if( self.minrate is not None and len(self.history)>1 ):
+            (n0, t0) = self.history[0]
+            (n1, t1) = self.history[-1]
+            if( n1-n0 >= self.ratewindow and t1>t0 ):
+                rate = (n1-n0)/(t1-t0)
+                if rate < self.minrate:
+                    msg = 'trial rate of {:.3g} trials/s'.format(rate)
+                    msg += ' over the last {} trials is below {} trials/s'.format(n1-n0, self.minrate)
+                    return msg
+        return None
+
+    def __call__( self, trials, *args ):
+        ### interface for the early_stop_fn argument of hyperopt.fmin
+        # note: the state is kept in this object, so no extra arguments are passed around.
+        self.update(trials)
+        self.reason = self.check()
+        return (self.reason is not None, [])
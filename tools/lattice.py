@@ -0,0 +1,198 @@
+##############################################################
+# Count passing events using a histogram on the grid lattice #
+##############################################################
+# For grids where each cut value is drawn from a quniform distribution,
+# the only possible cut values are the points of a fixed lattice.
+# Each event can then be assigned once to a cell of this lattice,
+# and the signal and background counts are stored in N-dimensional histograms.
+# These histograms are accumulated along each axis in the direction of the cut
+# (i.e. upwards for max cuts and downwards for min cuts), so that the number of
+# events passing any configuration of cuts on the lattice is a single table lookup,
+# independent of the number of events.
+# Since the table contains the passing counts for all configurations at once,
+# it can also be used for an exhaustive scan of the full grid.
+# Weighted yields are stored in the same way, in tables filled with the event weights.
+
+
+# imports
+import numpy as np
+
+# local imports
+from cuttools import parse_cutname, pass_selection
+from sortedindex import cast_cutvalue
+from losstools import get_losses
+
+
+def get_lattice( expr ):
+    ### get the lattice of possible values for a hyperopt search space expression
+    # input arguments:
+    # - expr: a hyperopt expression, e.g. as obtained from hp.quniform
+    # returns:
+    # a sorted array of all possible values,
+    # or None if the expression is not a quniform with fixed arguments.
+    # note: hyperopt (both random sampling and tpe) draws values in [low, high]
+    #       and then rounds them as np.round(value/q)*q,
+    #       which is reproduced here to get the exact same floating point values.
+    node = expr
+    if node.name=='float': node = node.pos_args[0]
+    if node.name=='hyperopt_param': node = node.pos_args[1]
+    if node.name!='quniform': return None
+    args = [getattr(node.arg[key], 'obj', None) for key in ['low', 'high', 'q']]
+    if None in args: return None
+    (low, high, q) = args
+    kvalues = np.arange(np.round(low/q), np.round(high/q)+1)
+    return kvalues * q
+
+def get_grid_lattices( grid ):
+    ### get the lattices for all cuts in a hyperopt grid
+    # returns:
+    # a dict mapping cut names to lattices, or None if any of the cuts has no lattice
+    lattices = {}
+    for cutname, expr in grid.items():
+        lattice = get_lattice(expr)
+        if lattice is None: return None
+        lattices[cutname] = lattice
+    return lattices
+
+
+class LatticeEngine(object):
+
+    def __init__( self, columns, sig_mask, lattices, weights=None ):
+        # input arguments:
+        # - columns: dict mapping cut names to arrays with one value per event,
+        #            as obtained from cuttools.make_cut_columns
+        # - sig_mask: boolean array with one value per event
+        # - lattices: dict mapping cut names to lattices,
+        #             as obtained from get_grid_lattices
+        # - weights: array with one weight per event (default: no weighted yields)
+        self.columns = columns
+        self.sig_mask = np.asarray(sig_mask, dtype=bool)
+        self.nsig_tot = int(np.count_nonzero(self.sig_mask))
+        self.nbkg_tot = len(self.sig_mask) - self.nsig_tot
+        self.weights = None
+        if weights is not None:
+            self.weights = np.asarray(weights, dtype=np.float32)
+            self.wsig_tot = float(np.sum(self.weights[self.sig_mask], dtype=np.float64))
+            self.wbkg_tot = float(np.sum(self.weights[~self.sig_mask], dtype=np.float64))
+        self.cutnames = list(lattices.keys())
+        self.lattices = [np.asarray(lattices[cutname], dtype=np.float64) for cutname in self.cutnames]
+        self.cuttypes = [parse_cutname(cutname)[1] for cutname in self.cutnames]
+        self.shape = tuple([len(lattice) for lattice in self.lattices])
+        self.nfallback = 0
+
+        # assign each event to a cell of the lattice
+        # note: the cell index along each axis is the number of lattice points
+        #       below the value (for min cuts) or not above the value (for max cuts),
+        #       so an event passes a cut at lattice point j if its index is > j
+        #       (for min cuts) or <= j (for max cuts).
+        #       events with a nan value are put in the cell that fails all cuts.
+        binindices = []
+        self.points = []
+        for cutname, cuttype, lattice in zip(self.cutnames, self.cuttypes, self.lattices):
+            column = columns[cutname]
+            # note: hyperopt passes quniform values to the objective function
+            #       as python floats, so use the same type for the comparison precision.
+            points = np.array([cast_cutvalue(float(point), column.dtype) for point in lattice])
+            self.points.append(points)
+            values = column.astype(np.float64)
+            if cuttype=='min':
+                indices = np.searchsorted(points, values, side='left')
+                indices[np.isnan(values)] = 0
+            else: indices = np.searchsorted(points, values, side='right')
+            binindices.append(indices)
+        histshape = tuple([n+1 for n in self.shape])
+        flatindices = np.ravel_multi_index(binindices, histshape)
+        del binindices
+        self.sigtable = self.make_table(flatindices[self.sig_mask], histshape)
+        self.bkgtable = self.make_table(flatindices[~self.sig_mask], histshape)
+        if self.weights is not None:
+            self.sigwtable = self.make_table(flatindices[self.sig_mask], histshape,
+                               weights=self.weights[self.sig_mask])
+            self.bkgwtable = self.make_table(flatindices[~self.sig_mask], histshape,
+                               weights=self.weights[~self.sig_mask])
+
+    @staticmethod
+    def get_size( lattices, weighted=False ):
+        ### estimate the (peak) memory needed for the tables in bytes
+        ncells = 1
+        for lattice in lattices.values(): ncells *= (len(lattice)+1)
+        if weighted: return 6*8*ncells
+        return 4*8*ncells
+
+    def make_table( self, flatindices, histshape, weights=None ):
+        ### make a table of passing counts (or summed weights) for each configuration on the lattice
+        table = np.bincount(flatindices, weights=weights, minlength=int(np.prod(histshape)))
+        table = table.reshape(histshape)
+        for axis, cuttype in enumerate(self.cuttypes):
+            if cuttype=='min':
+                table = np.flip(np.cumsum(np.flip(table, axis=axis), axis=axis), axis=axis)
+                table = np.delete(table, 0, axis=axis)
+            else:
+                table = np.cumsum(table, axis=axis)
+                table = np.delete(table, -1, axis=axis)
+        return np.ascontiguousarray(table)
+
+    def get_index( self, cuts ):
+        ### get the lattice index of a configuration of cuts, or None if not on the lattice
+        # note: a cut value is considered to be on the lattice if it gives
+        #       the same comparison with the column values as a lattice point.
+        if len(cuts)!=len(self.cutnames): return None
+        index = []
+        for cutname, points in zip(self.cutnames, self.points):
+            if cutname not in cuts: return None
+            cutvalue = cast_cutvalue(cuts[cutname], self.columns[cutname].dtype)
+            j = int(np.searchsorted(points, cutvalue))
+            if( j>=len(points) or points[j]!=cutvalue ): return None
+            index.append(j)
+        return tuple(index)
+
+    def get_config( self, index ):
+        ### get the configuration of cuts corresponding to a lattice index
+        return {cutname: float(lattice[j]) for cutname, lattice, j in zip(self.cutnames, self.lattices, index)}
+
+    def count( self, cuts ):
+        ### get the number of passing signal and background events
+        # returns:
+        # a tuple of the form (nsig_pass, nbkg_pass)
+        # note: configurations that are not on the lattice are evaluated with a mask.
+        index = self.get_index(cuts)
+        if index is None:
+            self.nfallback += 1
+            sel_mask = pass_selection(self.columns, cuts)
+            nsig_pass = int(np.count_nonzero(sel_mask & self.sig_mask))
+            return (nsig_pass, int(np.count_nonzero(sel_mask))-nsig_pass)
+        return (int(self.sigtable[index]), int(self.bkgtable[index]))
+
+    def count_weighted( self, cuts ):
+        ### get the number and the weighted yield of passing signal and background events
+        # returns:
+        # a tuple of the form (nsig_pass, nbkg_pass, wsig_pass, wbkg_pass)
+        index = self.get_index(cuts)
+        if index is None:
+            self.nfallback += 1
+            sel_mask = pass_selection(self.columns, cuts)
+            sigsel = sel_mask & self.sig_mask
+            bkgsel = sel_mask & ~self.sig_mask
+            return (int(np.count_nonzero(sigsel)), int(np.count_nonzero(bkgsel)),
+                    float(np.sum(self.weights[sigsel], dtype=np.float64)),
+                    float(np.sum(self.weights[bkgsel], dtype=np.float64)))
+        return (int(self.sigtable[index]), int(self.bkgtable[index]),
+                float(self.sigwtable[index]), float(self.bkgwtable[index]))
+
+    def scan( self, lossfunction='s/b' ):
+        ### calculate the loss function for all configurations on the lattice
+        # returns:
+        # an array of losses with one axis per cut
+        # note: if weights were given, the loss is calculated from the weighted yields.
+        if self.weights is not None:
+            return get_losses(self.sigwtable, self.bkgwtable, lossfunction=lossfunction)
+        return get_losses(self.sigtable, self.bkgtable, lossfunction=lossfunction)
+
+    def get_best( self, lossfunction='s/b', nbest=1 ):
+        ### get the lattice indices of the lowest-loss configurations
+        # note: the indices are sorted from lower to higher loss value
+        losses = self.scan(lossfunction=lossfunction).ravel()
+        nbest = min(nbest, len(losses))
+        best = np.argpartition(losses, nbest-1)[:nbest]
+        best = best[np.argsort(losses[best], kind='stable')]
+        return [tuple([int(j) for j in np.unravel_index(idx, self.shape)]) for idx in best]
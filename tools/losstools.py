@@ -0,0 +1,30 @@
+#########################################################
+# Vectorized loss functions for many cut configurations #
+#########################################################
+
+
+# imports
+import numpy as np
+
+
+def get_losses( nsig_pass, nbkg_pass, lossfunction='s/b' ):
+    ### calculate the loss function for arrays of passing event counts
+    # input arguments:
+    # - nsig_pass, nbkg_pass: arrays (of any shape) of passing signal and background counts
+    # - lossfunction: name of the loss function (see run_hyperopt.calculate_loss)
+    # returns:
+    # an array of the same shape as the inputs, with values identical to
+    # the ones calculated one by one in run_hyperopt.calculate_loss.
+    nsig = np.asarray(nsig_pass, dtype=float)
+    nbkg = np.asarray(nbkg_pass, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if lossfunction=='s/b':
+            loss = np.where(nbkg==0, 0., -nsig / nbkg)
+        elif lossfunction=='s/sqrt(b)':
+            loss = np.where(nbkg==0, 0., -nsig / np.sqrt(nbkg))
+        elif lossfunction=='s/sqrt(s+b)':
+            loss = np.where((nsig==0) & (nbkg==0), 0., -nsig / np.sqrt(nsig + nbkg))
+        else:
+            msg = 'ERROR: loss function {} not recognized.'.format(lossfunction)
+            raise Exception(msg)
+    return loss
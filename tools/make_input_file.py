@@ -6,17 +6,45 @@
 # imports
 import os
 import sys
+import time
 import argparse
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 import awkward as ak
-from coffea.nanoevents import NanoEventsFactory, NanoAODSchema
 import uproot
 
+# local imports
+from cuttools import get_cut_branches, make_cut_columns
+
+
+def check_branches( tree, branches, inputfile=None ):
+    ### check that all requested branches are present in a tree
+    # note: raise an exception listing all missing branches,
+    #       before any (slow) reading or decompression is done.
+    available = set(tree.keys())
+    missing = [branch for branch in branches if branch not in available]
+    if len(missing)>0:
+        msg = 'ERROR: the following branches were requested'
+        msg += ' but not found in file {}: {}'.format(inputfile, missing)
+        raise Exception(msg)
+
 
 def make_input_file(
     sigfiles=[],
     bkgfiles=[],
     nentriesperfile=-1,
-    sigvar='isSignal'):
+    sigvar='isSignal',
+    branches=None):
+    # input arguments:
+    # - sigfiles, bkgfiles: lists of signal and background NanoAOD files
+    # - nentriesperfile: number of entries to read per file (default: all)
+    # - sigvar: name of the signal label field to add to the events
+    # - branches: list of branches to read (default: all branches);
+    #             use cuttools.get_cut_branches to derive them from a grid.
+    #             note: the signal label is derived from the input file lists,
+    #                   so sigvar does not need to be a branch in the files.
 
     # loop over input files
     issignal = [True] * len(sigfiles) + [False] * len(bkgfiles)
@@ -25,13 +53,339 @@ def make_input_file(
 
         #load the tree
         tree = uproot.open(f"{inputfile}:Events")
-        #load all branches, optionally limit number of entries. 
+        if branches is not None: check_branches(tree, branches, inputfile=inputfile)
+        #load the requested branches (or all branches if not specified),
+        # optionally limit number of entries.
         # Note that now the fields are directly the branches.
-        events = tree.arrays(entry_stop=nentriesperfile if nentriesperfile >= 0 else None, library="ak")
+        events = tree.arrays(filter_name=branches,
+                   entry_stop=nentriesperfile if nentriesperfile >= 0 else None, library="ak")
         # Add signal label to each event
         events = ak.with_field(events, issignal[idx], where=sigvar)
         allevents.append(events)
 
     # Concatenate all signal and background events
     events = ak.concatenate(allevents)
-    return events
\ No newline at end of file
+    return events
+
+
+def get_nentries( tree, nentriesperfile=-1 ):
+    ### get the number of entries to read from a tree
+    if( nentriesperfile >= 0 ): return min(tree.num_entries, nentriesperfile)
+    return tree.num_entries
+
+
+def store_column( columns, cutname, values, start, ntotal, lock=None ):
+    ### write values into a preallocated output column
+    # input arguments:
+    # - columns: dict of output columns (modified in place)
+    # - cutname: name of the column to write to
+    # - values: numpy array of values to write
+    # - start: index of the first event to write
+    # - ntotal: total number of events (used when allocating a new column)
+    # note: the column is allocated when it is first written to,
+    #       and converted to a wider type if needed (e.g. an integer variable
+    #       that becomes float because of missing values in some of the events).
+    # note: when writing from multiple threads, a shared lock must be given,
+    #       since a column may be reallocated when converting it to a wider type.
+    with (lock if lock is not None else contextlib.nullcontext()):
+        column = columns.get(cutname)
+        if column is None:
+            column = np.empty(ntotal, dtype=values.dtype)
+            columns[cutname] = column
+        dtype = np.result_type(column.dtype, values.dtype)
+        if dtype!=column.dtype:
+            column = column.astype(dtype)
+            columns[cutname] = column
+        column[start:start+len(values)] = values
+
+
+def read_columns(
+    inputfile,
+    cutnames,
+    columns,
+    start,
+    ntotal,
+    nentriesperfile=-1,
+    stepsize=None,
+    lock=None,
+    executor=None,
+    weightbranch=None):
+    ### read and reduce the columns for a set of cuts from a single file
+    # input arguments:
+    # - inputfile: NanoAOD file to read
+    # - cutnames: list of cut names to read
+    # - columns, start, ntotal, lock: see store_column
+    # - nentriesperfile: see make_input_file
+    # - stepsize: if specified, read the file in chunks of this size
+    #             (either a number of entries or a string like "100 MB"),
+    #             else read all entries at once.
+    # - executor: executor used by uproot for decompression and interpretation
+    #             of the baskets (default: done sequentially in the calling thread)
+    # - weightbranch: name of a (flat) branch with event weights to read as well;
+    #                 it is stored as a float32 column with the branch name as key.
+    # returns:
+    # a tuple of the form (nevents, nbytes) with the number of events read
+    # and the (compressed) size of the branches that were read.
+    branches = get_cut_branches(cutnames, extra=[weightbranch])
+    tree = uproot.open(f"{inputfile}:Events")
+    check_branches(tree, branches, inputfile=inputfile)
+    entry_stop = get_nentries(tree, nentriesperfile=nentriesperfile)
+    kwargs = {'filter_name': branches, 'entry_stop': entry_stop, 'library': 'ak',
+              'decompression_executor': executor, 'interpretation_executor': executor}
+    if stepsize is None: chunks = [tree.arrays(**kwargs)]
+    else: chunks = tree.iterate(step_size=stepsize, **kwargs)
+    nevents = 0
+    for events in chunks:
+        # reduce each chunk to the cut columns directly,
+        # so the jagged arrays of only one chunk are in memory at any time
+        for cutname, values in make_cut_columns(events, cutnames).items():
+            store_column(columns, cutname, values, start+nevents, ntotal, lock=lock)
+        if weightbranch is not None:
+            values = np.asarray(ak.to_numpy(events[weightbranch]), dtype=np.float32)
+            store_column(columns, weightbranch, values, start+nevents, ntotal, lock=lock)
+        nevents += len(events)
+    # estimate the number of bytes read from the fraction of entries
+    nbytes = sum([tree[branch].compressed_bytes for branch in branches])
+    if tree.num_entries>0: nbytes = int(nbytes * nevents / tree.num_entries)
+    return (nevents, nbytes)
+
+
+def make_input_columns(
+    sigfiles=[],
+    bkgfiles=[],
+    cutnames=[],
+    nentriesperfile=-1,
+    cache=None,
+    stepsize=None,
+    nthreads=1,
+    verbose=False,
+    weightbranch=None,
+    xsecs=None,
+    samples=None,
+    lumi=1.):
+    ### same as make_input_file, but directly return reduced cut columns
+    # input arguments:
+    # - sigfiles, bkgfiles, nentriesperfile: see make_input_file
+    # - cutnames: list of cut names (e.g. the keys of a hyperopt grid)
+    # - cache: a columncache.ColumnCache instance (default: no caching)
+    # - stepsize: see read_columns
+    # - nthreads: number of files to read concurrently;
+    #             if larger than 1, the same number of threads is also used by uproot
+    #             for the decompression and interpretation of the baskets.
+    # - verbose: print the progress and the throughput for each file
+    # - weightbranch: name of the branch with generator weights (e.g. genWeight)
+    #                 (default: all events have a generator weight of 1)
+    # - xsecs, samples, lumi: see get_event_weights
+    # returns:
+    # a tuple of the form (columns, sig_mask, weights), where columns is a dict
+    # as obtained from cuttools.make_cut_columns, sig_mask a boolean array,
+    # and weights a float32 array as obtained from get_event_weights
+    # (or None if neither a weight branch nor cross-sections are given).
+    # note: only the branches needed for columns not found in the cache are read,
+    #       so for a fully cached set of inputs no ROOT file is opened at all.
+    # note: the output arrays are allocated once for all files,
+    #       and each file (or chunk of a file) is written directly in its slice.
+    # note: decompression (zlib, lz4, zstd) and most of the numpy and awkward operations
+    #       release the GIL, so threads are used rather than processes,
+    #       which also avoids sending the columns back to the main process.
+    inputfiles = sigfiles + bkgfiles
+    issignal = [True] * len(sigfiles) + [False] * len(bkgfiles)
+    # note: the weight branch is cached in the same way as the cut columns,
+    #       with the branch name as key.
+    colnames = list(cutnames)
+    if weightbranch is not None: colnames.append(weightbranch)
+
+    # get the columns from the cache and the number of entries for each file
+    cached = []
+    nevents = []
+    for inputfile in inputfiles:
+        thiscached = {}
+        if cache is not None:
+            for colname in colnames:
+                column = cache.get(inputfile, colname, nentries=nentriesperfile)
+                if column is not None: thiscached[colname] = column
+        if len(thiscached)==len(colnames) and len(colnames)>0:
+            nevents.append(len(thiscached[colnames[0]]))
+        else:
+            tree = uproot.open(f"{inputfile}:Events")
+            nevents.append(get_nentries(tree, nentriesperfile=nentriesperfile))
+        cached.append(thiscached)
+    ntotal = sum(nevents)
+    starts = np.cumsum([0]+nevents[:-1])
+
+    # copy the columns from the cache and add the signal label to each event
+    columns = {}
+    sig_mask = np.empty(ntotal, dtype=bool)
+    tasks = []
+    for idx, inputfile in enumerate(inputfiles):
+        start = int(starts[idx])
+        for cutname, column in cached[idx].items():
+            store_column(columns, cutname, column, start, ntotal)
+        sig_mask[start:start+nevents[idx]] = issignal[idx]
+        missing = [colname for colname in colnames if colname not in cached[idx]]
+        if len(missing)>0: tasks.append((idx, missing))
+        elif verbose:
+            print('  - {}: {} events (from cache)'.format(inputfile, nevents[idx]))
+
+    # read and reduce the remaining columns from the input files
+    lock = threading.Lock()
+    executor = ThreadPoolExecutor(max_workers=nthreads) if nthreads>1 else None
+    pool = ThreadPoolExecutor(max_workers=max(1, nthreads))
+
+    def read_task( idx, missing ):
+        starttime = time.time()
+        (nread, nbytes) = read_columns(inputfiles[idx],
+                            [colname for colname in missing if colname!=weightbranch],
+                            columns, int(starts[idx]), ntotal,
+                            nentriesperfile=nentriesperfile, stepsize=stepsize,
+                            lock=lock, executor=executor,
+                            weightbranch=weightbranch if weightbranch in missing else None)
+        return (nread, nbytes, time.time()-starttime)
+
+    starttime = time.time()
+    try:
+        futures = {pool.submit(read_task, idx, missing): (idx, missing) for idx, missing in tasks}
+        for ndone, future in enumerate(as_completed(futures)):
+            (idx, missing) = futures[future]
+            (nread, nbytes, readtime) = future.result()
+            inputfile = inputfiles[idx]
+            if nread!=nevents[idx]:
+                msg = 'ERROR: expected {} entries in file {}'.format(nevents[idx], inputfile)
+                msg += ' but found {}.'.format(nread)
+                raise Exception(msg)
+            if cache is not None:
+                start = int(starts[idx])
+                for colname in missing:
+                    cache.put(inputfile, colname, columns[colname][start:start+nread],
+                              nentries=nentriesperfile)
+            if verbose:
+                readtime = max(readtime, 1e-6)
+                print('  - [{}/{}] {}: {} events, {:.1f} MB in {:.2f} s'.format(
+                       ndone+1, len(tasks), inputfile, nread, nbytes/1e6, readtime)
+                       +' ({:.1f} MB/s, {:.0f} events/s)'.format(
+                       nbytes/1e6/readtime, nread/readtime))
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+        if executor is not None: executor.shutdown(wait=True)
+    if( verbose and len(tasks)>0 ):
+        readtime = max(time.time()-starttime, 1e-6)
+        nread = sum([nevents[idx] for idx, _ in tasks])
+        print('Read {} events from {} files in {:.2f} s ({:.0f} events/s)'.format(
+               nread, len(tasks), readtime, nread/readtime))
+
+    # make the event weights
+    weights = None
+    if( weightbranch is not None or xsecs is not None ):
+        genweights = columns.pop(weightbranch) if weightbranch is not None else None
+        weights = get_event_weights(nevents, genweights=genweights,
+                    xsecs=xsecs, samples=samples, lumi=lumi)
+
+    return (columns, sig_mask, weights)
+
+
+def make_candidate_columns(
+    sigfiles=[],
+    bkgfiles=[],
+    cutnames=[],
+    nentriesperfile=-1,
+    stepsize=None):
+    ### read the jagged variables for a set of cuts as flattened candidates
+    # input arguments:
+    # - sigfiles, bkgfiles, nentriesperfile: see make_input_file
+    # - cutnames: list of cut names (e.g. the keys of a hyperopt grid)
+    # - stepsize: see read_columns
+    # returns:
+    # a dict mapping collection names (e.g. DsMeson) to dicts with keys
+    # offsets (int64 array with the index of the first candidate of each event,
+    # with length number of events + 1) and values (dict mapping variable names
+    # to flat arrays with one value per candidate).
+    # note: the events are in the same order as in make_input_columns.
+    # note: only jagged variables (i.e. branches with a counter branch) are read,
+    #       variables with one value per event are not included.
+    # note: the candidates are not reduced, so they are not stored in the column cache.
+    collections = {}
+    counts = {}
+    values = {}
+    for inputfile in sigfiles + bkgfiles:
+        tree = uproot.open(f"{inputfile}:Events")
+        branches = get_cut_branches(cutnames)
+        check_branches(tree, branches, inputfile=inputfile)
+        for branch in branches:
+            count_branch = tree[branch].count_branch
+            if count_branch is None: continue
+            collection = count_branch.name
+            if collection.startswith('n'): collection = collection[1:]
+            if collections.get(branch, collection)!=collection:
+                msg = 'ERROR: branch {} belongs to collection {}'.format(branch, collections[branch])
+                msg += ' in some files and to {} in file {}.'.format(collection, inputfile)
+                raise Exception(msg)
+            collections[branch] = collection
+        branches = [branch for branch in branches if branch in collections]
+        if len(branches)==0: continue
+        entry_stop = get_nentries(tree, nentriesperfile=nentriesperfile)
+        kwargs = {'filter_name': branches, 'entry_stop': entry_stop, 'library': 'ak'}
+        if stepsize is None: chunks = [tree.arrays(**kwargs)]
+        else: chunks = tree.iterate(step_size=stepsize, **kwargs)
+        # one branch per collection to get the number of candidates from
+        countfrom = {}
+        for branch in branches: countfrom.setdefault(collections[branch], branch)
+        for events in chunks:
+            for collection, branch in countfrom.items():
+                counts.setdefault(collection, []).append(
+                  np.asarray(ak.to_numpy(ak.num(events[branch], axis=1)), dtype=np.int64))
+            for branch in branches:
+                values.setdefault(branch, []).append(ak.to_numpy(ak.flatten(events[branch])))
+    res = {}
+    for branch, collection in collections.items():
+        if collection not in res:
+            offsets = np.zeros(sum([len(c) for c in counts[collection]])+1, dtype=np.int64)
+            np.cumsum(np.concatenate(counts[collection]), out=offsets[1:])
+            res[collection] = {'offsets': offsets, 'values': {}}
+        content = np.concatenate(values[branch])
+        if len(content)!=res[collection]['offsets'][-1]:
+            msg = 'ERROR: branch {} has {} values'.format(branch, len(content))
+            msg += ' but collection {} has {} candidates.'.format(collection, res[collection]['offsets'][-1])
+            raise Exception(msg)
+        res[collection]['values'][branch] = content
+    return res
+
+
+def get_event_weights( nevents, genweights=None, xsecs=None, samples=None, lumi=1. ):
+    ### get the normalized weight of each event
+    # input arguments:
+    # - nevents: list with the number of events for each input file
+    # - genweights: array with the generator weight of each event
+    #               (default: all generator weights are 1)
+    # - xsecs: list with the cross-section of each input file
+    #          (default: no normalization, i.e. the weights are the generator weights)
+    # - samples: list with a sample name for each input file;
+    #            files with the same sample name are normalized together
+    #            (default: each file is a separate sample)
+    # - lumi: integrated luminosity (in units matching the cross-sections)
+    # returns:
+    # a float32 array with one weight per event, where the weight of event i
+    # in sample s is genweight_i * xsec_s * lumi / (sum of genweights in sample s).
+    # note: the sum of generator weights is taken over the events that were read
+    #       (i.e. taking into account nentriesperfile).
+    ntotal = sum(nevents)
+    if genweights is None: genweights = np.ones(ntotal, dtype=np.float32)
+    if xsecs is None: return np.asarray(genweights, dtype=np.float32)
+    if samples is None: samples = list(range(len(nevents)))
+    if( len(xsecs)!=len(nevents) or len(samples)!=len(nevents) ):
+        msg = 'ERROR: got {} cross-sections and {} sample names'.format(len(xsecs), len(samples))
+        msg += ' for {} input files.'.format(len(nevents))
+        raise Exception(msg)
+    starts = np.cumsum([0]+list(nevents))
+    slices = [slice(int(starts[idx]), int(starts[idx+1])) for idx in range(len(nevents))]
+    # sum of generator weights per sample
+    sumweights = {}
+    for sample, fileslice in zip(samples, slices):
+        sumw = np.sum(genweights[fileslice], dtype=np.float64)
+        sumweights[sample] = sumweights.get(sample, 0.) + sumw
+    # normalize each file (in float64, then store in float32)
+    weights = np.empty(ntotal, dtype=np.float32)
+    for sample, xsec, fileslice in zip(samples, xsecs, slices):
+        sumw = sumweights[sample]
+        norm = xsec * lumi / sumw if sumw!=0 else 0.
+        weights[fileslice] = genweights[fileslice].astype(np.float64) * norm
+    return weights
@@ -0,0 +1,153 @@
+######################################################
+# Count passing events using cached bit-packed masks #
+######################################################
+# Since the cut values are drawn from a discrete grid, the same threshold
+# on the same variable is used in many trials.
+# The mask of each (cut name, cut value) pair is therefore computed only once,
+# and stored bit-packed (8 events per byte), separately for signal and background.
+# The selection for a configuration of cuts is the bitwise and of the cached masks,
+# and the number of passing events is the number of set bits.
+# The least recently used masks are removed if the cache exceeds its maximum size.
+# For weighted yields, only the combined mask is unpacked and used to sum
+# the (float32) weights, which are stored separately for signal and background.
+# If timing is set to True, the time spent on getting and combining the masks (as opposed to
+# counting them) in the last call is stored in selecttime (see run_hyperopt.calculate_loss).
+
+
+# imports
+import time
+from collections import OrderedDict
+import numpy as np
+
+# local imports
+from cuttools import parse_cutname
+from sortedindex import cast_cutvalue
+
+
+def pack_mask( mask ):
+    ### pack a boolean mask into an array of 64-bit words
+    # note: the packed mask is padded with zeros to a multiple of 8 bytes,
+    #       so the padding never contributes to the number of set bits.
+    packed = np.packbits(mask)
+    npad = (-len(packed)) % 8
+    if npad>0: packed = np.concatenate((packed, np.zeros(npad, dtype=np.uint8)))
+    return packed.view(np.uint64)
+
+def count_bits( words ):
+    ### count the number of set bits in an array of words
+    if hasattr(np, 'bitwise_count'): return int(np.sum(np.bitwise_count(words), dtype=np.int64))
+    return int(np.count_nonzero(np.unpackbits(words.view(np.uint8))))
+
+
+class MaskCacheEngine(object):
+
+    def __init__( self, columns, sig_mask, maxsize=1e9, weights=None ):
+        # input arguments:
+        # - columns: dict mapping cut names to arrays with one value per event,
+        #            as obtained from cuttools.make_cut_columns
+        # - sig_mask: boolean array with one value per event
+        # - maxsize: maximum total size of the cached masks in bytes
+        # - weights: array with one weight per event (default: no weighted yields)
+        sig_mask = np.asarray(sig_mask, dtype=bool)
+        self.nsig_tot = int(np.count_nonzero(sig_mask))
+        self.nbkg_tot = len(sig_mask) - self.nsig_tot
+        self.dtypes = {cutname: column.dtype for cutname, column in columns.items()}
+        self.cuttypes = {cutname: parse_cutname(cutname)[1] for cutname in columns.keys()}
+        self.timing = False
+        self.selecttime = 0.
+        self.sigcolumns = {cutname: column[sig_mask] for cutname, column in columns.items()}
+        self.bkgcolumns = {cutname: column[~sig_mask] for cutname, column in columns.items()}
+        self.weights = None
+        if weights is not None:
+            self.weights = np.asarray(weights, dtype=np.float32)
+            self.sigweights = self.weights[sig_mask]
+            self.bkgweights = self.weights[~sig_mask]
+            self.wsig_tot = float(np.sum(self.sigweights, dtype=np.float64))
+            self.wbkg_tot = float(np.sum(self.bkgweights, dtype=np.float64))
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.size = 0
+        self.maxused = 0
+        self.nhits = 0
+        self.nmisses = 0
+        self.nevictions = 0
+
+    def make_masks( self, cutname, cutvalue ):
+        ### make the packed signal and background masks for a single cut
+        masks = []
+        for columns in [self.sigcolumns, self.bkgcolumns]:
+            varvalue = columns[cutname]
+            if self.cuttypes[cutname]=='max': mask = (varvalue < cutvalue)
+            else: mask = (varvalue > cutvalue)
+            masks.append(pack_mask(mask))
+        return tuple(masks)
+
+    def get_masks( self, cutname, cutvalue ):
+        ### get the packed signal and background masks for a single cut from the cache
+        # note: the key uses the cut value as rounded to the comparison precision,
+        #       so all values giving the same mask share the same cache entry.
+        key = (cutname, cast_cutvalue(cutvalue, self.dtypes[cutname]))
+        masks = self.cache.get(key)
+        if masks is not None:
+            self.nhits += 1
+            self.cache.move_to_end(key)
+            return masks
+        self.nmisses += 1
+        masks = self.make_masks(cutname, cutvalue)
+        self.cache[key] = masks
+        self.size += masks[0].nbytes + masks[1].nbytes
+        while( self.size > self.maxsize and len(self.cache)>1 ):
+            (_, oldmasks) = self.cache.popitem(last=False)
+            self.size -= oldmasks[0].nbytes + oldmasks[1].nbytes
+            self.nevictions += 1
+        self.maxused = max(self.maxused, self.size)
+        return masks
+
+    def combine_masks( self, cuts ):
+        ### get the packed signal and background masks for a configuration of cuts
+        # returns:
+        # a tuple of the form (sigwords, bkgwords), or (None, None) if there are no cuts
+        if self.timing: starttime = time.perf_counter()
+        sigwords = None
+        bkgwords = None
+        for cutname, cutvalue in cuts.items():
+            (sigmask, bkgmask) = self.get_masks(cutname, cutvalue)
+            if sigwords is None:
+                sigwords = sigmask.copy()
+                bkgwords = bkgmask.copy()
+            else:
+                sigwords &= sigmask
+                bkgwords &= bkgmask
+        self.selecttime = time.perf_counter() - starttime if self.timing else 0.
+        return (sigwords, bkgwords)
+
+    def count( self, cuts ):
+        ### get the number of passing signal and background events
+        # returns:
+        # a tuple of the form (nsig_pass, nbkg_pass)
+        (sigwords, bkgwords) = self.combine_masks(cuts)
+        if sigwords is None: return (self.nsig_tot, self.nbkg_tot)
+        return (count_bits(sigwords), count_bits(bkgwords))
+
+    def count_weighted( self, cuts ):
+        ### get the number and the weighted yield of passing signal and background events
+        # returns:
+        # a tuple of the form (nsig_pass, nbkg_pass, wsig_pass, wbkg_pass)
+        (sigwords, bkgwords) = self.combine_masks(cuts)
+        if sigwords is None: return (self.nsig_tot, self.nbkg_tot, self.wsig_tot, self.wbkg_tot)
+        res = [count_bits(sigwords), count_bits(bkgwords)]
+        for words, weights in [(sigwords, self.sigweights), (bkgwords, self.bkgweights)]:
+            mask = np.unpackbits(words.view(np.uint8), count=len(weights)).view(bool)
+            res.append(float(np.sum(weights[mask], dtype=np.float64)))
+        return tuple(res)
+
+    def report( self ):
+        ### make a summary of the cache usage
+        nrequests = self.nhits + self.nmisses
+        hitrate = self.nhits / nrequests if nrequests>0 else 0.
+        res = 'Mask cache: {} hits, {} misses (hit rate {:.1%}),'.format(
+                self.nhits, self.nmisses, hitrate)
+        res += ' {} evictions, {} masks in cache,'.format(self.nevictions, len(self.cache))
+        res += ' memory used {:.1f} MB (max. {:.1f} MB, limit {:.1f} MB)'.format(
+                self.size/1e6, self.maxused/1e6, self.maxsize/1e6)
+        return res
@@ -0,0 +1,117 @@
+########################################################
+# Count passing events with masks on pre-split columns #
+########################################################
+# Same selection as cuttools.pass_selection, but the columns and the weights
+# are split in signal and background once, and the total (weighted) yields are computed once.
+# Instead of building full-length masks for each configuration, the events are processed
+# in chunks: the cuts are applied to each chunk in a small preallocated mask
+# (which stays in the cpu cache), which is then counted and multiplied with the weights
+# of the chunk, so no memory is allocated per configuration.
+# If timing is set to True, the time spent on building the masks (as opposed to counting them)
+# in the last call is stored in selecttime (see run_hyperopt.calculate_loss).
+# note: if all signal events come before all background events
+#       (as in the output of make_input_file.make_input_columns),
+#       the split columns are views of the original ones, so no memory is copied.
+
+
+# imports
+import time
+import numpy as np
+
+# local imports
+from cuttools import parse_cutname
+
+
+def split_events( sig_mask ):
+    ### get the selections of signal and background events
+    # returns:
+    # a tuple of the form (signal selection, background selection),
+    # which are slices if all signal events come first, else boolean masks
+    sig_mask = np.asarray(sig_mask, dtype=bool)
+    nsig = int(np.count_nonzero(sig_mask))
+    if( np.all(sig_mask[:nsig]) ): return (slice(0, nsig), slice(nsig, len(sig_mask)))
+    return (sig_mask, ~sig_mask)
+
+
+class MaskEngine(object):
+
+    def __init__( self, columns, sig_mask, weights=None, chunksize=2**15 ):
+        # input arguments:
+        # - columns: dict mapping cut names to arrays with one value per event,
+        #            as obtained from cuttools.make_cut_columns
+        # - sig_mask: boolean array with one value per event
+        # - weights: array with one weight per event (default: no weighted yields)
+        # - chunksize: number of events to process at once
+        (sigsel, bkgsel) = split_events(sig_mask)
+        self.sigcolumns = {cutname: column[sigsel] for cutname, column in columns.items()}
+        self.bkgcolumns = {cutname: column[bkgsel] for cutname, column in columns.items()}
+        self.cuttypes = {cutname: parse_cutname(cutname)[1] for cutname in columns.keys()}
+        self.nsig_tot = int(np.count_nonzero(sig_mask))
+        self.nbkg_tot = len(sig_mask) - self.nsig_tot
+        self.sigweights = None
+        self.bkgweights = None
+        if weights is not None:
+            # note: the weights are stored in float64, so that the product with the mask
+            #       gives the same sum as the float64 sum of the selected float32 weights.
+            weights = np.asarray(weights, dtype=np.float32)
+            self.sigweights = weights[sigsel].astype(np.float64)
+            self.bkgweights = weights[bkgsel].astype(np.float64)
+            self.wsig_tot = float(np.sum(self.sigweights))
+            self.wbkg_tot = float(np.sum(self.bkgweights))
+        # buffers for a chunk of events
+        self.chunksize = chunksize
+        self.mask = np.empty(chunksize, dtype=bool)
+        self.tmp = np.empty(chunksize, dtype=bool)
+        self.fmask = np.empty(chunksize, dtype=np.float64)
+        self.timing = False
+        self.selecttime = 0.
+
+    def count_split( self, columns, weights, cuts ):
+        ### get the number and the weighted yield of passing events in a set of split columns
+        # input arguments:
+        # - columns: split columns (i.e. self.sigcolumns or self.bkgcolumns)
+        # - weights: corresponding split weights (or None for no weighted yield)
+        # - cuts: dict mapping cut names to cut values
+        # returns:
+        # a tuple of the form (npass, wpass), with wpass None if weights is None
+        # note: the comparisons are done in the same way as in cuttools.pass_selection
+        #       (i.e. with the python float cut values), so the results are identical.
+        nevents = len(next(iter(columns.values())))
+        npass = 0
+        wpass = None if weights is None else 0.
+        for start in range(0, nevents, self.chunksize):
+            stop = min(start+self.chunksize, nevents)
+            mask = self.mask[:stop-start]
+            tmp = self.tmp[:stop-start]
+            if self.timing: starttime = time.perf_counter()
+            mask.fill(True)
+            for cutname, cutvalue in cuts.items():
+                if self.cuttypes[cutname]=='max': np.less(columns[cutname][start:stop], cutvalue, out=tmp)
+                else: np.greater(columns[cutname][start:stop], cutvalue, out=tmp)
+                mask &= tmp
+            if self.timing: self.selecttime += time.perf_counter() - starttime
+            npass += int(np.count_nonzero(mask))
+            if weights is not None:
+                fmask = self.fmask[:stop-start]
+                fmask[:] = mask
+                wpass += float(np.dot(fmask, weights[start:stop]))
+        return (npass, wpass)
+
+    def count( self, cuts ):
+        ### get the number of passing signal and background events
+        # returns:
+        # a tuple of the form (nsig_pass, nbkg_pass)
+        self.selecttime = 0.
+        if len(cuts)==0: return (self.nsig_tot, self.nbkg_tot)
+        return (self.count_split(self.sigcolumns, None, cuts)[0],
+                self.count_split(self.bkgcolumns, None, cuts)[0])
+
+    def count_weighted( self, cuts ):
+        ### get the number and the weighted yield of passing signal and background events
+        # returns:
+        # a tuple of the form (nsig_pass, nbkg_pass, wsig_pass, wbkg_pass)
+        self.selecttime = 0.
+        if len(cuts)==0: return (self.nsig_tot, self.nbkg_tot, self.wsig_tot, self.wbkg_tot)
+        (nsig, wsig) = self.count_split(self.sigcolumns, self.sigweights, cuts)
+        (nbkg, wbkg) = self.count_split(self.bkgcolumns, self.bkgweights, cuts)
+        return (nsig, nbkg, wsig, wbkg)
@@ -0,0 +1,180 @@
+############################################################
+# Multi-fidelity (successive halving) evaluation of trials #
+############################################################
+# Instead of evaluating each suggested configuration on all events,
+# the configurations are suggested in brackets (e.g. 9 at a time),
+# which are first evaluated on a small random subsample of the events (e.g. 1/9),
+# after which only the best fraction (e.g. 1/3) is evaluated again on a larger subsample (e.g. 1/3),
+# and so on, until the best configuration(s) of each bracket are evaluated on all events.
+# The subsamples are stratified (the same fraction of signal and background events)
+# and nested (each subsample contains the smaller ones),
+# and the passing yields are scaled to the full sample before calculating the loss,
+# so that the losses at different fidelities are comparable for the suggestion algorithm.
+# The fidelity (fraction of events) at which each trial was last evaluated
+# is stored in its extra info under the key 'fidelity',
+# and the loss at each fidelity is stored in its result under the key 'fidelity_losses'.
+# note: only trials with fidelity 1 are evaluated on all events,
+#       so only those should be used to find the best configurations (see get_best.py).
+
+
+# imports
+import os
+import math
+import numpy as np
+from hyperopt import base, pyll
+from hyperopt.progress import default_callback, no_progress_callback
+from hyperopt.utils import coarse_utcnow
+
+
+def get_fractions( nlevels, eta=3 ):
+    ### get the fraction of events for each fidelity level, from coarse to fine
+    # e.g. for nlevels=3 and eta=3: [1/9, 1/3, 1]
+    return [float(eta)**(-(nlevels-1-level)) for level in range(nlevels)]
+
+def get_subsample_indices( sig_mask, fractions, seed=None ):
+    ### get the indices of nested, stratified random subsamples of the events
+    # input arguments:
+    # - sig_mask: boolean array with one value per event
+    # - fractions: list of fractions of events, in increasing order
+    # - seed: seed for the random generator
+    # returns:
+    # a list with for each fraction a sorted array of event indices
+    # (or None for a fraction of 1, i.e. all events)
+    # note: each subsample contains at least one signal and one background event
+    #       (if present in the full sample).
+    rng = np.random.default_rng(seed)
+    sig_mask = np.asarray(sig_mask, dtype=bool)
+    sigperm = rng.permutation(np.nonzero(sig_mask)[0])
+    bkgperm = rng.permutation(np.nonzero(~sig_mask)[0])
+    indices = []
+    for fraction in fractions:
+        if fraction>=1:
+            indices.append(None)
+            continue
+        nsig = min(len(sigperm), max(1, int(round(fraction*len(sigperm)))))
+        nbkg = min(len(bkgperm), max(1, int(round(fraction*len(bkgperm)))))
+        indices.append(np.sort(np.concatenate((sigperm[:nsig], bkgperm[:nbkg]))))
+    return indices
+
+def make_subsample( columns, sig_mask, indices, weights=None ):
+    ### make a subsample of the input columns
+    # returns:
+    # a dict with the keys columns, sig_mask, weights (subsampled, or the original ones
+    # if indices is None) and scale, a tuple of the form (signal scale, background scale)
+    # to estimate the (weighted) yields in the full sample from the ones in the subsample.
+    if indices is None:
+        return {'columns': columns, 'sig_mask': sig_mask, 'weights': weights, 'scale': None}
+    subcolumns = {name: np.ascontiguousarray(column[indices]) for name, column in columns.items()}
+    subsig_mask = np.asarray(sig_mask, dtype=bool)[indices]
+    subweights = None if weights is None else np.ascontiguousarray(weights[indices])
+    if weights is None:
+        sigtot = (np.sum(sig_mask), np.sum(subsig_mask))
+        bkgtot = (np.sum(~sig_mask), np.sum(~subsig_mask))
+    else:
+        sigtot = (np.sum(weights[sig_mask], dtype=np.float64),
+                  np.sum(subweights[subsig_mask], dtype=np.float64))
+        bkgtot = (np.sum(weights[~sig_mask], dtype=np.float64),
+                  np.sum(subweights[~subsig_mask], dtype=np.float64))
+    scale = tuple([float(tot[0]/tot[1]) if tot[1]!=0 else 1. for tot in [sigtot, bkgtot]])
+    return {'columns': subcolumns, 'sig_mask': subsig_mask, 'weights': subweights, 'scale': scale}
+
+def get_cost( trials ):
+    ### get the number of evaluations at each fidelity in a Trials object
+    # returns:
+    # a tuple of the form (dict mapping fidelities to number of evaluations,
+    # equivalent number of evaluations on all events)
+    nevals = {}
+    for trial in trials.trials:
+        for (fidelity, _) in trial['result'].get('fidelity_losses', []):
+            nevals[fidelity] = nevals.get(fidelity, 0) + 1
+    return (nevals, sum([fidelity*n for fidelity, n in nevals.items()]))
+
+def get_sort_key( loss ):
+    ### sort key for losses, with missing (None or nan) losses last
+    if( loss is None or np.isnan(loss) ): return np.inf
+    return loss
+
+
+def fmin_halving( fns, fractions, space, algo, max_evals, trials, eta=3,
+                  rstate=None, show_progressbar=True, early_stop_fn=None ):
+    ### same as hyperopt.fmin, but with successive halving over subsamples of the events
+    # input arguments:
+    # - fns: list of functions to evaluate a configuration at each fidelity level,
+    #        from coarse to fine (the last one should use all events)
+    # - fractions: fraction of events used by each function in fns (see get_fractions)
+    # - space, algo, max_evals, trials, rstate, show_progressbar, early_stop_fn:
+    #   see hyperopt.fmin (early_stop_fn is called after each bracket)
+    # - eta: at each level, 1/eta of the configurations (rounded up) is promoted to the next one
+    # note: each bracket consists of eta**(number of levels - 1) suggestions
+    #       (or fewer, if max_evals is reached), of which one ends up at the finest level.
+    # note: trials already present in the Trials object with state new
+    #       (e.g. from hyperopt.fmin.generate_trials_to_calculate)
+    #       are evaluated first, in the same way as new suggestions.
+    if len(fns)!=len(fractions):
+        msg = 'ERROR: got {} functions but {} fractions.'.format(len(fns), len(fractions))
+        raise Exception(msg)
+    if rstate is None:
+        seed = os.environ.get('HYPEROPT_FMIN_SEED', '')
+        rstate = np.random.default_rng(int(seed) if seed else None)
+    nbracket = int(eta)**(len(fns)-1)
+    # note: the domain needs a function, but it is not used for evaluation
+    domain = base.Domain(lambda config: None, space)
+    trials.refresh()
+    progress = default_callback if show_progressbar else no_progress_callback
+    ndone = trials.count_by_state_unsynced(base.JOB_STATE_DONE)
+    early_stop_args = []
+    with progress(initial=ndone, total=max_evals) as progress_ctx:
+        while True:
+            # get new suggestions if there are no pending trials
+            pending = [trial for trial in trials._dynamic_trials
+                       if trial['state']==base.JOB_STATE_NEW]
+            if len(pending)==0:
+                nnew = min(nbracket, max_evals - len(trials._dynamic_trials))
+                if nnew<=0: break
+                for _ in range(nnew):
+                    new_ids = trials.new_trial_ids(1)
+                    new_trials = algo(new_ids, domain, trials, rstate.integers(2**31-1))
+                    if len(new_trials)==0: break
+                    trials.insert_trial_docs(new_trials)
+                    trials.refresh()
+                pending = [trial for trial in trials._dynamic_trials
+                           if trial['state']==base.JOB_STATE_NEW]
+                if len(pending)==0: break
+            # evaluate the pending trials, promoting the best ones to the next level
+            configs = {}
+            for trial in pending:
+                trial['state'] = base.JOB_STATE_RUNNING
+                trial['book_time'] = coarse_utcnow()
+                trial['result'] = {'status': base.STATUS_RUNNING, 'fidelity_losses': []}
+                memo = domain.memo_from_config(base.spec_from_misc(trial['misc']))
+                configs[trial['tid']] = pyll.rec_eval(domain.expr, memo=memo)
+            candidates = pending
+            for level, (fn, fraction) in enumerate(zip(fns, fractions)):
+                for trial in candidates:
+                    history = trial['result']['fidelity_losses']
+                    result = fn(configs[trial['tid']])
+                    # note: the result (and its extra info) can be shared with the result cache,
+                    #       so it is copied instead of modified.
+                    result = dict(result)
+                    result['extra_info'] = dict(result['extra_info'], fidelity=fraction)
+                    result['fidelity_losses'] = history + [[fraction, result.get('loss')]]
+                    trial['result'] = result
+                if level==len(fns)-1: break
+                candidates = sorted(candidates,
+                               key=lambda trial: get_sort_key(trial['result'].get('loss')))
+                candidates = candidates[:int(math.ceil(len(candidates)/eta))]
+            for trial in pending:
+                trial['state'] = base.JOB_STATE_DONE
+                trial['refresh_time'] = coarse_utcnow()
+            trials.refresh()
+            # update the progress bar
+            losses = [trial['result'].get('loss') for trial in trials.trials
+                      if trial['result'].get('extra_info', {}).get('fidelity', 1)>=1]
+            losses = [loss for loss in losses if loss is not None]
+            if len(losses)>0: progress_ctx.postfix = 'best loss: {}'.format(min(losses))
+            progress_ctx.update(len(pending))
+            # check the early stopping rules
+            if early_stop_fn is not None:
+                (stop, early_stop_args) = early_stop_fn(trials, *early_stop_args)
+                if stop: break
+    return trials
@@ -0,0 +1,204 @@
+##################################################
+# Evaluate hyperopt trials in parallel processes #
+##################################################
+# The reduced event columns are put in shared memory once,
+# so the worker processes never copy or unpickle them;
+# only the cut configurations and their results are sent between processes.
+# The trials are stored in a regular hyperopt Trials object,
+# so the output is identical in format to the one of a serial fmin call.
+
+
+# imports
+import os
+import sys
+import time
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from hyperopt import base, pyll
+from hyperopt.progress import default_callback, no_progress_callback
+from hyperopt.utils import coarse_utcnow
+
+
+def share_arrays( arrays ):
+    ### copy a dict of numpy arrays to shared memory
+    # returns:
+    # a tuple of the form (shms, specs), where shms is a list of SharedMemory objects
+    # (to be closed and unlinked by the caller) and specs a dict mapping
+    # each array name to a tuple (shared memory name, dtype, shape).
+    shms = []
+    specs = {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+        shared[...] = array
+        shms.append(shm)
+        specs[name] = (shm.name, array.dtype.str, array.shape)
+    return (shms, specs)
+
+def attach_arrays( specs ):
+    ### get numpy arrays backed by existing shared memory
+    # returns:
+    # a tuple of the form (shms, arrays), where shms is a list of SharedMemory objects
+    # (to be kept alive as long as the arrays are used).
+    shms = []
+    arrays = {}
+    for name, (shmname, dtype, shape) in specs.items():
+        shm = shared_memory.SharedMemory(name=shmname)
+        shms.append(shm)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        arrays[name].flags.writeable = False
+    return (shms, arrays)
+
+
+# state of each worker process (set by init_worker)
+_worker = {}
+
+def init_worker( specs, fn, enginefactory ):
+    ### initialize a worker process
+    (shms, arrays) = attach_arrays(specs)
+    sig_mask = arrays.pop('__sig_mask__')
+    weights = arrays.pop('__weights__', None)
+    _worker['shms'] = shms
+    _worker['columns'] = arrays
+    _worker['sig_mask'] = sig_mask
+    _worker['weights'] = weights
+    _worker['fn'] = fn
+    _worker['engine'] = None
+    if enginefactory is not None:
+        if weights is None: _worker['engine'] = enginefactory(arrays, sig_mask)
+        else: _worker['engine'] = enginefactory(arrays, sig_mask, weights=weights)
+
+def evaluate_worker( config ):
+    ### evaluate a single configuration in a worker process
+    return _worker['fn'](_worker['columns'], config,
+                         sig_mask=_worker['sig_mask'],
+                         engine=_worker['engine'],
+                         weights=_worker['weights'])
+
+
+class TrialPool(object):
+
+    def __init__( self, columns, sig_mask, fn, nworkers, enginefactory=None,
+                  resultcache=None, lossfunction=None, weights=None ):
+        # input arguments:
+        # - columns: dict mapping cut names to arrays with one value per event,
+        #            as obtained from cuttools.make_cut_columns
+        # - sig_mask: boolean array with one value per event
+        # - fn: function to evaluate, called in the workers as
+        #       fn(columns, config, sig_mask=sig_mask, engine=engine, weights=weights),
+        #       e.g. a partial of run_hyperopt.calculate_loss
+        # - nworkers: number of worker processes
+        # - enginefactory: function called in each worker as enginefactory(columns, sig_mask)
+        #                  (or enginefactory(columns, sig_mask, weights=weights) if weights are given)
+        #                  to make the engine for counting passing events (default: no engine)
+        # - resultcache: a resultcache.ResultCache instance, checked before
+        #                sending configurations to the workers (default: no caching)
+        # - lossfunction: name of the loss function (used as part of the cache key)
+        # - weights: array with one weight per event, shared in the same way as the columns
+        #            (default: no weights)
+        # note: the engine is made separately in each worker,
+        #       while the columns are shared between all workers.
+        arrays = dict(columns)
+        arrays['__sig_mask__'] = np.asarray(sig_mask, dtype=bool)
+        if weights is not None: arrays['__weights__'] = np.asarray(weights, dtype=np.float32)
+        (self.shms, specs) = share_arrays(arrays)
+        self.nworkers = nworkers
+        self.resultcache = resultcache
+        self.lossfunction = lossfunction
+        self.pool = mp.Pool(processes=nworkers,
+                      initializer=init_worker,
+                      initargs=(specs, fn, enginefactory))
+
+    def evaluate( self, configs ):
+        ### evaluate a list of configurations in parallel
+        if self.resultcache is None:
+            return self.pool.map(evaluate_worker, configs, chunksize=1)
+        # only send configurations that are not in the result cache to the workers
+        results = [self.resultcache.get(config, self.lossfunction) for config in configs]
+        todo = [idx for idx, result in enumerate(results) if result is None]
+        starttime = time.time()
+        newresults = self.pool.map(evaluate_worker, [configs[idx] for idx in todo], chunksize=1)
+        evaltime = (time.time()-starttime)*self.nworkers/max(1, len(todo))
+        for idx, result in zip(todo, newresults):
+            self.resultcache.put(configs[idx], self.lossfunction, result, evaltime=evaltime)
+            results[idx] = result
+        return results
+
+    def close( self ):
+        ### stop the workers and release the shared memory
+        self.pool.close()
+        self.pool.join()
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *args ):
+        self.close()
+
+
+def fmin_parallel( pool, space, algo, max_evals, trials,
+                   rstate=None, show_progressbar=True, early_stop_fn=None ):
+    ### same as hyperopt.fmin, but evaluate trials in batches using a TrialPool
+    # input arguments:
+    # - pool: a TrialPool instance
+    # - space, algo, max_evals, trials, rstate, show_progressbar, early_stop_fn:
+    #   see hyperopt.fmin (early_stop_fn is called after each batch)
+    # note: for each batch, the algorithm is asked for one suggestion per worker;
+    #       trials that are still pending are seen by tpe as having infinite loss,
+    #       which avoids multiple suggestions of the same configuration.
+    # note: trials already present in the Trials object with state new
+    #       (e.g. from hyperopt.fmin.generate_trials_to_calculate)
+    #       are evaluated first.
+    if rstate is None:
+        seed = os.environ.get('HYPEROPT_FMIN_SEED', '')
+        rstate = np.random.default_rng(int(seed) if seed else None)
+    # note: the domain needs a function, but it is not used for evaluation
+    domain = base.Domain(lambda config: None, space)
+    trials.refresh()
+    progress = default_callback if show_progressbar else no_progress_callback
+    ndone = trials.count_by_state_unsynced(base.JOB_STATE_DONE)
+    early_stop_args = []
+    with progress(initial=ndone, total=max_evals) as progress_ctx:
+        while True:
+            # get new suggestions if there are no pending trials
+            pending = [trial for trial in trials._dynamic_trials
+                       if trial['state']==base.JOB_STATE_NEW]
+            if len(pending)==0:
+                nnew = min(pool.nworkers, max_evals - len(trials._dynamic_trials))
+                if nnew<=0: break
+                for _ in range(nnew):
+                    new_ids = trials.new_trial_ids(1)
+                    new_trials = algo(new_ids, domain, trials, rstate.integers(2**31-1))
+                    if len(new_trials)==0: break
+                    trials.insert_trial_docs(new_trials)
+                    trials.refresh()
+                pending = [trial for trial in trials._dynamic_trials
+                           if trial['state']==base.JOB_STATE_NEW]
+                if len(pending)==0: break
+            # evaluate the pending trials
+            configs = []
+            for trial in pending:
+                trial['state'] = base.JOB_STATE_RUNNING
+                trial['book_time'] = coarse_utcnow()
+                memo = domain.memo_from_config(base.spec_from_misc(trial['misc']))
+                configs.append(pyll.rec_eval(domain.expr, memo=memo))
+            results = pool.evaluate(configs)
+            for trial, result in zip(pending, results):
+                trial['state'] = base.JOB_STATE_DONE
+                trial['result'] = result
+                trial['refresh_time'] = coarse_utcnow()
+            trials.refresh()
+            # update the progress bar
+            losses = [loss for loss in trials.losses() if loss is not None]
+            if len(losses)>0: progress_ctx.postfix = 'best loss: {}'.format(min(losses))
+            progress_ctx.update(len(pending))
+            # check the early stopping rules
+            if early_stop_fn is not None:
+                (stop, early_stop_args) = early_stop_fn(trials, *early_stop_args)
+                if stop: break
+    return trials
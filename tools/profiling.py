@@ -0,0 +1,134 @@
+######################################################
+# Per-trial timing and progress reports for hyperopt #
+######################################################
+# The time spent in each trial is measured by run_hyperopt.calculate_loss (with timing=True)
+# and stored in the result of the trial as a dict under the key 'timing', with the following steps:
+# - select: building the event mask for the cuts (without an engine,
+#           or as reported by engines that build masks, e.g. maskengine.MaskEngine)
+# - count: counting the passing (weighted) events, with the mask or the engine
+# - loss: calculating the loss from the passing events
+# - total: total time of the evaluation
+# The time spent in the suggestion algorithm (e.g. tpe.suggest) is measured by wrapping it.
+# After each trial (or batch of trials), the new trials can be written as json lines
+# to a progress file, and at the end of the run a summary can be printed
+# with the percentiles of the time per step, the number of trials per second
+# and the slowest trials with their cuts.
+# note: the reduction of jagged variables to one value per event is done only once,
+#       when reading the input files (see make_input_file.make_input_columns),
+#       so it does not contribute to the time per trial.
+
+
+# imports
+import json
+import time
+import numpy as np
+
+# local imports
+from trialtracker import TrialTracker
+
+
+class TrialProfiler(object):
+
+    def __init__( self, progressfile=None, nslowest=5 ):
+        # input arguments:
+        # - progressfile: json lines file to write the progress to (default: no file)
+        # - nslowest: number of slowest trials to show in the report
+        self.progressfile = progressfile
+        self.nslowest = nslowest
+        self.starttime = time.time()
+        self.timings = {}
+        self.suggesttimes = []
+        self.suggestbytid = {}
+        self.slowest = []
+        self.tracker = TrialTracker()
+        self.ndone = 0
+        self.ncached = 0
+        self.best = None
+        self.f = None
+        if progressfile is not None: self.f = open(progressfile, 'w')
+
+    def wrap_algo( self, algo ):
+        ### wrap a suggestion algorithm (e.g. tpe.suggest) to measure the time of each call
+        def timed_algo( new_ids, domain, trials, seed, *args, **kwargs ):
+            starttime = time.perf_counter()
+            res = algo(new_ids, domain, trials, seed, *args, **kwargs)
+            elapsed = time.perf_counter() - starttime
+            self.suggesttimes.append(elapsed)
+            for tid in new_ids: self.suggestbytid[tid] = elapsed/max(1, len(new_ids))
+            return res
+        return timed_algo
+
+    def update( self, trials ):
+        ### process the trials that finished since the last call (see tools/trialtracker.py)
+        elapsed = time.time() - self.starttime
+        for trial in self.tracker.get_new(trials):
+            result = trial['result']
+            loss = result.get('loss')
+            if loss is None: continue
+            self.ndone += 1
+            # note: the best loss only takes into account trials evaluated on all events
+            #       (see tools/multifidelity.py)
+            fidelity = result.get('extra_info', {}).get('fidelity', 1)
+            if( fidelity>=1 and (self.best is None or loss < self.best) ): self.best = loss
+            timing = result.get('timing')
+            # note: results from the result cache have no timing
+            if timing is None: self.ncached += 1
+            else:
+                for step, val in timing.items(): self.timings.setdefault(step, []).append(val)
+                total = timing.get('total', 0.)
+                if( len(self.slowest)<self.nslowest or total>self.slowest[-1][0] ):
+                    cuts = {key: float(val[0]) for key, val in trial['misc']['vals'].items()
+                            if len(val)>0}
+                    self.slowest.append((total, trial['tid'], cuts))
+                    self.slowest = sorted(self.slowest, key=lambda x: -x[0])[:self.nslowest]
+            if self.f is not None:
+                line = {'tid': trial['tid'], 'loss': loss, 'best': self.best,
+                        'ndone': self.ndone, 'elapsed': elapsed,
+                        'rate': self.ndone/elapsed if elapsed>0 else None,
+                        'timing': timing, 'suggest': self.suggestbytid.get(trial['tid'])}
+                self.f.write(json.dumps(line, default=float)+'\n')
+        if self.f is not None: self.f.flush()
+
+    def __call__( self, trials, *args ):
+        ### interface for the early_stop_fn argument of hyperopt.fmin
+        # note: never requests to stop.
+        self.update(trials)
+        return (False, [])
+
+    def close( self ):
+        ### close the progress file
+        if self.f is not None: self.f.close()
+        self.f = None
+
+    @staticmethod
+    def format_times( times ):
+        ### format the percentiles of a list of times (in seconds) in ms
+        times = np.asarray(times, dtype=np.float64)*1e3
+        (p50, p90, p99) = np.percentile(times, [50, 90, 99])
+        res = 'mean {:.3f}, p50 {:.3f}, p90 {:.3f}, p99 {:.3f}, max {:.3f} ms'.format(
+                np.mean(times), p50, p90, p99, np.max(times))
+        res += ' (total {:.2f} s)'.format(np.sum(times)*1e-3)
+        return res
+
+    def report( self ):
+        ### make a summary of the timings
+        elapsed = time.time() - self.starttime
+        res = 'Timing summary: {} trials in {:.2f} s'.format(self.ndone, elapsed)
+        if elapsed>0: res += ' ({:.1f} trials/s)'.format(self.ndone/elapsed)
+        if self.ncached>0: res += ', {} from the result cache'.format(self.ncached)
+        for step in ['select', 'count', 'loss', 'total']:
+            if step not in self.timings: continue
+            res += '\n  - {}: {}'.format(step, self.format_times(self.timings[step]))
+        if len(self.suggesttimes)>0:
+            res += '\n  - suggest: {}'.format(self.format_times(self.suggesttimes))
+        if( elapsed>0 and 'total' in self.timings ):
+            evaltime = np.sum(self.timings['total'])
+            suggesttime = np.sum(self.suggesttimes)
+            # note: with parallel workers, the evaluation time is summed over all workers.
+            res += '\n  Fraction of wall time: {:.1%} evaluation, {:.1%} suggestion'.format(
+                     evaltime/elapsed, suggesttime/elapsed)
+        if len(self.slowest)>0:
+            res += '\n  Slowest trials:'
+            for (total, tid, cuts) in self.slowest:
+                res += '\n  - trial {}: {:.3f} ms, cuts {}'.format(tid, total*1e3, cuts)
+        return res
@@ -0,0 +1,132 @@
+###########################################
+# Cache of results for cut configurations #
+###########################################
+# With discrete (e.g. quniform) search spaces, the same configuration of cuts
+# is often proposed multiple times, especially late in a run.
+# The results are stored in memory, keyed by the configuration and the loss function,
+# and can be written to a file, so that later runs on the same inputs can reuse them.
+# The results for different inputs are stored separately in the same file,
+# identified by a key made from the input files (path, size and modification time)
+# and the settings used to read them (e.g. the number of entries per file).
+# Multiple jobs can share the same file: it is only updated while holding a lock,
+# and the results of all jobs are merged rather than overwritten.
+
+
+# imports
+import os
+import sys
+import json
+import fcntl
+import hashlib
+import contextlib
+import pickle as pkl
+
+
+def get_input_key( sigfiles=[], bkgfiles=[], nentriesperfile=-1, extra=None ):
+    ### make a unique key for a set of input files and settings
+    # input arguments:
+    # - sigfiles, bkgfiles, nentriesperfile: see make_input_file
+    # - extra: any other json-serializable object that changes the results
+    #          (e.g. the event weight settings)
+    keyobj = {'nentriesperfile': int(nentriesperfile), 'extra': extra}
+    for (name, files) in [('sigfiles', sigfiles), ('bkgfiles', bkgfiles)]:
+        keyobj[name] = []
+        for inputfile in files:
+            path = os.path.abspath(inputfile)
+            stat = os.stat(path)
+            keyobj[name].append([path, stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha1(json.dumps(keyobj, sort_keys=True).encode()).hexdigest()
+
+
+@contextlib.contextmanager
+def file_lock( lockfile ):
+    ### context manager holding an exclusive lock on a file (created if needed)
+    # note: uses flock, which also works between nodes on most network filesystems
+    #       (e.g. NFS with locking enabled).
+    with open(lockfile, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try: yield
+        finally: fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class ResultCache(object):
+
+    def __init__( self, inputkey=None, cachefile=None ):
+        # input arguments:
+        # - inputkey: key identifying the inputs, as obtained from get_input_key
+        # - cachefile: file to read earlier results from and write results to
+        #              (default: results are kept in memory only)
+        self.inputkey = inputkey
+        self.cachefile = cachefile
+        self.results = {}
+        self.nhits = 0
+        self.nmisses = 0
+        self.nloaded = 0
+        self.evaltime = 0.
+        self.nevals = 0
+        if( cachefile is not None and os.path.exists(cachefile) ):
+            with open(cachefile, 'rb') as f: allresults = pkl.load(f)
+            self.results = allresults.get(inputkey, {})
+            self.nloaded = len(self.results)
+
+    @staticmethod
+    def get_key( cuts, lossfunction ):
+        ### make a canonical key for a configuration of cuts
+        # note: the type of the cut values is included in the key,
+        #       since e.g. numpy compares float32 arrays with python floats
+        #       and numpy float64 values in a different precision.
+        items = sorted([(cutname, type(cutvalue).__name__, float(cutvalue))
+                        for cutname, cutvalue in cuts.items()])
+        return (lossfunction, tuple(items))
+
+    def get( self, cuts, lossfunction ):
+        ### get the stored result for a configuration of cuts, or None if not present
+        result = self.results.get(self.get_key(cuts, lossfunction))
+        if result is None:
+            self.nmisses += 1
+            return None
+        self.nhits += 1
+        return dict(result)
+
+    def put( self, cuts, lossfunction, result, evaltime=None ):
+        ### store the result for a configuration of cuts
+        # input arguments:
+        # - evaltime: time (in seconds) it took to calculate the result,
+        #             used to estimate the time saved by the cache
+        # note: the timing of the evaluation (see profiling.py) is not stored,
+        #       since it does not apply to later requests of the same configuration.
+        result = dict(result)
+        result.pop('timing', None)
+        self.results[self.get_key(cuts, lossfunction)] = result
+        if evaltime is not None:
+            self.evaltime += evaltime
+            self.nevals += 1
+
+    def save( self ):
+        ### write the results to the cache file
+        # note: results already present in the file (for other inputs,
+        #       or written by other jobs in the meantime) are kept,
+        #       and the file is locked while reading, merging and writing it.
+        if self.cachefile is None: return
+        with file_lock(self.cachefile + '.lock'):
+            allresults = {}
+            if os.path.exists(self.cachefile):
+                with open(self.cachefile, 'rb') as f: allresults = pkl.load(f)
+            results = allresults.get(self.inputkey, {})
+            results.update(self.results)
+            allresults[self.inputkey] = results
+            tmpfile = self.cachefile + '.tmp{}'.format(os.getpid())
+            with open(tmpfile, 'wb') as f: pkl.dump(allresults, f)
+            os.replace(tmpfile, self.cachefile)
+
+    def report( self ):
+        ### make a summary of the cache usage
+        nrequests = self.nhits + self.nmisses
+        hitrate = self.nhits / nrequests if nrequests>0 else 0.
+        res = 'Result cache: {} hits, {} misses (hit rate {:.1%}),'.format(
+                self.nhits, self.nmisses, hitrate)
+        res += ' {} results loaded from file, {} results in total'.format(
+                self.nloaded, len(self.results))
+        if self.nevals>0:
+            res += ', estimated time saved: {:.2f} s'.format(self.nhits*self.evaltime/self.nevals)
+        return res
@@ -0,0 +1,165 @@
+########################################
+# Columnar storage of hyperopt results #
+########################################
+# Reading the losses or the best configurations from a pickled hyperopt Trials object
+# requires unpickling all per-trial dicts, which is slow for many trials.
+# Instead, the results can be stored as a directory with one .npy file per column
+# (which can be memory-mapped), together with a small meta.json file:
+# - loss: loss value of each trial (nan for failed trials)
+# - tid: hyperopt trial id
+# - config: matrix of cut values (one row per trial, one column per cut name)
+# - extra_<key>: numeric values in the extra_info of each trial (e.g. nsig_pass)
+# - time_book, time_refresh: start and end time of each trial (seconds since epoch)
+# Non-numeric extra_info values that are the same for all trials (e.g. the loss function)
+# are stored in meta.json.
+# The losses used for ranking (get_trial_losses for Trials objects, load_losses for results
+# directories) are missing (nan) for trials evaluated on a subsample of the events only
+# (i.e. with fidelity smaller than 1, see tools/multifidelity.py),
+# so they are never preferred over trials evaluated on all events.
+# Usage (standalone, converting an existing output file):
+# - python tools/resultsfile.py -i <output.pkl> -o <output directory>
+
+
+# imports
+import os
+import sys
+import json
+import shutil
+import argparse
+import numbers
+import numpy as np
+
+
+def get_trial_loss( trial ):
+    ### get the loss of a single trial (as in a Trials object) for ranking
+    # returns:
+    # the loss as a float, or nan for failed trials and trials with fidelity smaller than 1
+    result = trial['result']
+    if( result.get('status')!='ok' or result.get('loss') is None ): return np.nan
+    if result.get('extra_info', {}).get('fidelity', 1) < 1: return np.nan
+    return float(result['loss'])
+
+def get_trial_losses( trials ):
+    ### get the losses of all trials in a Trials object for ranking (see get_trial_loss)
+    return np.array([get_trial_loss(trial) for trial in trials.trials], dtype=np.float64)
+
+def get_timestamp( dt ):
+    ### convert a (naive utc) datetime to seconds since epoch, or nan if not set
+    if dt is None: return np.nan
+    return (dt - dt.__class__(1970, 1, 1)).total_seconds()
+
+def trials_to_columns( trials ):
+    ### convert a hyperopt Trials object to a dict of columns
+    # returns:
+    # a tuple of the form (columns, meta), where columns is a dict of numpy arrays
+    # and meta a json-serializable dict with the cut names and constant extra info.
+    trials = [trial for trial in trials.trials if trial['result'].get('status')=='ok']
+    cutnames = []
+    for trial in trials:
+        for name in trial['misc']['vals'].keys():
+            if name not in cutnames: cutnames.append(name)
+    columns = {}
+    columns['loss'] = np.array([trial['result'].get('loss', np.nan) for trial in trials],
+                               dtype=np.float64)
+    columns['tid'] = np.array([trial['tid'] for trial in trials], dtype=np.int64)
+    # note: a cut that was not set in a trial (e.g. in conditional search spaces)
+    #       is stored as nan.
+    config = np.full((len(trials), len(cutnames)), np.nan, dtype=np.float64)
+    for idx, trial in enumerate(trials):
+        for j, name in enumerate(cutnames):
+            val = trial['misc']['vals'].get(name, [])
+            if len(val)>0: config[idx, j] = val[0]
+    columns['config'] = config
+    # extra info
+    constants = {}
+    keys = []
+    for trial in trials:
+        for key in trial['result'].get('extra_info', {}).keys():
+            if key not in keys: keys.append(key)
+    for key in keys:
+        values = [trial['result'].get('extra_info', {}).get(key) for trial in trials]
+        if all([isinstance(val, numbers.Number) for val in values]):
+            column = np.asarray(values)
+            if column.dtype.kind=='b': column = column.astype(np.int8)
+            columns['extra_{}'.format(key)] = column
+        elif all([val==values[0] for val in values]):
+            constants[key] = values[0]
+    # timings
+    columns['time_book'] = np.array([get_timestamp(trial.get('book_time')) for trial in trials],
+                                    dtype=np.float64)
+    columns['time_refresh'] = np.array([get_timestamp(trial.get('refresh_time')) for trial in trials],
+                                       dtype=np.float64)
+    meta = {'ntrials': len(trials), 'cutnames': cutnames,
+            'extrakeys': keys, 'constants': constants,
+            'columns': {name: column.dtype.str for name, column in columns.items()}}
+    return (columns, meta)
+
+
+def write_results( trials, outputdir ):
+    ### write a hyperopt Trials object as a columnar results directory
+    # note: the directory is first written under a temporary name and then moved in place,
+    #       so readers never see a partially written directory.
+    (columns, meta) = trials_to_columns(trials)
+    outputdir = os.path.normpath(outputdir)
+    tmpdir = outputdir + '.tmp{}'.format(os.getpid())
+    os.makedirs(tmpdir)
+    for name, column in columns.items():
+        np.save(os.path.join(tmpdir, name+'.npy'), np.ascontiguousarray(column))
+    with open(os.path.join(tmpdir, 'meta.json'), 'w') as f: json.dump(meta, f)
+    olddir = None
+    if os.path.exists(outputdir):
+        olddir = outputdir + '.old{}'.format(os.getpid())
+        os.replace(outputdir, olddir)
+    os.replace(tmpdir, outputdir)
+    if olddir is not None: shutil.rmtree(olddir)
+
+def is_results_dir( path ):
+    ### check whether a path is a columnar results directory
+    return os.path.isfile(os.path.join(path, 'meta.json'))
+
+def load_meta( inputdir ):
+    ### load the meta information of a columnar results directory
+    with open(os.path.join(inputdir, 'meta.json'), 'r') as f: return json.load(f)
+
+def load_column( inputdir, name, mmap=True ):
+    ### load a single column from a columnar results directory
+    # note: with mmap=True, the data is only read from disk when it is accessed.
+    return np.load(os.path.join(inputdir, name+'.npy'), mmap_mode='r' if mmap else None)
+
+def load_losses( inputdir, mmap=True ):
+    ### load the losses of a columnar results directory for ranking
+    # note: same as the loss column, but with nan for trials with fidelity smaller than 1.
+    losses = load_column(inputdir, 'loss', mmap=mmap)
+    if 'extra_fidelity' in load_meta(inputdir)['columns']:
+        losses = np.where(load_column(inputdir, 'extra_fidelity') < 1, np.nan, losses)
+    return losses
+
+def load_results( inputdir, names=None, mmap=True ):
+    ### load (a subset of) the columns of a columnar results directory
+    # input arguments:
+    # - inputdir: results directory, as written by write_results
+    # - names: list of column names to load (default: all columns)
+    # - mmap: memory-map the columns instead of reading them
+    # returns:
+    # a tuple of the form (columns, meta)
+    meta = load_meta(inputdir)
+    if names is None: names = list(meta['columns'].keys())
+    columns = {name: load_column(inputdir, name, mmap=mmap) for name in names}
+    return (columns, meta)
+
+
+if __name__=='__main__':
+
+    # read arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--inputfile', required=True)
+    parser.add_argument('-o', '--outputdir', required=True)
+    args = parser.parse_args()
+
+    # convert the file
+    import pickle as pkl
+    with open(args.inputfile, 'rb') as f: trials = pkl.load(f)
+    write_results(trials, args.outputdir)
+    meta = load_meta(args.outputdir)
+    print('Wrote {} trials with columns {} to {}'.format(
+           meta['ntrials'], list(meta['columns'].keys()), args.outputdir))
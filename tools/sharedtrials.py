@@ -0,0 +1,301 @@
+#############################################################
+# Hyperopt trials shared between jobs through a SQLite file #
+#############################################################
+# A study is a named set of trials stored in a SQLite database file,
+# which can be on a local or a shared (network) filesystem, so no database server is needed.
+# One job creates the study, after which any number of jobs (on the same or other nodes)
+# can attach to it by name. Each job repeatedly:
+# - claims a trial that is not started yet (e.g. pre-defined points added by the creating job),
+#   or reserves a new trial id and makes a new suggestion based on the trials of all jobs,
+# - evaluates it locally and writes the result back to the database,
+# - reads the trials that were added or updated by the other jobs since the last time,
+# so that the suggestion algorithm (e.g. tpe) learns from the results of all jobs.
+# The maximum number of trials applies to the study as a whole.
+# Each trial is stored as a pickled hyperopt trial document, and the local view of the study
+# is a regular hyperopt Trials object, so the output of each job contains the full study
+# in the same format as the output of a single run.
+# note: all writes are short transactions that lock the whole database file,
+#       which relies on the file locking of the filesystem; this works on local filesystems
+#       and on most network filesystems (e.g. NFS with locking enabled), but not on all of them.
+# note: trials that are still running when a job is killed stay in the running state;
+#       they can be put back in the queue after a given time (see TrialStore.requeue_stale).
+
+
+# imports
+import os
+import sys
+import json
+import time
+import hashlib
+import socket
+import sqlite3
+import contextlib
+import pickle as pkl
+import numpy as np
+from hyperopt import base, pyll, Trials
+from hyperopt.progress import default_callback, no_progress_callback
+from hyperopt.utils import coarse_utcnow
+
+
+class TrialStore(object):
+
+    def __init__( self, dbfile, study, create=False, settings=None, timeout=600. ):
+        # input arguments:
+        # - dbfile: SQLite database file (created if it does not exist yet)
+        # - study: name of the study
+        # - create: create a new study (raise an exception if it already exists),
+        #           else attach to an existing one (raise an exception if it does not exist)
+        # - settings: json-serializable object with the settings that must be the same
+        #             for all jobs in the study (e.g. the input files and the grid);
+        #             stored when creating the study and compared when attaching to it
+        # - timeout: maximum time in seconds to wait for a lock on the database
+        self.dbfile = dbfile
+        self.study = study
+        self.owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+        # note: transactions are managed explicitly (see transaction).
+        self.conn = sqlite3.connect(dbfile, timeout=timeout, isolation_level=None)
+        with self.transaction() as cursor:
+            cursor.execute('CREATE TABLE IF NOT EXISTS studies'
+                           +' (name TEXT PRIMARY KEY, settings TEXT, created REAL)')
+            cursor.execute('CREATE TABLE IF NOT EXISTS trials'
+                           +' (study TEXT, tid INTEGER, state INTEGER, owner TEXT,'
+                           +' booked REAL, version INTEGER, doc BLOB, PRIMARY KEY (study, tid))')
+            row = cursor.execute('SELECT settings FROM studies WHERE name=?', (study,)).fetchone()
+            settingsstr = json.dumps(settings, sort_keys=True)
+            if create:
+                if row is not None:
+                    msg = 'ERROR: study {} already exists in {};'.format(study, dbfile)
+                    msg += ' attach to it instead of creating it, or use another name.'
+                    raise Exception(msg)
+                cursor.execute('INSERT INTO studies VALUES (?, ?, ?)',
+                               (study, settingsstr, time.time()))
+            else:
+                if row is None:
+                    msg = 'ERROR: study {} not found in {};'.format(study, dbfile)
+                    msg += ' it must be created by one of the jobs first.'
+                    raise Exception(msg)
+                if( settings is not None and row[0]!=settingsstr ):
+                    msg = 'ERROR: the settings of this job do not match those of study {}'.format(study)
+                    stored = json.loads(row[0])
+                    if( isinstance(settings, dict) and isinstance(stored, dict) ):
+                        diff = sorted([key for key in set(settings.keys()) | set(stored.keys())
+                                       if settings.get(key)!=stored.get(key)])
+                        msg += ' (different {})'.format(diff)
+                    raise Exception(msg+'.')
+        # local view of the study
+        self.trials = Trials()
+        self.docs = {}
+        self.version = 0
+        self.nevaluated = 0
+
+    @contextlib.contextmanager
+    def transaction( self ):
+        ### context manager for a transaction that locks the database for writing
+        cursor = self.conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            yield cursor
+            cursor.execute('COMMIT')
+        except:
+            cursor.execute('ROLLBACK')
+            raise
+
+    def close( self ):
+        ### close the connection to the database
+        self.conn.close()
+
+    def write( self, cursor, doc ):
+        ### write a trial document (within a transaction)
+        # note: the version is increased for each write, so that other jobs
+        #       can read only the trials that changed since their last sync.
+        version = cursor.execute('SELECT COALESCE(MAX(version), 0)+1 FROM trials WHERE study=?',
+                                 (self.study,)).fetchone()[0]
+        cursor.execute('INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       (self.study, doc['tid'], doc['state'], doc.get('owner'),
+                        time.time(), version, pkl.dumps(doc)))
+
+    def add_trials( self, trials ):
+        ### add the trials of a Trials object to the study
+        # (e.g. pre-defined points from hyperopt.fmin.generate_trials_to_calculate,
+        #  or the trials of an earlier run)
+        # note: the trial ids are kept, so this should be done before any trials are added.
+        with self.transaction() as cursor:
+            for doc in trials._dynamic_trials: self.write(cursor, doc)
+
+    def sync( self ):
+        ### update the local Trials object with the trials that changed in the database
+        # returns:
+        # the number of trials that changed
+        rows = self.conn.execute('SELECT tid, version, doc FROM trials'
+                                 +' WHERE study=? AND version>? AND doc IS NOT NULL',
+                                 (self.study, self.version)).fetchall()
+        for (tid, version, doc) in rows:
+            self.docs[tid] = pkl.loads(doc)
+            self.version = max(self.version, version)
+        if len(rows)>0:
+            self.trials._dynamic_trials[:] = [self.docs[tid] for tid in sorted(self.docs.keys())]
+            self.trials.refresh()
+        return len(rows)
+
+    def claim( self ):
+        ### claim the first trial that was not started yet
+        # returns:
+        # the trial document (in the running state), or None if there is none
+        with self.transaction() as cursor:
+            row = cursor.execute('SELECT doc FROM trials WHERE study=? AND state=?'
+                                 +' AND doc IS NOT NULL ORDER BY tid LIMIT 1',
+                                 (self.study, base.JOB_STATE_NEW)).fetchone()
+            if row is None: return None
+            doc = pkl.loads(row[0])
+            doc['state'] = base.JOB_STATE_RUNNING
+            doc['owner'] = self.owner
+            doc['book_time'] = coarse_utcnow()
+            self.write(cursor, doc)
+        return doc
+
+    def reserve( self, max_evals ):
+        ### reserve the id for a new trial
+        # returns:
+        # the trial id, or None if the study already has max_evals trials
+        # note: the reserved trial has no document until it is written with update,
+        #       so it is not seen by the other jobs, but its id is not given out again.
+        with self.transaction() as cursor:
+            (ntrials, maxtid) = cursor.execute('SELECT COUNT(*), MAX(tid) FROM trials WHERE study=?',
+                                               (self.study,)).fetchone()
+            if ntrials>=max_evals: return None
+            tid = 0 if maxtid is None else maxtid+1
+            cursor.execute('INSERT INTO trials VALUES (?, ?, ?, ?, ?, ?, NULL)',
+                           (self.study, tid, base.JOB_STATE_RUNNING, self.owner, time.time(), 0))
+        return tid
+
+    def release( self, tid ):
+        ### remove a reserved trial id that was not used
+        with self.transaction() as cursor:
+            cursor.execute('DELETE FROM trials WHERE study=? AND tid=? AND doc IS NULL',
+                           (self.study, tid))
+
+    def update( self, doc ):
+        ### write a (new or updated) trial document to the study
+        with self.transaction() as cursor: self.write(cursor, doc)
+
+    def requeue_stale( self, maxtime ):
+        ### put trials that have been running for too long back in the queue
+        # input arguments:
+        # - maxtime: time in seconds after which a running trial is considered stale
+        #            (e.g. because the job evaluating it was killed)
+        # returns:
+        # the number of trials that were put back in the queue
+        # note: stale trial ids that were reserved but never got a document are removed.
+        # note: if the original job finishes a requeued trial after all,
+        #       the last result written is kept.
+        nrequeued = 0
+        with self.transaction() as cursor:
+            rows = cursor.execute('SELECT tid, doc FROM trials WHERE study=? AND state=? AND booked<?',
+                                  (self.study, base.JOB_STATE_RUNNING, time.time()-maxtime)).fetchall()
+            for (tid, doc) in rows:
+                if doc is None:
+                    cursor.execute('DELETE FROM trials WHERE study=? AND tid=?', (self.study, tid))
+                    continue
+                doc = pkl.loads(doc)
+                doc['state'] = base.JOB_STATE_NEW
+                doc['owner'] = None
+                doc['book_time'] = None
+                doc['result'] = {'status': base.STATUS_NEW}
+                self.write(cursor, doc)
+                nrequeued += 1
+        return nrequeued
+
+    def count( self ):
+        ### count the trials in the study by state
+        # returns:
+        # a dict mapping hyperopt job states to number of trials
+        # (reserved trial ids without a document are not included)
+        rows = self.conn.execute('SELECT state, COUNT(*) FROM trials WHERE study=?'
+                                 +' AND doc IS NOT NULL GROUP BY state', (self.study,)).fetchall()
+        return {state: n for (state, n) in rows}
+
+    def report( self ):
+        ### make a summary of the study
+        counts = self.count()
+        res = 'Study {} in {}: {} trials done'.format(self.study, self.dbfile,
+                counts.get(base.JOB_STATE_DONE, 0))
+        res += ', {} running, {} queued'.format(counts.get(base.JOB_STATE_RUNNING, 0),
+                counts.get(base.JOB_STATE_NEW, 0))
+        if counts.get(base.JOB_STATE_ERROR, 0)>0:
+            res += ', {} failed'.format(counts[base.JOB_STATE_ERROR])
+        res += ' ({} evaluated by this job)'.format(self.nevaluated)
+        return res
+
+
+def fmin_shared( fn, space, algo, max_evals, store,
+                 rstate=None, show_progressbar=True, early_stop_fn=None ):
+    ### same as hyperopt.fmin, but with the trials shared with other jobs through a TrialStore
+    # input arguments:
+    # - fn, space, algo, rstate, show_progressbar, early_stop_fn: see hyperopt.fmin
+    #   (early_stop_fn is called with the trials of the whole study, and only stops this job)
+    # - max_evals: maximum number of trials in the study (for all jobs together)
+    # - store: a TrialStore instance
+    # returns:
+    # the local Trials object of the store, with all trials of the study
+    # note: this job stops when the study has max_evals trials,
+    #       while trials of other jobs may still be running.
+    if rstate is None:
+        seed = os.environ.get('HYPEROPT_FMIN_SEED', '')
+        # note: each job needs different suggestions, so the seed is combined with the job
+        #       (host name and process id, since jobs on different nodes can have the same pid).
+        jobkey = int(hashlib.sha1(store.owner.encode()).hexdigest()[:16], 16)
+        rstate = np.random.default_rng([int(seed), jobkey] if seed else None)
+    domain = base.Domain(fn, space)
+    store.sync()
+    trials = store.trials
+    progress = default_callback if show_progressbar else no_progress_callback
+    ndone = trials.count_by_state_unsynced(base.JOB_STATE_DONE)
+    early_stop_args = []
+    with progress(initial=ndone, total=max_evals) as progress_ctx:
+        while True:
+            # claim a queued trial, or make a new suggestion
+            doc = store.claim()
+            if doc is None:
+                tid = store.reserve(max_evals)
+                if tid is None: break
+                store.sync()
+                new_trials = algo([tid], domain, trials, rstate.integers(2**31-1))
+                if len(new_trials)==0:
+                    store.release(tid)
+                    break
+                doc = new_trials[0]
+                doc['state'] = base.JOB_STATE_RUNNING
+                doc['owner'] = store.owner
+                doc['book_time'] = coarse_utcnow()
+                store.update(doc)
+            # evaluate the trial
+            # (if the evaluation fails, the trial is marked as failed in the study,
+            #  so that it does not stay in the running state for all jobs)
+            try:
+                memo = domain.memo_from_config(base.spec_from_misc(doc['misc']))
+                config = pyll.rec_eval(domain.expr, memo=memo)
+                doc['result'] = fn(config)
+            except Exception as e:
+                doc['state'] = base.JOB_STATE_ERROR
+                doc['result'] = {'status': base.STATUS_FAIL}
+                doc['misc']['error'] = (str(type(e)), str(e))
+                doc['refresh_time'] = coarse_utcnow()
+                store.update(doc)
+                raise
+            doc['state'] = base.JOB_STATE_DONE
+            doc['refresh_time'] = coarse_utcnow()
+            store.update(doc)
+            store.nevaluated += 1
+            store.sync()
+            # update the progress bar with the trials done by all jobs
+            losses = [loss for loss in trials.losses() if loss is not None]
+            if len(losses)>0: progress_ctx.postfix = 'best loss: {}'.format(min(losses))
+            newdone = trials.count_by_state_unsynced(base.JOB_STATE_DONE)
+            progress_ctx.update(newdone-ndone)
+            ndone = newdone
+            # check the early stopping rules
+            if early_stop_fn is not None:
+                (stop, early_stop_args) = early_stop_fn(trials, *early_stop_args)
+                if stop: break
+    store.sync()
+    return trials
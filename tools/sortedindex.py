@@ -0,0 +1,129 @@
+############################################################
+# Count passing events using sorted cut columns (no masks) #
+############################################################
+# The reduced cut columns are sorted once, after which the number of events
+# passing a single cut is found with a binary search (O(log N) per trial).
+# For multiple cuts, only the events passing the most selective cut
+# (found from the sorted order) are checked against the other cuts.
+# Weighted yields are obtained in the same way from cumulative sums of the weights.
+
+
+# imports
+import numpy as np
+
+# local imports
+from cuttools import parse_cutname
+
+
+def cast_cutvalue( cutvalue, dtype ):
+    ### convert a cut value to float64 such that comparisons give identical results
+    # note: numpy compares e.g. a float32 array with a python float in float32 precision,
+    #       so the cut value is first rounded to the precision in which the comparison
+    #       with the original column would be done.
+    comptype = np.result_type(dtype, cutvalue)
+    return np.float64(np.asarray(cutvalue, dtype=comptype))
+
+
+class SortedIndexEngine(object):
+
+    def __init__( self, columns, sig_mask, weights=None ):
+        # input arguments:
+        # - columns: dict mapping cut names to arrays with one value per event,
+        #            as obtained from cuttools.make_cut_columns
+        # - sig_mask: boolean array with one value per event
+        # - weights: array with one weight per event (default: no weighted yields)
+        self.columns = columns
+        self.sig_mask = np.asarray(sig_mask, dtype=bool)
+        self.nsig_tot = int(np.count_nonzero(self.sig_mask))
+        self.nbkg_tot = len(self.sig_mask) - self.nsig_tot
+        self.weights = None
+        if weights is not None:
+            self.weights = np.asarray(weights, dtype=np.float32)
+            self.wsig_tot = float(np.sum(self.weights[self.sig_mask], dtype=np.float64))
+            self.wbkg_tot = float(np.sum(self.weights[~self.sig_mask], dtype=np.float64))
+        self.cuttypes = {}
+        self.order = {}
+        self.values = {}
+        self.sigcounts = {}
+        self.sigweights = {}
+        self.bkgweights = {}
+        for cutname, column in columns.items():
+            self.cuttypes[cutname] = parse_cutname(cutname)[1]
+            # sort the events with a valid value (nan never passes a cut)
+            valid = np.nonzero(~np.isnan(column))[0]
+            order = valid[np.argsort(column[valid], kind='stable')]
+            self.order[cutname] = order
+            self.values[cutname] = column[order].astype(np.float64)
+            # cumulative number of signal events in sorted order
+            sigcounts = np.zeros(len(order)+1, dtype=np.int64)
+            np.cumsum(self.sig_mask[order], out=sigcounts[1:])
+            self.sigcounts[cutname] = sigcounts
+            # cumulative signal and background weights in sorted order
+            if self.weights is not None:
+                weights = self.weights[order].astype(np.float64)
+                sigweights = np.zeros(len(order)+1, dtype=np.float64)
+                np.cumsum(np.where(self.sig_mask[order], weights, 0.), out=sigweights[1:])
+                self.sigweights[cutname] = sigweights
+                bkgweights = np.zeros(len(order)+1, dtype=np.float64)
+                np.cumsum(np.where(self.sig_mask[order], 0., weights), out=bkgweights[1:])
+                self.bkgweights[cutname] = bkgweights
+
+    def get_range( self, cutname, cutvalue ):
+        ### get the range of passing events in sorted order for a single cut
+        values = self.values[cutname]
+        cutvalue = cast_cutvalue(cutvalue, self.columns[cutname].dtype)
+        if self.cuttypes[cutname]=='max':
+            return (0, int(np.searchsorted(values, cutvalue, side='left')))
+        return (int(np.searchsorted(values, cutvalue, side='right')), len(values))
+
+    def select( self, cuts ):
+        ### find the passing events for a configuration of cuts
+        # returns:
+        # a tuple of the form (best, low, high, indices), where (low, high) is the range
+        # in sorted order of the most selective cut (best), and indices the array
+        # of passing events (or None if there is only one cut, in which case
+        # the passing events are exactly the ones in the range).
+        ranges = {cutname: self.get_range(cutname, cutvalue) for cutname, cutvalue in cuts.items()}
+        # find the most selective cut
+        best = min(ranges.keys(), key=lambda cutname: ranges[cutname][1]-ranges[cutname][0])
+        (low, high) = ranges[best]
+        if high<=low: return (best, low, low, np.zeros(0, dtype=np.int64))
+        # if there is only one cut, the range can be used directly
+        if len(cuts)==1: return (best, low, high, None)
+        # else, apply the other cuts only on the events passing the most selective one
+        indices = self.order[best][low:high]
+        mask = np.ones(len(indices), dtype=bool)
+        for cutname, cutvalue in cuts.items():
+            if cutname==best: continue
+            varvalue = self.columns[cutname][indices]
+            if self.cuttypes[cutname]=='max': mask &= (varvalue < cutvalue)
+            if self.cuttypes[cutname]=='min': mask &= (varvalue > cutvalue)
+        return (best, low, high, indices[mask])
+
+    def count( self, cuts ):
+        ### get the number of passing signal and background events
+        # returns:
+        # a tuple of the form (nsig_pass, nbkg_pass)
+        (best, low, high, indices) = self.select(cuts)
+        if indices is None:
+            nsig_pass = int(self.sigcounts[best][high] - self.sigcounts[best][low])
+            return (nsig_pass, high-low-nsig_pass)
+        nsig_pass = int(np.count_nonzero(self.sig_mask[indices]))
+        return (nsig_pass, len(indices)-nsig_pass)
+
+    def count_weighted( self, cuts ):
+        ### get the number and the weighted yield of passing signal and background events
+        # returns:
+        # a tuple of the form (nsig_pass, nbkg_pass, wsig_pass, wbkg_pass)
+        (best, low, high, indices) = self.select(cuts)
+        if indices is None:
+            nsig_pass = int(self.sigcounts[best][high] - self.sigcounts[best][low])
+            wsig_pass = float(self.sigweights[best][high] - self.sigweights[best][low])
+            wbkg_pass = float(self.bkgweights[best][high] - self.bkgweights[best][low])
+            return (nsig_pass, high-low-nsig_pass, wsig_pass, wbkg_pass)
+        issig = self.sig_mask[indices]
+        weights = self.weights[indices]
+        nsig_pass = int(np.count_nonzero(issig))
+        wsig_pass = float(np.sum(weights[issig], dtype=np.float64))
+        wbkg_pass = float(np.sum(weights[~issig], dtype=np.float64))
+        return (nsig_pass, len(indices)-nsig_pass, wsig_pass, wbkg_pass)
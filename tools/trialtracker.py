@@ -0,0 +1,47 @@
+##########################################
+# Keep track of finished hyperopt trials #
+##########################################
+# Hooks that are called after each trial (or batch of trials), such as the early stopping rules
+# (see tools/earlystop.py) and the profiler (see tools/profiling.py), need the trials that
+# finished since the last call. Simply taking the trials after the last seen position
+# is not enough, since the Trials object can contain trials that are not finished yet
+# (e.g. trials that other jobs are evaluating in a shared study, see tools/sharedtrials.py),
+# and trials can be inserted before the last seen position (e.g. in a shared study,
+# where the trials are sorted by id and trials of other jobs can finish in any order).
+# Instead, the ids of the finished trials that were returned are kept,
+# and each trial is returned once, as soon as it is finished.
+
+
+# imports
+from hyperopt import base
+
+
+class TrialTracker(object):
+
+    def __init__( self ):
+        self.seen = set()
+        # index of the first trial that was not returned yet, and the id of the trial before it
+        self.start = 0
+        self.lasttid = None
+
+    def get_new( self, trials ):
+        ### get the finished trials that were not returned before
+        # input arguments:
+        # - trials: hyperopt Trials object
+        # returns:
+        # a list of trial documents with state done or error
+        # note: only the trials after the first one that was not returned yet are looked at,
+        #       so each call is fast also for a large number of trials,
+        #       unless trials were inserted before it, in which case all trials are looked at.
+        trials = trials.trials
+        if( self.start>len(trials) or (self.start>0 and trials[self.start-1]['tid']!=self.lasttid) ):
+            self.start = 0
+        newtrials = []
+        for trial in trials[self.start:]:
+            if trial['state'] not in (base.JOB_STATE_DONE, base.JOB_STATE_ERROR): continue
+            if trial['tid'] in self.seen: continue
+            self.seen.add(trial['tid'])
+            newtrials.append(trial)
+        while( self.start<len(trials) and trials[self.start]['tid'] in self.seen ): self.start += 1
+        if self.start>0: self.lasttid = trials[self.start-1]['tid']
+        return newtrials